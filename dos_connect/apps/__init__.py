@@ -6,18 +6,24 @@ applications
 This common module contains methods for logging, args, and client connection
 """
 import argparse
+import atexit
 import logging
 import sys
+import threading
+import time
+import Queue
 import requests.packages.urllib3
 from ga4gh.dos.client import Client
 from bravado.requests_client import RequestsClient
+from dos_connect.http_session import session
+from dos_connect import json_codec
 import logging
-import json
 import os
 from urlparse import urlparse
 from importlib import import_module
 
 _CLIENT = None
+_BATCHER = None
 
 # import our plugin
 customizer_name = os.getenv('CUSTOMIZER', 'dos_connect.apps.noop_customizer')
@@ -37,6 +43,27 @@ def common_args(argparser):
     argparser.add_argument("-v", "--verbose", help="increase output verbosity",
                            default=False,
                            action="store_true")
+    argparser.add_argument('--batch_size', '-bs',
+                           help='send data objects to the server in batches '
+                                'of this size from a background thread, '
+                                '0 sends each one as it is stored',
+                           default=0,
+                           type=int)
+    argparser.add_argument('--batch_interval', '-bi',
+                           help='max seconds a data object waits in the '
+                                'buffer before its batch is sent',
+                           default=5.0,
+                           type=float)
+    argparser.add_argument('--batch_queue_size', '-bq',
+                           help='max buffered data objects, store() blocks '
+                                'when the buffer is full',
+                           default=10000,
+                           type=int)
+    argparser.add_argument('--batch_retries', '-br',
+                           help='times to retry a data object the server '
+                                'could not accept',
+                           default=3,
+                           type=int)
     return argparser
 
 
@@ -62,6 +89,22 @@ def custom_args(argparser):
                            help='api key name',
                            default='X-API-Key')
 
+    argparser.add_argument('--http_pool_size', '-hp',
+                           help='keep-alive connections to the dos server',
+                           default=None,
+                           type=int)
+
+    argparser.add_argument('--http_retries', '-hr',
+                           help='retries of failed connections to the '
+                                'dos server',
+                           default=None,
+                           type=int)
+
+    argparser.add_argument('--http_timeout', '-ht',
+                           help='seconds to wait for the dos server',
+                           default=None,
+                           type=float)
+
 
 def common_logging(args):
     """ log to stdout """
@@ -82,6 +125,11 @@ def client_factory(args):
             'validate_responses': False
         }
         http_client = RequestsClient()
+        # pooled keep-alive connections, retries and timeout
+        http_client.session = session('dos_server',
+                                      pool_size=args.http_pool_size,
+                                      retries=args.http_retries,
+                                      timeout=args.http_timeout)
         hostname = urlparse(args.dos_server).hostname
         if args.api_key:
             http_client.set_api_key(hostname, args.api_key,
@@ -104,6 +152,178 @@ def client_factory(args):
     return _CLIENT
 
 
+class _Batcher(object):
+    """ buffer data objects, send them in batches from a background thread """
+
+    def __init__(self, args):
+        super(_Batcher, self).__init__()
+        self.args = args
+        self.logger = logging.getLogger(__name__)
+        # bounded, so a slow server pushes back on the producer
+        self.queue = Queue.Queue(maxsize=args.batch_queue_size)
+        # (data_object, key, sent, attempt) waiting to be resent
+        self.retries = []
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='dos-batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, data_object, key, sent=None):
+        """
+        enqueue, blocks while the buffer is full.
+        sent() is called once the server has accepted the data object
+        """
+        self.queue.put((data_object, key, sent, 0))
+
+    def flush(self):
+        """ block until every buffered data object has been handled """
+        self.queue.join()
+
+    def close(self):
+        """ flush, then stop the thread before interpreter teardown """
+        self.flush()
+        # wake the thread, it exits instead of waiting for the deadline
+        self.queue.put(None)
+        self.thread.join()
+
+    def _next_batch(self):
+        """ retries first, then whatever arrives before the deadline """
+        batch = self.retries[:self.args.batch_size]
+        self.retries = self.retries[self.args.batch_size:]
+        deadline = time.time() + self.args.batch_interval
+        while len(batch) < self.args.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            if item is None:
+                self.closed = True
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while not self.closed:
+            batch = self._next_batch()
+            if batch and self._send(batch):
+                # back off before resending
+                attempt = max([attempt for _, _, _, attempt in self.retries])
+                time.sleep(min(2 ** attempt, 60))
+
+    def _send(self, batch):
+        """
+        send batch, return True if anything was queued for retry.
+        never raises, an exception would stop the thread and flush()
+        would wait forever, every item not retried is marked done
+        """
+        results = []
+        try:
+            client = client_factory(self.args)
+            CreateDataObjectsRequest = client.models.get_model(
+                                        'CreateDataObjectsRequest')
+            create_request = CreateDataObjectsRequest(
+                data_objects=[data_object for data_object, _, _, _ in batch])
+            results = client.client.CreateDataObjects(
+                body=create_request).result().results
+        except Exception as e:
+            self.logger.exception(e)
+        # objects without a result are retried like a server error
+        results = list(results or [])
+        results += [None] * (len(batch) - len(results))
+
+        retrying = False
+        for (data_object, key, sent, attempt), result in zip(batch, results):
+            retry = False
+            try:
+                status_code = getattr(result, 'status_code', 500)
+                if status_code == 200:
+                    self.logger.info('sent to dos_server: {} {}'
+                                     .format(key, result.data_object_id))
+                    _call(sent, key)
+                elif status_code < 500:
+                    self.logger.error('dos_server rejected: {} {}'
+                                      .format(key, result.msg))
+                elif attempt < self.args.batch_retries:
+                    self.retries.append((data_object, key, sent, attempt + 1))
+                    retry = retrying = True
+                else:
+                    self.logger.error('giving up on: {}'.format(key))
+            except Exception as e:
+                self.logger.exception(e)
+            finally:
+                if not retry:
+                    self.queue.task_done()
+        return retrying
+
+
+def _call(sent, key):
+    """ call the sent() callback of a data object, log its errors """
+    if not sent:
+        return
+    try:
+        sent()
+    except Exception as e:
+        logging.getLogger(__name__).exception(
+            'acknowledging {} failed: {}'.format(key, e))
+
+
+class Acknowledgement(object):
+    """
+    acknowledge a queue message once every data object stored from it
+    reached the server, with --batch_size that is after their batch was
+    sent, not when store() returns.
+
+        acknowledgement = Acknowledgement(message.delete)
+        store(args, data_object, sent=acknowledgement.expect())
+        acknowledgement.done()
+
+    a message whose data objects are rejected or given up on is not
+    acknowledged, the queue delivers it again
+    """
+
+    def __init__(self, ack):
+        super(Acknowledgement, self).__init__()
+        self.ack = ack
+        self.lock = threading.Lock()
+        # released by done(), so ack waits for every store()
+        self.pending = 1
+
+    def expect(self):
+        """ the sent() callback of one more data object """
+        with self.lock:
+            self.pending += 1
+        return self._sent
+
+    def done(self):
+        """ the message has been processed, every store() was called """
+        self._sent()
+
+    def _sent(self):
+        with self.lock:
+            self.pending -= 1
+            if self.pending:
+                return
+        self.ack()
+
+
+def flush():
+    """ send any buffered data objects, call before exiting """
+    if _BATCHER:
+        _BATCHER.flush()
+
+
+def _batcher(args):
+    """ create the background sender """
+    global _BATCHER
+    if not _BATCHER:
+        _BATCHER = _Batcher(args)
+        atexit.register(_BATCHER.close)
+    return _BATCHER
+
+
 def user_metadata(**kwargs):
     """ call plugin """
     return _user_metadata(**kwargs)
@@ -124,8 +344,11 @@ def id(**kwargs):
     return _id(**kwargs)
 
 
-def store(args, payload):
-    """ convienince method write dict to server """
+def store(args, payload, sent=None):
+    """
+    convienince method write dict to server,
+    sent() is called once the server has the data object, see Acknowledgement
+    """
     before_store(args=args, data_object_dict=payload)
     logger = logging.getLogger(__name__)
     event_type = payload['urls'][0]['system_metadata']['event_type']
@@ -142,12 +365,10 @@ def store(args, payload):
         local_client = client_factory(args)
         models = local_client.models
         client = local_client.client
-        CreateDataObjectRequest = models.get_model(
-                                    'CreateDataObjectRequest')
         DataObject = models.get_model('DataObject')
-        data_object = DataObject().unmarshal(payload)
-        create_request = CreateDataObjectRequest(data_object=data_object)
-        data_object = create_request.data_object
+        # observers set datetime/arrow values, unmarshal wants strings
+        data_object = DataObject().unmarshal(
+            json_codec.loads(json_codec.dumps(payload)))
         # call plugin
         constructed_id = id(data_object=data_object)
         if constructed_id:
@@ -155,9 +376,15 @@ def store(args, payload):
             logger.info('set id to {}'.format(data_object.id))
         else:
             logger.info('data_object id was {}'.format(data_object.id))
+        if args.batch_size:
+            _batcher(args).put(data_object, key, sent)
+            return
+        CreateDataObjectRequest = models.get_model(
+                                    'CreateDataObjectRequest')
         create_request = CreateDataObjectRequest(data_object=data_object)
         create_response = client.CreateDataObject(body=create_request).result()
         data_object_id = create_response['data_object_id']
         logger.info('sent to dos_server: {} {}'.format(key, data_object_id))
     else:
         logger.info('dry_run to dos_server: {}'.format(key))
+    _call(sent, key)
@@ -1,7 +1,7 @@
 """ default client app plugins """
-import requests
 import logging
 import os
+from dos_connect.http_session import session
 
 logger = logging.getLogger(__name__)
 aws_md5_url = os.getenv('AWS_MD5_URL', None)
@@ -28,7 +28,7 @@ def md5sum(**kwargs):
         return etag
 
     url = '{}/{}/{}/md5sum'.format(aws_md5_url, bucket_name, key)
-    response = requests.get(url).json()
+    response = session().get(url).json()
     logger.error(response)
     assert 'md5sum' in response
     return response['md5sum']
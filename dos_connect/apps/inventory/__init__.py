@@ -3,21 +3,245 @@ inventory
 ==========
 scrape cloud side buckets
 """
+import json
+import logging
+import multiprocessing
+import os
 import pickle
+import time
+import urllib
 
+from .. import flush
 
-def get_offset(bucket_name):
-    """ return offset dict """
-    offset = None
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_args(argparser):
+    """ options for inventories that resume from an offset """
+    argparser.add_argument('--checkpoint_every', '-ce',
+                           help='save the offset after this many objects',
+                           default=1000,
+                           type=int)
+    argparser.add_argument('--checkpoint_interval', '-ci',
+                           help='save the offset after this many seconds',
+                           default=30.0,
+                           type=float)
+    return argparser
+
+
+def shard_args(argparser):
+    """ options for inventories that can split the keyspace """
+    argparser.add_argument('--shard_prefixes', '-sp',
+                           help='comma separated key prefixes, '
+                                'each one inventoried as a shard',
+                           default=None)
+    argparser.add_argument('--shard_delimiter', '-sd',
+                           help='shard by the top level prefixes found with '
+                                'this delimiter, e.g. /',
+                           default=None)
+    argparser.add_argument('--processes', '-np',
+                           help='shards inventoried in parallel',
+                           default=1,
+                           type=int)
+    argparser.add_argument('--node_index', '-ni',
+                           help='with --node_count, inventory only every '
+                                'node_count-th shard starting at this one',
+                           default=0,
+                           type=int)
+    argparser.add_argument('--node_count', '-nc',
+                           help='nodes sharing the shards',
+                           default=1,
+                           type=int)
+    return argparser
+
+
+def shards(args, list_prefixes):
+    """
+    return this node's shards as (prefix, delimiter) tuples.
+    list_prefixes(delimiter) returns the bucket's top level prefixes.
+    A delimiter in a shard means only keys directly under its prefix.
+    """
+    if args.shard_prefixes:
+        all_shards = [(prefix, None)
+                      for prefix in args.shard_prefixes.split(',')]
+    elif args.shard_delimiter:
+        # top level keys, then one shard per top level prefix
+        all_shards = [('', args.shard_delimiter)] + \
+            [(prefix, None)
+             for prefix in sorted(list_prefixes(args.shard_delimiter))]
+    else:
+        all_shards = [('', None)]
+    # sorted above, so every node computes the same assignment
+    return [shard for i, shard in enumerate(all_shards)
+            if i % args.node_count == args.node_index]
+
+
+def shard_key(bucket_name, shard):
+    """ checkpoint key, the whole bucket keeps its unsharded key """
+    prefix, delimiter = shard
+    if not prefix and not delimiter:
+        return bucket_name
+    return '{}~{}~{}'.format(bucket_name, prefix, delimiter or '')
+
+
+def _run_shard(job):
+    """ pool entry point """
+    inventory, args, shard = job
     try:
-        with open('offset.{}.pickle'.format(bucket_name)) as data_file:
-            offset = pickle.load(data_file)
+        return inventory(args, shard)
+    except Exception as e:
+        logger.exception(e)
+        return {'key': str(shard), 'error': str(e)}
+
+
+def run_shards(args, inventory, shards):
+    """
+    call inventory(args, shard) for each shard, on a process pool if
+    args.processes > 1. inventory returns its Checkpoint.stats().
+    Log a merged progress report.
+    """
+    started = time.time()
+    jobs = [(inventory, args, shard) for shard in shards]
+    if args.processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(args.processes, len(jobs)))
+        try:
+            results = pool.map(_run_shard, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_run_shard(job) for job in jobs]
+
+    elapsed = time.time() - started
+    run_count = 0
+    for stats in results:
+        if 'error' in stats:
+            logger.error('shard {} failed: {}'
+                         .format(stats['key'], stats['error']))
+            continue
+        run_count += stats['run_count']
+        logger.info('shard {}: {} objects this run, {} total'
+                    .format(stats['key'], stats['run_count'],
+                            stats['count']))
+    logger.info('{} shards done, {} objects in {:.1f}s at {:.1f}/s'
+                .format(len(results), run_count, elapsed,
+                        run_count / elapsed if elapsed else 0.0))
+    return results
+
+
+def _offset_path(key):
+    return 'offset.{}.json'.format(urllib.quote_plus(key))
+
+
+def _read(key):
+    """ return saved checkpoint dict for key, or None """
+    try:
+        with open(_offset_path(key)) as data_file:
+            return json.load(data_file)
     except Exception as e:
         pass
-    return offset
+    # previous releases pickled the bare offset
+    try:
+        with open('offset.{}.pickle'.format(key)) as data_file:
+            return {'offset': pickle.load(data_file)}
+    except Exception as e:
+        pass
+    return None
+
+
+def _write(key, checkpoint):
+    """ write checkpoint dict for key, write-then-rename so never torn """
+    path = _offset_path(key)
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as data_file:
+        json.dump(checkpoint, data_file)
+        data_file.flush()
+        os.fsync(data_file.fileno())
+    os.rename(tmp_path, path)
+
+
+class Checkpoint(object):
+
+    """
+    Batched, crash safe offset for one inventory run.
+    The offset is committed every `every` objects or `interval` seconds,
+    along with cumulative throughput so a resumed run reports its rate.
+    """
+
+    def __init__(self, key, every=1000, interval=30.0):
+        super(Checkpoint, self).__init__()
+        self.key = key
+        self.every = every
+        self.interval = interval
+        saved = _read(key) or {}
+        self.offset = saved.get('offset', None)
+        # totals across all runs
+        self.count = saved.get('count', 0)
+        self.elapsed = saved.get('elapsed', 0.0)
+        # this run
+        self.started = time.time()
+        self.last_commit = self.started
+        self.committed_count = self.count
+        self.run_count = 0
+        if self.offset:
+            logger.info('resuming {} at {}, {} objects so far at {:.1f}/s'
+                        .format(key, self.offset, self.count, self.rate()))
+
+    def rate(self):
+        """ objects per second across all runs """
+        elapsed = self.elapsed + (time.time() - self.last_commit)
+        if not elapsed:
+            return 0.0
+        return self.count / elapsed
+
+    def advance(self, offset, count=1):
+        """ record progress, commit if due """
+        self.offset = offset
+        self.count += count
+        self.run_count += count
+        if (self.count - self.committed_count >= self.every or
+                time.time() - self.last_commit >= self.interval):
+            self.commit()
+
+    def commit(self):
+        """ persist the offset once everything before it has been sent """
+        if self.count == self.committed_count:
+            return
+        # do not checkpoint past data objects still buffered in the client
+        flush()
+        now = time.time()
+        self.elapsed += now - self.last_commit
+        self.last_commit = now
+        self.committed_count = self.count
+        _write(self.key, {'offset': self.offset,
+                          'count': self.count,
+                          'elapsed': self.elapsed})
+
+    def close(self):
+        """ final commit, report this run """
+        self.commit()
+        run_elapsed = time.time() - self.started
+        run_rate = self.run_count / run_elapsed if run_elapsed else 0.0
+        logger.info('{} done, {} objects this run at {:.1f}/s, {} total'
+                    .format(self.key, self.run_count, run_rate, self.count))
+        return self.stats()
+
+    def stats(self):
+        """ progress as a plain dict """
+        return {'key': self.key,
+                'offset': self.offset,
+                'count': self.count,
+                'run_count': self.run_count,
+                'run_elapsed': time.time() - self.started}
+
+
+def get_offset(bucket_name):
+    """ return offset dict """
+    return (_read(bucket_name) or {}).get('offset', None)
 
 
 def save_offset(offset, bucket_name):
     """ save offset dict """
-    with open('offset.{}.pickle'.format(bucket_name), 'w') as data_file:
-        pickle.dump(offset, data_file)
+    checkpoint = _read(bucket_name) or {}
+    checkpoint['offset'] = offset
+    _write(bucket_name, checkpoint)
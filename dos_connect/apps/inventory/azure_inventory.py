@@ -1,4 +1,5 @@
 from azure.storage.blob import BlockBlobService
+from azure.storage.blob.models import BlobPrefix
 from azure.common import AzureException
 # https://docs.microsoft.com/en-us/azure/storage/blobs/storage-blob-event-overview
 # https://docs.microsoft.com/en-us/azure/storage/queues/storage-python-how-to-use-queue-storage
@@ -18,7 +19,9 @@ import attr
 from datetime import datetime
 
 from customizations import store, custom_args
-from .. import common_args, common_logging,  store, custom_args
+from .. import common_args, common_logging,  store, custom_args, flush
+from . import Checkpoint, checkpoint_args, shard_args, shards, shard_key, \
+    run_shards
 
 
 BLOB_SERVICE = None
@@ -78,15 +81,41 @@ def process(args, blob):
     return True
 
 
-def consume(args):
+def list_prefixes(args, delimiter):
+    """ top level prefixes of the container """
+    # not the shared service, shards may run in forked processes
+    blob_service = BlockBlobService(
+        account_name=os.environ.get('BLOB_STORAGE_ACCOUNT'),
+        account_key=os.environ.get('BLOB_STORAGE_ACCESS_KEY'))
+    return [blob.name for blob in blob_service.list_blobs(
+            args.azure_container, delimiter=delimiter)
+            if isinstance(blob, BlobPrefix)]
+
+
+def consume(args, shard=('', None)):
+    prefix, delimiter = shard
+    checkpoint = Checkpoint(shard_key(args.azure_container, shard),
+                            every=args.checkpoint_every,
+                            interval=args.checkpoint_interval)
+    # listing is in name order, resume by skipping what was stored
+    last_name = (checkpoint.offset or {}).get('name', None)
     # Get all the blobs
-    for blob in _blob_service().list_blobs(args.azure_container):
+    for blob in _blob_service().list_blobs(args.azure_container,
+                                           prefix=prefix or None,
+                                           delimiter=delimiter):
+        if isinstance(blob, BlobPrefix):
+            continue
+        if last_name and blob.name <= last_name:
+            continue
         blob_properties = _blob_service().get_blob_properties(
                                             args.azure_container, blob.name)
         try:
             process(args, blob_properties)
+            checkpoint.advance({'name': blob.name})
         except AzureException as e:
             logger.exception(e)
+    flush()
+    return checkpoint.close()
 
 
 def populate_args(argparser):
@@ -98,6 +127,8 @@ def populate_args(argparser):
 
     common_args(argparser)
     custom_args(argparser)
+    checkpoint_args(argparser)
+    shard_args(argparser)
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -108,4 +139,5 @@ if __name__ == '__main__':  # pragma: no cover
     common_logging(args)
     logger = logging.getLogger(__name__)
     logger.debug(args)
-    consume(args)
+    run_shards(args, consume,
+               shards(args, lambda delimiter: list_prefixes(args, delimiter)))
@@ -1,6 +1,6 @@
 # With app.py running start this demo
 from .. import common_args, common_logging,  client_factory, custom_args
-import requests
+from dos_connect.http_session import session
 import json
 import sys
 import argparse
@@ -134,6 +134,29 @@ def post_gdc(gdc):
     #     return e
 
 
+def post_gdc_page(hits):
+    """
+    Takes a page of GDC hits and indexes them into GA4GH in one request.
+    :param hits:
+    :return:
+    """
+    CreateDataObjectsRequest = models.get_model('CreateDataObjectsRequest')
+    create_request = CreateDataObjectsRequest(
+        data_objects=[gdc_to_ga4gh(gdc) for gdc in hits])
+    if not args.dry_run:
+        create_response = client.CreateDataObjects(
+            body=create_request).result()
+        for result in create_response.results:
+            if result.status_code != 200:
+                sys.stderr.write('x')
+            else:
+                sys.stderr.write('.')
+        sys.stderr.flush()
+        return create_response
+    else:
+        print create_request
+
+
 def update_gdc(gdc):
     """
     Takes a GDC hit and updates it into GA4GH.
@@ -176,9 +199,9 @@ def load_gdc():
         print pagination
         url = '{}/files?size={}&related_files=true&from={}&fields={}' \
             .format(GDC_URL, page_length, next_record, fields)
-        response = requests.post(url, json={}, timeout=30).json()
+        response = session().post(url, json={}, timeout=30).json()
         hits = response['data']['hits']
-        map(post_gdc, hits)
+        post_gdc_page(hits)
         pagination = response['data']['pagination']
         next_record = pagination.get('page') * page_length
         # except Exception as e:
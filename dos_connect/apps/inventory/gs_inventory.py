@@ -8,7 +8,9 @@ import time
 import pprint
 import sys
 from datetime import datetime
-from .. import common_args, common_logging,  store, custom_args
+from .. import common_args, common_logging,  store, custom_args, flush
+from . import Checkpoint, checkpoint_args, shard_args, shards, shard_key, \
+    run_shards
 
 
 def to_dos(bucket, record):
@@ -52,6 +54,43 @@ def populate_args(argparser):
                            )
     common_args(argparser)
     custom_args(argparser)
+    checkpoint_args(argparser)
+    shard_args(argparser)
+
+
+def list_prefixes(args, delimiter):
+    """ top level prefixes of the bucket """
+    bucket = storage.Client().get_bucket(args.bucket_name)
+    blobs = bucket.list_blobs(delimiter=delimiter)
+    # prefixes are collected as pages are read
+    for page in blobs.pages:
+        pass
+    return list(blobs.prefixes)
+
+
+def inventory(args, shard):
+    """ inventory the blobs of one (prefix, delimiter) shard """
+    prefix, delimiter = shard
+    checkpoint = Checkpoint(shard_key(args.bucket_name, shard),
+                            every=args.checkpoint_every,
+                            interval=args.checkpoint_interval)
+    # listing is in name order, resume by skipping what was stored
+    last_name = (checkpoint.offset or {}).get('name', None)
+
+    # Instantiates a client
+    storage_client = storage.Client()
+    bucket = storage_client.get_bucket(args.bucket_name)
+    blobs = bucket.list_blobs(prefix=prefix or None, delimiter=delimiter)
+    for blob in blobs:
+        if last_name and blob.name <= last_name:
+            continue
+        try:
+            process(args, bucket, blob.__dict__['_properties'])
+            checkpoint.advance({'name': blob.name})
+        except Exception as e:
+            logging.getLogger(__name__).exception(e)
+    flush()
+    return checkpoint.close()
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -66,9 +105,5 @@ if __name__ == '__main__':  # pragma: no cover
     logger = logging.getLogger(__name__)
     logger.debug(args)
 
-    # Instantiates a client
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(args.bucket_name)
-    blobs = bucket.list_blobs()
-    for blob in blobs:
-        process(args, bucket, blob.__dict__['_properties'])
+    run_shards(args, inventory,
+               shards(args, lambda delimiter: list_prefixes(args, delimiter)))
@@ -7,9 +7,12 @@ import logging
 import argparse
 import urllib
 from botocore.client import Config
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
-from .. import common_args, common_logging,  store, custom_args, md5sum
-from . import get_offset, save_offset
+from .. import common_args, common_logging,  store, custom_args, md5sum, \
+    flush
+from . import Checkpoint, checkpoint_args, shard_args, shards, shard_key, \
+    run_shards
 
 logger = logging.getLogger('s3_inventory')
 
@@ -62,81 +65,153 @@ def to_dos(endpoint_url, region, bucket_name, record, metadata):
         }
 
 
+def fetch_metadata(client, bucket_name, records, pool):
+    """
+    head_object each record on the pool,
+    return user metadata in the same order as records
+    """
+    def _head(record):
+        try:
+            head = client.head_object(Bucket=bucket_name,
+                                      Key=record['Key'])
+            return head['Metadata'] if ('Metadata' in head) else None
+        except Exception as e:
+            logger.info("head failed. {} {} {}"
+                        .format(bucket_name, record['Key'], e))
+            return None
+    return pool.map(_head, records)
+
+
 class DOSHandler(object):
 
     """Creates DOS object in store in response to matched events."""
 
     def __init__(self,
-                 args=None):
+                 args=None, checkpoint=None):
         super(DOSHandler, self).__init__()
+        self.args = args
         self.dry_run = args.dry_run
+        self.checkpoint = checkpoint
 
     def on_any_event(self, endpoint_url, region, bucket_name, record,
                      metadata):
         try:
             self.process(endpoint_url, region, bucket_name, record, metadata)
-            save_offset({'Key': record['Key']}, args.bucket_name)
+            self.checkpoint.advance({'Key': record['Key']})
         except Exception as e:
             logger.exception(e)
 
     def process(self, endpoint_url, region, bucket_name, record, metadata):
         data_object = to_dos(endpoint_url, region, bucket_name, record,
                              metadata)
-        store(args, data_object)
+        store(self.args, data_object)
 
 
-if __name__ == "__main__":
-
-    argparser = argparse.ArgumentParser(
-        description='Consume events from bucket, populate store')
-    argparser.add_argument('--endpoint_url', '-ep',
-                           help='''for swift, ceph, other non-aws endpoints''',
-                           default=None)
-    argparser.add_argument('bucket_name',
-                           help='''bucket_name to inventory''',
-                           )
-    common_args(argparser)
-    custom_args(argparser)
-
-    args = argparser.parse_args()
-
-    common_logging(args)
-    event_handler = DOSHandler(args)
-
-    offset = get_offset(args.bucket_name)
-    last_key = None
-    if offset:
-        last_key = offset.get('Key', None)
-    # support non aws hosts
+def s3_client(args):
+    """ create a client, support non aws hosts """
     if args.endpoint_url:
         use_ssl = True
         if args.endpoint_url.startswith('http://'):
             use_ssl = False
-        client = boto3.client(
+        return boto3.client(
             's3', endpoint_url=args.endpoint_url, use_ssl=use_ssl,
             config=Config(s3={'addressing_style': 'path'},
                           signature_version='s3')
         )
-    else:
-        client = boto3.client('s3')
+    return boto3.client('s3')
+
+
+def list_prefixes(args, delimiter):
+    """ top level prefixes of the bucket """
+    paginator = s3_client(args).get_paginator('list_objects_v2')
+    prefixes = []
+    for page in paginator.paginate(Bucket=args.bucket_name,
+                                   Delimiter=delimiter):
+        prefixes.extend([p['Prefix'] for p in page.get('CommonPrefixes', [])])
+    return prefixes
+
+
+def inventory(args, shard):
+    """ inventory the keys of one (prefix, delimiter) shard """
+    prefix, delimiter = shard
+    checkpoint = Checkpoint(shard_key(args.bucket_name, shard),
+                            every=args.checkpoint_every,
+                            interval=args.checkpoint_interval)
+    event_handler = DOSHandler(args, checkpoint)
+
+    offset = checkpoint.offset
+    last_key = None
+    if offset:
+        last_key = offset.get('Key', None)
+
+    client = s3_client(args)
+
+    # bounded pool for head_object, one page in flight at a time
+    pool = None
+    if not args.skip_metadata:
+        pool = ThreadPool(args.metadata_workers)
 
     paginator = client.get_paginator('list_objects_v2')
+    params = {'Bucket': args.bucket_name, 'Prefix': prefix}
+    if delimiter:
+        params['Delimiter'] = delimiter
     if last_key:
-    	page_iterator = paginator.paginate(Bucket=args.bucket_name, StartAfter=last_key)
-    else:
-    	page_iterator = paginator.paginate(Bucket=args.bucket_name)
+        params['StartAfter'] = last_key
+    page_iterator = paginator.paginate(**params)
     for page in page_iterator:
         region = None
         if 'x-amz-bucket-region' in page['ResponseMetadata']['HTTPHeaders']:
             region = \
                 page['ResponseMetadata']['HTTPHeaders']['x-amz-bucket-region']
         if 'Contents' not in page:
-            logger.error(page)
-            exit(1)
-        for record in page['Contents']:
-            # get the metadata associated with object
-            head = client.head_object(Bucket=args.bucket_name,
-                                     Key=record['Key'])
-            metadata = head['Metadata'] if ('Metadata' in head) else None
+            # nothing (left) to list
+            logger.info('no objects in {} {}'.format(args.bucket_name, shard))
+            continue
+        records = page['Contents']
+        # get the metadata associated with objects
+        if pool:
+            metadatas = fetch_metadata(client, args.bucket_name, records,
+                                       pool)
+        else:
+            metadatas = [None] * len(records)
+        # process in listing order, so offset tracks the page
+        for record, metadata in zip(records, metadatas):
             event_handler.on_any_event(args.endpoint_url, region,
                                        args.bucket_name, record, metadata)
+    if pool:
+        pool.close()
+    flush()
+    return checkpoint.close()
+
+
+if __name__ == "__main__":
+
+    argparser = argparse.ArgumentParser(
+        description='Consume events from bucket, populate store')
+    argparser.add_argument('--endpoint_url', '-ep',
+                           help='''for swift, ceph, other non-aws endpoints''',
+                           default=None)
+    argparser.add_argument('--metadata_workers', '-mw',
+                           help='''concurrent head_object calls used to
+                           fetch user metadata''',
+                           default=16,
+                           type=int)
+    argparser.add_argument('--skip_metadata', '-sm',
+                           help='''do not fetch user metadata,
+                           only list size and ETag''',
+                           default=False,
+                           action='store_true')
+    argparser.add_argument('bucket_name',
+                           help='''bucket_name to inventory''',
+                           )
+    common_args(argparser)
+    custom_args(argparser)
+    checkpoint_args(argparser)
+    shard_args(argparser)
+
+    args = argparser.parse_args()
+
+    common_logging(args)
+
+    run_shards(args, inventory,
+               shards(args, lambda delimiter: list_prefixes(args, delimiter)))
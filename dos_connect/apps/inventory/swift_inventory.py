@@ -7,8 +7,10 @@ import logging
 import argparse
 import urllib
 from urlparse import urlparse
-from .. import common_args, common_logging,  store, custom_args, md5sum
-from . import get_offset, save_offset
+from .. import common_args, common_logging,  store, custom_args, md5sum, \
+    flush
+from . import Checkpoint, checkpoint_args, shard_args, shards, shard_key, \
+    run_shards
 
 logger = logging.getLogger('s3_inventory')
 
@@ -66,39 +68,28 @@ class DOSHandler(object):
     """Creates DOS object in store in response to matched events."""
 
     def __init__(self,
-                 args=None):
+                 args=None, checkpoint=None):
         super(DOSHandler, self).__init__()
+        self.args = args
         self.dry_run = args.dry_run
+        self.checkpoint = checkpoint
 
     def on_any_event(self, endpoint_url, region, bucket_name, record,
                      metadata):
         try:
             self.process(endpoint_url, region, bucket_name, record, metadata)
-            save_offset({'name': record['name']})
+            self.checkpoint.advance({'name': record['name']})
         except Exception as e:
             logger.exception(e)
 
     def process(self, endpoint_url, region, bucket_name, record, metadata):
         data_object = to_dos(endpoint_url, region, bucket_name, record,
                              metadata)
-        store(args, data_object)
+        store(self.args, data_object)
 
 
-if __name__ == "__main__":
-    # setup ...
-    argparser = argparse.ArgumentParser(
-        description='Consume events from bucket, populate store')
-    argparser.add_argument('bucket_name',
-                           help='bucket_name to inventory',
-                           )
-    common_args(argparser)
-    custom_args(argparser)
-
-    args = argparser.parse_args()
-
-    common_logging(args)
-
-    # ensure user ran OS source command
+def swift_connection():
+    """ connect using the OS environment, ensure user ran OS source command """
     OS_REGION_NAME = os.environ.get('OS_REGION_NAME', None)
     OS_TENANT_ID = os.environ.get('OS_TENANT_ID', None)
     OS_PASSWORD = os.environ.get('OS_PASSWORD', None)
@@ -113,29 +104,50 @@ if __name__ == "__main__":
     assert OS_TENANT_NAME, 'missing envvar OS_TENANT_NAME'
 
     # get connection
-    swift = swiftclient.Connection(authurl=OS_AUTH_URL,
-                                   user=OS_USERNAME,
-                                   key=OS_PASSWORD,
-                                   tenant_name=OS_TENANT_NAME,
-                                   auth_version='2')
+    return swiftclient.Connection(authurl=OS_AUTH_URL,
+                                  user=OS_USERNAME,
+                                  key=OS_PASSWORD,
+                                  tenant_name=OS_TENANT_NAME,
+                                  auth_version='2')
+
+
+def list_prefixes(args, delimiter):
+    """ top level prefixes (pseudo directories) of the container """
+    (container, objects) = swift_connection().get_container(
+        args.bucket_name, delimiter=delimiter, full_listing=True)
+    return [obj['subdir'] for obj in objects if 'subdir' in obj]
+
+
+def inventory(args, shard):
+    """ inventory the objects of one (prefix, delimiter) shard """
+    prefix, delimiter = shard
+    swift = swift_connection()
 
     # do we have a saved offset?
-    offset = get_offset()
+    checkpoint = Checkpoint(shard_key(args.bucket_name, shard),
+                            every=args.checkpoint_every,
+                            interval=args.checkpoint_interval)
+    offset = checkpoint.offset
     last_name = None
     if offset:
         last_name = offset['name']
 
     (container, objects) = swift.get_container(args.bucket_name,
                                                marker=last_name,
+                                               prefix=prefix or None,
+                                               delimiter=delimiter,
                                                full_listing=True)
     # set token in args
     args.api_key = swift.token
 
     # our handler
-    event_handler = DOSHandler(args)
+    event_handler = DOSHandler(args, checkpoint)
 
     # iterate through objects
     for obj in objects:
+        # pseudo directory of a delimited listing
+        if 'subdir' in obj:
+            continue
         # need a separate call to get meta :-(
         headers = swift.head_object(container=args.bucket_name,
                                     obj=obj['name'])
@@ -145,3 +157,25 @@ if __name__ == "__main__":
                 metadata[k] = headers[k]
         event_handler.on_any_event(swift.url, None,
                                    args.bucket_name, obj, metadata)
+    flush()
+    return checkpoint.close()
+
+
+if __name__ == "__main__":
+    # setup ...
+    argparser = argparse.ArgumentParser(
+        description='Consume events from bucket, populate store')
+    argparser.add_argument('bucket_name',
+                           help='bucket_name to inventory',
+                           )
+    common_args(argparser)
+    custom_args(argparser)
+    checkpoint_args(argparser)
+    shard_args(argparser)
+
+    args = argparser.parse_args()
+
+    common_logging(args)
+
+    run_shards(args, inventory,
+               shards(args, lambda delimiter: list_prefixes(args, delimiter)))
@@ -2,7 +2,7 @@ from azure.storage.queue import QueueService, QueueMessageFormat
 from azure.storage.blob import BlockBlobService
 from azure.common import AzureException
 
-import json
+from dos_connect import json_codec
 import argparse
 import logging
 import urllib
@@ -12,7 +12,8 @@ import os
 from urlparse import urlparse
 import sys
 import datetime
-from .. import common_args, common_logging,  store, custom_args
+from .. import common_args, common_logging,  store, custom_args, flush, \
+    Acknowledgement
 
 
 BLOB_SERVICE = None
@@ -84,9 +85,9 @@ def to_dos(message_json, blob=None):
     return data_object
 
 
-def process(args, message):
+def process(args, message, acknowledgement):
 
-    message_json = json.loads(message.content)
+    message_json = json_codec.loads(message.content)
 
     record = message_json['data']
     # get storage account, container and blob_name
@@ -104,7 +105,7 @@ def process(args, message):
         blob = _blob_service().get_blob_properties(container, blob_name)
         data_object = to_dos(message_json, blob)
 
-    store(args, data_object)
+    store(args, data_object, sent=acknowledgement.expect())
     return True
 
 
@@ -117,22 +118,35 @@ def consume(args):
 
     queue_service.decode_function = QueueMessageFormat.binary_base64decode
 
+    def deleter(message):
+        def delete():
+            if not args.dry_run:
+                logger.debug('deleting message {}'.format(message.id))
+                queue_service.delete_message(args.azure_queue,
+                                             message.id, message.pop_receipt)
+        return delete
+
+    # with --batch_size a message is deleted after its batch was sent,
+    # keep it invisible until then, each retry backs off up to 60 seconds
+    visibility_timeout = int(args.wait_time)
+    if args.batch_size:
+        visibility_timeout += int(args.batch_interval +
+                                  60 * args.batch_retries)
+
     logger.debug('Listening for messages on {}'.format(args.azure_queue))
     while True:
-        messages = queue_service.get_messages(args.azure_queue,
-                                              num_messages=16,
-                                              visibility_timeout=args.wait_time
-                                              )
+        messages = queue_service.get_messages(
+                        args.azure_queue,
+                        num_messages=16,
+                        visibility_timeout=visibility_timeout)
         for message in messages:
+            acknowledgement = Acknowledgement(deleter(message))
             try:
-                process(args, message)
+                process(args, message, acknowledgement)
             except AzureException as e:
                 logger.exception(e)
-            if not args.dry_run:
-                logger.debug('deleting message {}'.format(message.id))
-                queue_service.delete_message(args.azure_queue,
-                                             message.id, message.pop_receipt)
-        time.sleep(args.wait_time)
+            acknowledgement.done()
+        time.sleep(float(args.wait_time))
 
 
 def populate_args(argparser):
@@ -158,4 +172,7 @@ if __name__ == '__main__':  # pragma: no cover
     logger = logging.getLogger(__name__)
 
     logger.debug(args)
-    consume(args)
+    try:
+        consume(args)
+    finally:
+        flush()
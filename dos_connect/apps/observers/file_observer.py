@@ -16,7 +16,7 @@ import argparse
 from stat import *
 import json
 import re
-from .. import common_args, common_logging,  store, custom_args, md5sum, before_store, user_metadata  # noqa
+from .. import common_args, common_logging,  store, custom_args, md5sum, before_store, user_metadata, flush  # noqa
 
 
 class DOSHandler(PatternMatchingEventHandler):
@@ -167,6 +167,7 @@ if __name__ == "__main__":
                     continue
                 event_handler.on_any_event(FileCreatedEvent(
                         os.path.join(root, name)))
+        flush()
     else:
         logger.debug("observing {}".format(path))
         observer = PollingObserver(args.polling_interval)
@@ -178,3 +179,4 @@ if __name__ == "__main__":
         except KeyboardInterrupt:
             observer.stop()
         observer.join()
+        flush()
@@ -1,7 +1,7 @@
 from google.cloud import pubsub
 from google.cloud import storage
 
-import json
+from dos_connect import json_codec
 import argparse
 import logging
 import urllib
@@ -9,7 +9,8 @@ import time
 from datetime import datetime
 import pprint
 import sys
-from .. import common_args, common_logging,  store, custom_args
+from .. import common_args, common_logging,  store, custom_args, flush, \
+    Acknowledgement
 
 
 # Instantiates a client
@@ -26,7 +27,7 @@ def _client():
 
 
 def to_dos(message):
-    record = json.loads(message.data)
+    record = json_codec.loads(message.data)
     if not record['kind'] == "storage#object":
         return None
     system_metadata = dict(message.attributes)
@@ -61,7 +62,7 @@ def to_dos(message):
     }
 
 
-def process(args, message):
+def process(args, message, acknowledgement):
     # https://cloud.google.com/storage/docs/reporting-changes
     # https://cloud.google.com/storage/docs/json_api/v1/objects
     # {u'resource':
@@ -102,7 +103,7 @@ def process(args, message):
         if bucketId not in buckets:
             buckets[bucketId] = _client().get_bucket(bucketId)
         data_object['urls'][0]['system_metadata']['location'] = buckets[bucketId].location
-        store(args, data_object)
+        store(args, data_object, sent=acknowledgement.expect())
         return True
 
 
@@ -121,9 +122,10 @@ def consume(args):
         try:
             # logger.debug(message.attributes)
             # logger.debug(message.data)
-            process(args, message)
-            if not args.dry_run:
-                message.ack()
+            acknowledgement = Acknowledgement(
+                message.ack if not args.dry_run else lambda: None)
+            process(args, message, acknowledgement)
+            acknowledgement.done()
         except Exception as e:
             logger.exception(e)
 
@@ -162,4 +164,7 @@ if __name__ == '__main__':  # pragma: no cover
     common_logging(args)
     logger = logging.getLogger(__name__)
 
-    consume(args)
+    try:
+        consume(args)
+    finally:
+        flush()
@@ -1,10 +1,11 @@
-import json
+from dos_connect import json_codec
 import boto3
 import argparse
 import logging
 import urllib
 import sys
-from .. import common_args, common_logging,  store, custom_args, md5sum
+from .. import common_args, common_logging,  store, custom_args, md5sum, \
+    flush, Acknowledgement
 from datetime import datetime
 
 # Boto3 will check these environment variables for credentials:
@@ -59,16 +60,17 @@ def to_dos(record):
     return data_object
 
 
-def process(args, message):
+def process(args, message, acknowledgement):
     """
     http://docs.aws.amazon.com/AmazonS3/latest/dev/notification-content-structure.html
+    the message is deleted once every record reached the server
     """
     # we need a call to s3 to fetch metadata not in queue message
     client = boto3.client('s3')
 
     logger.debug(message.body)
     sqs_json = message.body
-    sqs = json.loads(sqs_json)
+    sqs = json_codec.loads(sqs_json)
 
     if 'Records' not in sqs:
         return True
@@ -90,7 +92,7 @@ def process(args, message):
                 logger.info("head failed. {} {} {}"
                             .format(bucket_name, key, e))
 
-        store(args, data_object)
+        store(args, data_object, sent=acknowledgement.expect())
     return True
 
 
@@ -109,8 +111,9 @@ def consume(args):
             for message in queue.receive_messages(WaitTimeSeconds=20):
                 # Get the custom author message attribute if it was set
                 # Print out the body and author (if set)
-                if process(args, message):
-                    message.delete()
+                acknowledgement = Acknowledgement(message.delete)
+                if process(args, message, acknowledgement):
+                    acknowledgement.done()
         except Exception as e:
             logger.exception(e)
 
@@ -131,4 +134,7 @@ if __name__ == '__main__':  # pragma: no cover
     args = argparser.parse_args()
     common_logging(args)
     logger = logging.getLogger(__name__)
-    consume(args)
+    try:
+        consume(args)
+    finally:
+        flush()
@@ -0,0 +1,71 @@
+"""
+http_session
+==========
+Shared, pooled requests sessions so repeated calls to the same host reuse
+keep-alive connections instead of paying a TCP/TLS handshake each time.
+Used by the client apps and the server side plugins.
+
+Defaults can be set in the environment:
+  DOS_HTTP_POOL_SIZE  connections kept alive per host (10)
+  DOS_HTTP_RETRIES    retries of connection errors and idempotent calls (3)
+  DOS_HTTP_BACKOFF    backoff factor in seconds between retries (0.5)
+  DOS_HTTP_TIMEOUT    seconds to wait for a response (30)
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+POOL_SIZE = int(os.getenv('DOS_HTTP_POOL_SIZE', '10'))
+RETRIES = int(os.getenv('DOS_HTTP_RETRIES', '3'))
+BACKOFF = float(os.getenv('DOS_HTTP_BACKOFF', '0.5'))
+TIMEOUT = float(os.getenv('DOS_HTTP_TIMEOUT', '30'))
+
+_SESSIONS = {}
+_LOCK = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+
+    """ a session that applies a default timeout to every request """
+
+    def __init__(self, timeout=TIMEOUT):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+    def send(self, request, **kwargs):
+        # callers such as bravado pass timeout=None explicitly
+        if kwargs.get('timeout', None) is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutSession, self).send(request, **kwargs)
+
+
+def create_session(pool_size=None, retries=None, backoff=None,
+                   timeout=None):
+    """ a new keep-alive session with connection pool, retries, timeout """
+    pool_size = pool_size or POOL_SIZE
+    retries = RETRIES if retries is None else retries
+    backoff = BACKOFF if backoff is None else backoff
+    s = TimeoutSession(timeout=timeout or TIMEOUT)
+    # POST is not retried on read errors or status, only if never sent
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
+
+
+def session(name='default', **kwargs):
+    """
+    return the shared session for name, created on first use.
+    kwargs are passed to create_session the first time only.
+    """
+    with _LOCK:
+        if name not in _SESSIONS:
+            _SESSIONS[name] = create_session(**kwargs)
+        return _SESSIONS[name]
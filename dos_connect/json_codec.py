@@ -0,0 +1,131 @@
+"""
+json_codec
+==========
+One json codec for the client apps, the server and its plugins.
+Uses the fastest library installed, falling back to the standard library.
+datetime, date and arrow values are encoded as ISO-8601 strings, uuids as
+strings. An encoder is only used if it can do that, ujson before 2.0 for
+example writes datetimes as epoch seconds and so only decodes.
+simplejson decodes faster than the standard library but encodes slower,
+so it is preferred for one and not the other.
+
+The libraries can be chosen in the environment, comma separated,
+in order of preference:
+  DOS_JSON_DECODERS  (ujson,simplejson,json)
+  DOS_JSON_ENCODERS  (ujson,json,simplejson)
+
+    python -m dos_connect.json_codec   # compare the installed codecs
+"""
+import datetime
+import decimal
+import os
+import timeit
+import uuid
+from importlib import import_module
+
+DECODERS = os.getenv('DOS_JSON_DECODERS', 'ujson,simplejson,json').split(',')
+ENCODERS = os.getenv('DOS_JSON_ENCODERS', 'ujson,json,simplejson').split(',')
+
+
+def _default(value):
+    """ encode values json has no type for """
+    # arrow.Arrow has isoformat too
+    if isinstance(value, (datetime.datetime, datetime.date,
+                          datetime.time)) or \
+            value.__class__.__name__ == 'Arrow':
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+_PROBE = [datetime.datetime(1970, 1, 1)]
+
+
+def _codecs(names):
+    """ yield (name, module) of the installed libraries, in order """
+    for name in names:
+        name = name.strip()
+        try:
+            yield name, import_module(name)
+        except ImportError:
+            continue
+
+
+def _encoder(module):
+    """ dumps of module, or None if it can not encode with _default """
+    def dumps(value, **kwargs):
+        return module.dumps(value, default=_default, **kwargs)
+    try:
+        if module.loads(dumps(_PROBE)) == ['1970-01-01T00:00:00']:
+            return dumps
+    except Exception:
+        pass
+    return None
+
+
+def _select():
+    """ (name, loads), (name, dumps) of the preferred libraries """
+    decoder = encoder = None
+    for name, module in _codecs(DECODERS):
+        decoder = (name, module.loads)
+        break
+    for name, module in _codecs(ENCODERS):
+        dumps = _encoder(module)
+        if dumps:
+            encoder = (name, dumps)
+            break
+    if not decoder or not encoder:
+        import json
+        decoder = decoder or ('json', json.loads)
+        encoder = encoder or ('json', _encoder(json))
+    return decoder, encoder
+
+
+(DECODER, _loads), (ENCODER, _dumps) = _select()
+
+
+def loads(s):
+    """ json text -> value """
+    return _loads(s)
+
+
+def dumps(value):
+    """ value -> json text, see _default for the types added to json's """
+    return _dumps(value)
+
+
+def benchmark(number=2000):
+    """ seconds to encode and decode a data object with each library """
+    doc = {
+        'id': str(uuid.uuid4()), 'name': 'file.bam', 'size': '12345',
+        'created': '2018-01-01T00:00:00Z', 'updated': '2018-01-01T00:00:00Z',
+        'version': '2018-01-01T00:00:00Z', 'current': True,
+        'aliases': ['alias'],
+        'checksums': [{'checksum': 'd41d8cd98f00b204e9800998ecf8427e',
+                       'type': 'md5'}],
+        'urls': [{'url': 's3://bucket/file.bam',
+                  'system_metadata': {'event_type': 'ObjectCreated:Put',
+                                      'bucket_name': 'bucket'},
+                  'user_metadata': {'project': 'project'}}],
+    }
+    results = []
+    for name, module in _codecs(['ujson', 'simplejson', 'json']):
+        encoder = _encoder(module)
+        text = (encoder or module.dumps)(doc)
+        results.append((
+            name,
+            timeit.timeit(lambda: encoder(doc), number=number)
+            if encoder else None,
+            timeit.timeit(lambda: module.loads(text), number=number)))
+    return results
+
+
+if __name__ == '__main__':
+    print('decoder {}, encoder {}'.format(DECODER, ENCODER))
+    for name, encode, decode in benchmark(20000):
+        print('{:12} dumps {:>8} loads {:8.3f}s'.format(
+            name, '{:.3f}s'.format(encode) if encode else 'unusable',
+            decode))
@@ -6,23 +6,35 @@ import connexion
 from flask_cors import CORS
 
 import argparse
+import glob
+import os
 import sys
+import tempfile
 from OpenSSL import SSL
 
-from prometheus_client import generate_latest, Gauge
-
 from flask import redirect
 
 import ga4gh.dos
-# These are imported by name by connexion so we assert it here.
-from controllers import *  # noqa
-# the swagger doc points to 'ga4gh.dos.server' module
-# so, override it here.
-sys.modules['ga4gh.dos.server'] = sys.modules[__name__]
+
+# backends holding their documents in the process, each worker
+# would have its own store and rewrite the same files
+SINGLE_PROCESS_BACKENDS = ['memory_backend', 'log_backend']
 
 
 def configure_app():
-    """ associate swagger with app, setup CORS"""
+    """ associate swagger with app, setup CORS and metrics """
+    # imported here, not at module level, so each worker of a
+    # multi-worker server loads its own backend, replicator and metrics
+    import controllers
+    import document_cache
+    from instrumentation import CachedMetrics, gauge
+    from prometheus_client import generate_latest, CollectorRegistry
+    from prometheus_client import multiprocess
+    # These are imported by name by connexion so we assert it here.
+    # the swagger doc points to 'ga4gh.dos.server' module
+    # so, override it here.
+    sys.modules['ga4gh.dos.server'] = controllers
+
     app = connexion.App(
         __name__,
         swagger_ui=True,
@@ -30,19 +42,16 @@ def configure_app():
     # TODO get from schemas ga4gh.dos...? #24
     app.add_api('data_object_service.swagger.yaml')
     CORS(app.app)
-    return app
-
-
-def main(args):
-    """ configure """
-    app = configure_app()
 
     # create gauges for Prometheus
-    # Responds with total counts
+    # Responds with total counts, refreshed in the background
+    document_counts = CachedMetrics(controllers.metrics)
     gauges = {}
-    for metric in metrics():
-        g = Gauge('dos_connect_{}_count'.format(metric.name),
-                  'Number of {}'.format(metric.name))
+    for metric in document_counts():
+        # every worker reports the same counts, export one
+        g = gauge('dos_connect_{}_count'.format(metric.name),
+                  'Number of {}'.format(metric.name),
+                  multiprocess_mode='max')
         g.set(metric.count)
         gauges[metric.name] = g
 
@@ -50,15 +59,79 @@ def main(args):
     # Prometheus server ping response
     @app.route('/metrics')
     def metrics_endpoint():
-        for metric in metrics():
+        for metric in document_counts():
             g = gauges[metric.name]
             g.set(metric.count)
+        if 'prometheus_multiproc_dir' in os.environ:
+            # sum the values written by all workers
+            registry = CollectorRegistry()
+            collector = multiprocess.MultiProcessCollector(registry)
+            registry.register(document_cache.HitRatio(collector))
+            return generate_latest(registry)
         return generate_latest()
 
     @app.route("/")
     def to_ui():
         return redirect("/ga4gh/dos/v1/ui", code=302)
 
+    return app
+
+
+def serve(args):
+    """ run the app in a gunicorn pre-fork server """
+    from gunicorn.app.base import BaseApplication
+
+    backend_name = os.getenv('BACKEND', 'dos_connect.server.memory_backend')
+    assert (args.workers or 1) == 1 or \
+        backend_name.split('.')[-1] not in SINGLE_PROCESS_BACKENDS, \
+        '{} is not shared between workers, use --threads rather than ' \
+        '--workers, or the sqlite or elastic backend'.format(backend_name)
+
+    # prometheus_client picks multi-process mode when it is first
+    # imported, so this is set before any worker loads the app
+    if 'prometheus_multiproc_dir' not in os.environ:
+        os.environ['prometheus_multiproc_dir'] = \
+            tempfile.mkdtemp(prefix='dos_connect_metrics_')
+    for stale in glob.glob(
+            os.path.join(os.environ['prometheus_multiproc_dir'], '*.db')):
+        os.remove(stale)
+    # per process state such as the get cache depends on it
+    os.environ['DOS_WORKERS'] = str(args.workers or 1)
+
+    def child_exit(server, worker):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+    options = {
+        'bind': '{}:{}'.format(args.host, args.port),
+        'workers': args.workers or 1,
+        'threads': args.threads or 1,
+        'graceful_timeout': args.graceful_timeout,
+        'child_exit': child_exit,
+    }
+    if args.key_file:
+        options['keyfile'] = args.key_file
+        options['certfile'] = args.certificate_file
+
+    class Application(BaseApplication):
+        # no preload, workers import the app after the fork,
+        # SIGHUP reloads them one by one
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return configure_app().app
+
+    Application().run()
+
+
+def main(args):
+    """ configure """
+    if args.workers or args.threads:
+        return serve(args)
+
+    app = configure_app()
     if args.key_file:
         context = (args.certificate_file, args.key_file)
         app.run(port=args.port, ssl_context=context)
@@ -71,4 +144,9 @@ if __name__ == '__main__':
     argparser.add_argument('-P', '--port', default=8080, type=int)
     argparser.add_argument('-K', '--key_file', default=None)
     argparser.add_argument('-C', '--certificate_file', default=None)
+    # either one runs gunicorn instead of the flask development server
+    argparser.add_argument('-W', '--workers', default=None, type=int)
+    argparser.add_argument('-T', '--threads', default=None, type=int)
+    argparser.add_argument('--host', default='0.0.0.0')
+    argparser.add_argument('--graceful_timeout', default=30, type=int)
     main(argparser.parse_args())
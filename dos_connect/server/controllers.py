@@ -1,37 +1,65 @@
 
+import base64
+import flask
+import hashlib
 import logging
 import sys
-import json
 import os
+import zlib
 from dateutil.parser import parse
+from dos_connect import json_codec
 from importlib import import_module
 
 # customize for your needs
 from log_setup import init_logging
-from utils import AttributeDict, now, add_created_timestamps, \
-                  add_updated_timestamps
+from utils import AttributeDict, add_created_timestamps, \
+                  add_updated_timestamps, next_version
+from instrumentation import timed, timed_authorization, timed_call, \
+                            timed_generator, streamed
+import document_cache
 
 # from authorizer import authorization_check
 authorizer_name = os.getenv('AUTHORIZER', 'dos_connect.server.noop_authorizer')
 authorizer = import_module(authorizer_name)
-authorization_check = getattr(authorizer, 'authorization_check')
+authorization_check = timed_authorization(
+    getattr(authorizer, 'authorization_check'))
 
 # from backend import save, update, delete, search
 backend_name = os.getenv('BACKEND', 'dos_connect.server.memory_backend')
 backend = import_module(backend_name)
-save = getattr(backend, 'save')
-update = getattr(backend, 'update')
-delete = getattr(backend, 'delete')
-search = getattr(backend, 'search')
+save = timed_call('backend_save', getattr(backend, 'save'))
+update = timed_call('backend_update', getattr(backend, 'update'))
+delete = timed_call('backend_delete', getattr(backend, 'delete'))
+search = timed_generator('backend_search', getattr(backend, 'search'))
 metrics = getattr(backend, 'metrics')
+save_many = getattr(backend, 'save_many', None)
+if save_many:
+    save_many = timed_call('backend_save_many', save_many)
+new_version = getattr(backend, 'new_version', None)
+if new_version:
+    new_version = timed_call('backend_new_version', new_version)
+current_version = getattr(backend, 'current_version', None)
+if current_version:
+    current_version = timed_call('backend_current_version', current_version)
+scan = getattr(backend, 'scan', None)
+if scan:
+    scan = timed_generator('backend_scan', scan)
+resolve = getattr(backend, 'resolve', None)
+if resolve:
+    resolve = timed_call('backend_resolve', resolve)
+# fields of a page cursor, None if the backend does not say
+search_sort = getattr(backend, 'SEARCH_SORT', None)
 
 # from replicator import replicate
 replicator_name = os.getenv('REPLICATOR', 'dos_connect.server.noop_replicator')
 replicator = import_module(replicator_name)
-replicate = getattr(replicator, 'replicate')
+replicate = timed_call('replicate', getattr(replicator, 'replicate'))
 
 
 DEFAULT_PAGE_SIZE = 100
+MAX_BULK_SIZE = int(os.getenv('MAX_BULK_SIZE', '10000'))
+# hits per backend call when exporting from a backend without scan()
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '1000'))
 
 init_logging()
 log = logging.getLogger(__name__)
@@ -41,8 +69,185 @@ log.info('using backend {} to change set BACKEND envvar'
          .format(backend_name))
 
 
+def _save_many(docs, index):
+    """
+    use the backend's save_many if it has one, otherwise save one by one
+    return list of (doc, error) in order, error is None on success
+    """
+    if save_many:
+        return save_many(docs, index)
+    results = []
+    for doc in docs:
+        try:
+            results.append((save(doc, index), None))
+        except Exception as e:
+            log.exception(e)
+            results.append((doc, str(e)))
+    return results
+
+
+def _page_token(body):
+    """
+    return (offset, after) for the page_token in body.
+    tokens are opaque cursors holding the last hit's sort values,
+    numeric tokens are offsets issued by earlier releases,
+    raise ValueError or TypeError for anything else
+    """
+    token = body.get('page_token', None) or body.get('next_page_token', None)
+    if not token:
+        return 0, None
+    if str(token).isdigit():
+        return int(token), None
+    after = json_codec.loads(base64.urlsafe_b64decode(str(token)))
+    # a value for each sort field, as in the hit's meta.sort
+    if not isinstance(after, list) or \
+            (search_sort and len(after) != len(search_sort)) or \
+            not all(isinstance(value, (basestring, int, long, float)) and
+                    not isinstance(value, bool) for value in after):
+        raise ValueError('page_token is not a cursor')
+    return 0, after
+
+
+def _page(properties, index, body, offset, after):
+    """ return (docs, next_page_token) for the requested page """
+    page_size = int(body.get('page_size', DEFAULT_PAGE_SIZE))
+    # one extra hit tells us if there is a next page
+    hits = list(search(properties, index, size=page_size + 1,
+                       offset=offset, after=after))
+    next_page_token = None
+    if len(hits) > page_size:
+        hits = hits[:page_size]
+        next_page_token = base64.urlsafe_b64encode(
+            json_codec.dumps(list(hits[-1].meta.sort)))
+    return [x.to_dict() for x in hits], next_page_token
+
+
+def _new_version(id, doc, index):
+    """
+    store doc as the new current version of id, use the backend's
+    new_version if it has one, otherwise search, update and save
+    """
+    if new_version:
+        return new_version(id, doc, index)
+    old_doc = search(AttributeDict({'id': id}), index).next()
+    next_version(old_doc, doc)
+    # update old unset current
+    update(_id=old_doc.meta.id, index=index, doc={'current': False})
+    # new is current
+    return save(doc, index)
+
+
+def _etag(id, version):
+    """ strong entity tag of a document version """
+    return hashlib.sha1(u'{}\n{}'.format(id, version)
+                        .encode('utf-8')).hexdigest()
+
+
+def _not_modified(index, id, version):
+    """
+    if If-None-Match names the current version return the etag,
+    the current version comes from the cache or the backend's
+    current_version, without loading the document.
+    a requested version may have been deleted, so it is looked up
+    like any get and _get_response compares the etag
+    """
+    if not flask.request.if_none_match or version:
+        return None
+    cached = document_cache.get(index, id)
+    if cached:
+        version = cached.get('version', None)
+    elif current_version:
+        version = current_version(id, index)
+    if not version:
+        return None
+    etag = _etag(id, version)
+    if flask.request.if_none_match.contains(etag):
+        return etag
+    return None
+
+
+def _get_response(key, doc):
+    """ 200 with the document and its etag, 304 if the client has it """
+    etag = _etag(doc['id'], doc.get('version', None))
+    if flask.request.if_none_match.contains(etag):
+        return ('', 304, {'ETag': '"{}"'.format(etag)})
+    return ({key: doc}, 200, {'ETag': '"{}"'.format(etag)})
+
+
+def _scan(properties, index):
+    """
+    yield every matching document, use the backend's scan if it has one,
+    otherwise page through search with a cursor
+    """
+    if scan:
+        for hit in scan(properties, index):
+            yield hit
+        return
+    after = None
+    while True:
+        hits = list(search(properties, index, size=EXPORT_CHUNK_SIZE,
+                           after=after))
+        for hit in hits:
+            yield hit
+        if len(hits) < EXPORT_CHUNK_SIZE:
+            return
+        after = list(hits[-1].meta.sort)
+
+
+def _resolve(keys, index):
+    """
+    current documents of each key, use the backend's resolve if it
+    has one, otherwise search key by key
+    return {name: {value: [doc, ...]}}
+    """
+    if resolve:
+        return resolve(keys, index)
+    resolved = {}
+    for name, values in keys.items():
+        resolved[name] = {}
+        for value in values:
+            properties = AttributeDict({name: value, 'current': True})
+            if name == 'checksum':
+                properties.checksum = {'checksum': value}
+            resolved[name][value] = list(_scan(properties, index))
+    return resolved
+
+
+def _export(index, all_versions):
+    """
+    stream the index as newline delimited json,
+    gzip compressed if the client accepts it
+    """
+    properties = AttributeDict({})
+    if not all_versions:
+        properties.current = True
+
+    def lines():
+        for hit in _scan(properties, index):
+            yield json_codec.dumps(hit.to_dict()) + '\n'
+
+    def gzipped(chunks):
+        # wbits 16 + MAX_WBITS writes a gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    headers = {}
+    body = lines()
+    if 'gzip' in flask.request.accept_encodings:
+        headers['Content-Encoding'] = 'gzip'
+        body = gzipped(body)
+    # the body is read after this returns, keep timing it as the export
+    return flask.Response(streamed(body), mimetype='application/x-ndjson',
+                          headers=headers)
+
+
 # Data Object Controllers
 
+@timed
 @authorization_check
 def CreateDataObject(**kwargs):
     """
@@ -56,10 +261,39 @@ def CreateDataObject(**kwargs):
     except Exception as e:
         log.exception(e)
         return({'msg': e.message, 'status_code': 400}, 400)
+    document_cache.invalidate('data_objects', doc.id)
     replicate(doc, 'CREATE')
     return({"data_object_id": doc.id}, 200)
 
 
+@timed
+@authorization_check
+def CreateDataObjects(**kwargs):
+    """
+    update timestamps, ensure version, persist many
+    """
+    data_objects = kwargs['body'].get('data_objects', None) or []
+    if len(data_objects) > MAX_BULK_SIZE:
+        return({'msg': 'too many data_objects, max {}'.format(MAX_BULK_SIZE),
+                'status_code': 400}, 400)
+    docs = []
+    for data_object in data_objects:
+        doc = add_created_timestamps(AttributeDict(data_object))
+        doc.current = True
+        docs.append(doc)
+    results = []
+    for doc, error in _save_many(docs, 'data_objects'):
+        if error:
+            results.append({'data_object_id': doc.get('id', None),
+                            'msg': error, 'status_code': 400})
+            continue
+        document_cache.invalidate('data_objects', doc.id)
+        replicate(doc, 'CREATE')
+        results.append({'data_object_id': doc.id, 'status_code': 200})
+    return({"results": results}, 200)
+
+
+@timed
 @authorization_check
 def GetDataObject(**kwargs):
     """
@@ -69,17 +303,30 @@ def GetDataObject(**kwargs):
     version = kwargs.get('version', None)
     if version:
         properties['version'] = version
+    else:
+        properties.current = True  # only the current index is read
+    etag = _not_modified('data_objects', properties.id, version)
+    if etag:
+        return ('', 304, {'ETag': '"{}"'.format(etag)})
+    cached = document_cache.get('data_objects', properties.id, version)
+    if cached:
+        return _get_response('data_object', cached)
+    generation = document_cache.generation('data_objects', properties.id)
     # Get the Data Object from our dictionary
     try:
         data_object = search(properties, size=1).next()
         if data_object:
-            return({"data_object": data_object.to_dict()}, 200)
+            data_object = data_object.to_dict()
+            document_cache.set('data_objects', properties.id, data_object,
+                               generation, version)
+            return _get_response('data_object', data_object)
     except Exception as e:
         log.exception(e)
     return({'msg': "The requested Data "
                    "Object wasn't found", 'status_code': 404}, 404)
 
 
+@timed
 @authorization_check
 def GetDataObjectVersions(**kwargs):
     """
@@ -97,6 +344,7 @@ def GetDataObjectVersions(**kwargs):
                    "Object wasn't found", 'status_code': 404}, 404)
 
 
+@timed
 @authorization_check
 def UpdateDataObject(**kwargs):
     """
@@ -105,23 +353,10 @@ def UpdateDataObject(**kwargs):
     properties = AttributeDict({'id': kwargs['data_object_id']})
     body = AttributeDict(kwargs['body']['data_object'])
     try:
-        old_data_object = search(properties).next()
         data_object = add_updated_timestamps(body)
-        data_object.created = old_data_object.created
-        # We need to safely set the version if they provided one that
-        # collides we'll pad it. If they provided a good one, we will
-        # accept it. If they don't provide one, we'll give one.
-        new_version = data_object.get('version', None)
-        if new_version and new_version != old_data_object.version:
-            data_object.version = new_version
-        else:
-            data_object.version = now()
-        data_object.id = old_data_object.id
-        # update old unset current
-        update(_id=old_data_object.meta.id, doc={'current': False})
-        # new is current
-        data_object.current = True
-        save(data_object, 'data_objects')
+        data_object = _new_version(properties.id, data_object,
+                                   'data_objects')
+        document_cache.invalidate('data_objects', data_object.id)
         replicate(data_object, 'UPDATE')
         return({"data_object_id": properties.id}, 200)
     except Exception as e:
@@ -130,6 +365,7 @@ def UpdateDataObject(**kwargs):
                    "Object wasn't found", 'status_code': 404}, 404)
 
 
+@timed
 @authorization_check
 def DeleteDataObject(**kwargs):
     """
@@ -137,10 +373,12 @@ def DeleteDataObject(**kwargs):
     """
     properties = AttributeDict({'id': kwargs['data_object_id']})
     delete(properties)
+    document_cache.invalidate('data_objects', properties.id)
     replicate(properties, 'DELETE')
     return({"data_object_id": properties.id}, 200)
 
 
+@timed
 @authorization_check
 def ListDataObjects(**kwargs):
     """
@@ -153,18 +391,57 @@ def ListDataObjects(**kwargs):
         if body.get(property_name, None):
             properties[property_name] = body.get(property_name, None)
     properties.current = True  # only current, no previous
-    page_size = int(body.get('page_size', DEFAULT_PAGE_SIZE))
-    offset = int(body.get('next_page_token', 0))
-    total = 0
-    data_objects = [x.to_dict() for x, total in search(properties, offset=offset, size=page_size, include_total=True)]  # noqa
+    try:
+        offset, after = _page_token(body)
+    except (TypeError, ValueError):
+        return({'msg': 'invalid page_token', 'status_code': 400}, 400)
+    data_objects, next_page_token = _page(properties, 'data_objects', body,
+                                          offset, after)
     response = {"data_objects": data_objects}
-    if (offset + page_size) < total:
-        response['next_page_token'] = str(offset + page_size)
+    if next_page_token:
+        response['next_page_token'] = next_page_token
+    return(response, 200)
+
+
+@timed
+@authorization_check
+def ExportDataObjects(**kwargs):
+    """
+    stream all, current only unless all_versions
+    """
+    return _export('data_objects', kwargs.get('all_versions', False))
+
+
+@timed
+@authorization_check
+def ResolveDataObjects(**kwargs):
+    """
+    current data objects of many ids, checksums, aliases and urls
+    """
+    body = kwargs.get('body')
+    # request field -> property name used by the backends
+    property_names = {'ids': 'id', 'checksums': 'checksum',
+                      'aliases': 'alias', 'urls': 'url'}
+    keys = {}
+    for field, property_name in property_names.items():
+        if body.get(field, None):
+            keys[property_name] = body[field]
+    if sum([len(values) for values in keys.values()]) > MAX_BULK_SIZE:
+        return({'msg': 'too many keys, max {}'.format(MAX_BULK_SIZE),
+                'status_code': 400}, 400)
+    resolved = _resolve(keys, 'data_objects')
+    response = {}
+    for field, property_name in property_names.items():
+        if property_name in keys:
+            response[field] = dict(
+                (value, [x.to_dict() for x in docs])
+                for value, docs in resolved[property_name].items())
     return(response, 200)
 
 
 # Data Bundle Controllers
 
+@timed
 @authorization_check
 def CreateDataBundle(**kwargs):
     """
@@ -178,10 +455,12 @@ def CreateDataBundle(**kwargs):
     except Exception as e:
         log.exception(e)
         return({"data_object_id": doc.id}, 409)
+    document_cache.invalidate('data_bundles', doc.id)
     replicate(doc, 'CREATE')
     return({"data_bundle_id": doc.id}, 200)
 
 
+@timed
 @authorization_check
 def GetDataBundle(**kwargs):
     """
@@ -191,17 +470,30 @@ def GetDataBundle(**kwargs):
     version = kwargs.get('version', None)
     if version:
         properties['version'] = version
+    else:
+        properties.current = True  # only the current index is read
+    etag = _not_modified('data_bundles', properties.id, version)
+    if etag:
+        return ('', 304, {'ETag': '"{}"'.format(etag)})
+    cached = document_cache.get('data_bundles', properties.id, version)
+    if cached:
+        return _get_response('data_bundle', cached)
+    generation = document_cache.generation('data_bundles', properties.id)
     # Get the Data Object from our dictionary
     try:
         data_bundle = search(properties, 'data_bundles').next()
         if data_bundle:
-            return({"data_bundle": data_bundle.to_dict()}, 200)
+            data_bundle = data_bundle.to_dict()
+            document_cache.set('data_bundles', properties.id, data_bundle,
+                               generation, version)
+            return _get_response('data_bundle', data_bundle)
     except Exception as e:
         log.exception(e)
     return({'msg': "The requested Data "
                    "Object wasn't found", 'status_code': 404}, 404)
 
 
+@timed
 @authorization_check
 def UpdateDataBundle(**kwargs):
     """
@@ -210,21 +502,10 @@ def UpdateDataBundle(**kwargs):
     properties = AttributeDict({'id': kwargs['data_bundle_id']})
     body = AttributeDict(kwargs['body']['data_bundle'])
     try:
-        old_data_bundle = search(properties, 'data_bundles').next()
         data_bundle = add_updated_timestamps(body)
-        data_bundle.created = old_data_bundle.created
-        new_version = data_bundle.get('version', None)
-        if new_version and new_version != old_data_bundle.version:
-            data_bundle.version = new_version
-        else:
-            data_bundle.version = now()
-        # update old unset current
-        update(_id=old_data_bundle.meta.id, index='data_bundles',
-               doc={'current': False})
-        # new is current
-        data_bundle.current = True
-        data_bundle.id = old_data_bundle.id
-        save(data_bundle, 'data_bundles')
+        data_bundle = _new_version(properties.id, data_bundle,
+                                   'data_bundles')
+        document_cache.invalidate('data_bundles', data_bundle.id)
         replicate(data_bundle, 'UPDATE')
         return({"data_bundle_id": properties.id}, 200)
     except Exception as e:
@@ -233,6 +514,7 @@ def UpdateDataBundle(**kwargs):
                    "Object wasn't found", 'status_code': 404}, 404)
 
 
+@timed
 @authorization_check
 def GetDataBundleVersions(**kwargs):
     """
@@ -250,6 +532,7 @@ def GetDataBundleVersions(**kwargs):
                    "Object wasn't found", 'status_code': 404}, 404)
 
 
+@timed
 @authorization_check
 def DeleteDataBundle(**kwargs):
     """
@@ -257,10 +540,12 @@ def DeleteDataBundle(**kwargs):
     """
     properties = AttributeDict({'id': kwargs['data_bundle_id']})
     delete(properties, 'data_bundles')
+    document_cache.invalidate('data_bundles', properties.id)
     replicate(properties, 'DELETE')
     return(kwargs, 200)
 
 
+@timed
 @authorization_check
 def ListDataBundles(**kwargs):
     """
@@ -272,7 +557,22 @@ def ListDataBundles(**kwargs):
     for property_name in property_names:
         if body.get(property_name, None):
             properties[property_name] = body.get(property_name, None)
-    page_size = int(body.get('page_size', DEFAULT_PAGE_SIZE))
-    data_objects = [x.to_dict() for x in search(properties, 'data_bundles',
-                                                size=page_size)]
-    return({"data_bundles": data_objects}, 200)
+    try:
+        offset, after = _page_token(body)
+    except (TypeError, ValueError):
+        return({'msg': 'invalid page_token', 'status_code': 400}, 400)
+    data_bundles, next_page_token = _page(properties, 'data_bundles', body,
+                                          offset, after)
+    response = {"data_bundles": data_bundles}
+    if next_page_token:
+        response['next_page_token'] = next_page_token
+    return(response, 200)
+
+
+@timed
+@authorization_check
+def ExportDataBundles(**kwargs):
+    """
+    stream all, current only unless all_versions
+    """
+    return _export('data_bundles', kwargs.get('all_versions', False))
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# read-through cache for GetDataObject and GetDataBundle
+
+import collections
+import itertools
+import logging
+import os
+import threading
+import uuid
+
+from prometheus_client import Counter, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from utils import TTLCache
+from dos_connect import json_codec
+
+log = logging.getLogger(__name__)
+
+# server processes, set by app.py --workers
+WORKERS = int(os.getenv('DOS_WORKERS', '1'))
+# with several workers, invalidate from the replication topic
+GET_CACHE_KAFKA_INVALIDATION = os.getenv('GET_CACHE_KAFKA_INVALIDATION',
+                                         'False')
+GET_CACHE_KAFKA_INVALIDATION = not (GET_CACHE_KAFKA_INVALIDATION == 'False')
+# ids cached, 0 disables the cache. each worker has its own cache and
+# only sees its own writes, so it is off with several workers unless
+# they also invalidate from kafka
+GET_CACHE_SIZE = int(os.getenv(
+    'GET_CACHE_SIZE',
+    '10000' if WORKERS == 1 or GET_CACHE_KAFKA_INVALIDATION else '0'))
+# seconds an entry is served, bounds staleness if an invalidation is missed
+GET_CACHE_TTL = float(os.getenv('GET_CACHE_TTL', '60'))
+
+assert not GET_CACHE_SIZE or WORKERS == 1 or GET_CACHE_KAFKA_INVALIDATION, \
+    'GET_CACHE_SIZE with several workers needs ' \
+    'GET_CACHE_KAFKA_INVALIDATION=True, other workers would serve ' \
+    'updated and deleted objects'
+
+INDEXES = ['data_objects', 'data_bundles']
+
+# (index, id) -> {version: doc}, version None is the current one,
+# so every version of an id is dropped together
+_cache = TTLCache(maxsize=GET_CACHE_SIZE, ttl=GET_CACHE_TTL)
+# (index, id) -> generation of its last invalidation, most recent last.
+# a get reads the generation before the backend and only caches what
+# it read if no invalidation came in between. ids dropped from here
+# fall back to the highest generation dropped, so a read that spans
+# the drop is not cached either
+_generations = collections.OrderedDict()
+_dropped = 0
+_sequence = itertools.count(1)
+_lock = threading.Lock()
+_hits = Counter('dos_connect_get_cache_hits',
+                'Get requests answered from cache')
+_misses = Counter('dos_connect_get_cache_misses',
+                  'Get requests read from the backend')
+
+
+class HitRatio(object):
+    """
+    collector of dos_connect_get_cache_hit_ratio, computed at scrape
+    time from the hit and miss counters of collector, e.g. the
+    multi-process collector that adds up all workers, or of this process
+    """
+
+    def __init__(self, collector=None):
+        super(HitRatio, self).__init__()
+        self.collector = collector
+
+    def collect(self):
+        if self.collector:
+            metrics = self.collector.collect()
+        else:
+            metrics = itertools.chain(_hits.collect(), _misses.collect())
+        totals = {}
+        for metric in metrics:
+            totals[metric.name] = sum(value for _, _, value in
+                                      metric.samples)
+        hits = totals.get('dos_connect_get_cache_hits', 0.0)
+        misses = totals.get('dos_connect_get_cache_misses', 0.0)
+        yield GaugeMetricFamily('dos_connect_get_cache_hit_ratio',
+                                'Share of get requests answered from cache',
+                                value=hits / ((hits + misses) or 1))
+
+
+if 'prometheus_multiproc_dir' not in os.environ:
+    # with workers app.py adds one over the files of all of them
+    REGISTRY.register(HitRatio())
+
+
+def get(index, id, version=None):
+    """ return the cached document, or None """
+    if not GET_CACHE_SIZE:
+        return None
+    doc = (_cache.get((index, id)) or {}).get(version, None)
+    if doc is None:
+        _misses.inc()
+    else:
+        _hits.inc()
+    return doc
+
+
+def generation(index, id):
+    """ changes whenever id is invalidated, read it before the backend """
+    with _lock:
+        return _generations.get((index, id), _dropped)
+
+
+def set(index, id, doc, generation, version=None):
+    """
+    cache doc, a plain dict that callers must not change,
+    unless id was invalidated since generation was read
+    """
+    if not GET_CACHE_SIZE:
+        return
+    with _lock:
+        if _generations.get((index, id), _dropped) != generation:
+            # an update or delete raced with the read, doc may be stale
+            return
+        versions = dict(_cache.get((index, id)) or {})
+        versions[version] = doc
+        _cache.set((index, id), versions)
+
+
+def invalidate(index, id):
+    """ drop every cached version of id """
+    global _dropped
+    if not GET_CACHE_SIZE:
+        return
+    with _lock:
+        _generations.pop((index, id), None)
+        _generations[(index, id)] = next(_sequence)
+        while len(_generations) > GET_CACHE_SIZE:
+            _, dropped = _generations.popitem(last=False)
+            _dropped = max(_dropped, dropped)
+        _cache.invalidate((index, id))
+
+
+def _consume():
+    """ invalidate on every message of the replication topic """
+    from kafka import KafkaConsumer
+    # no group, so every worker sees every message
+    consumer = KafkaConsumer(os.getenv('KAFKA_DOS_TOPIC'),
+                             bootstrap_servers=os.getenv(
+                                'KAFKA_BOOTSTRAP_SERVERS'),
+                             group_id=None,
+                             auto_offset_reset='latest',
+                             client_id='dos-cache-{}'.format(uuid.uuid4()))
+    for message in consumer:
+        try:
+            id = json_codec.loads(message.value)['doc']['id']
+            for index in INDEXES:
+                invalidate(index, id)
+        except Exception as e:
+            log.exception(e)
+
+
+if GET_CACHE_SIZE and GET_CACHE_KAFKA_INVALIDATION:
+    assert os.getenv('KAFKA_BOOTSTRAP_SERVERS', None) and \
+        os.getenv('KAFKA_DOS_TOPIC', None), \
+        'GET_CACHE_KAFKA_INVALIDATION needs KAFKA_BOOTSTRAP_SERVERS ' \
+        'and KAFKA_DOS_TOPIC'
+    invalidator = threading.Thread(target=_consume,
+                                   name='get-cache-invalidation')
+    invalidator.daemon = True
+    invalidator.start()
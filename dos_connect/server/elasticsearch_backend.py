@@ -10,20 +10,50 @@ import uuid
 
 
 from elasticsearch import Elasticsearch
+from elasticsearch import helpers
 from elasticsearch_dsl import Search, Q
+from elasticsearch.serializer import JSONSerializer
 import elasticsearch
+from dos_connect import json_codec
 from utils import AttributeDict, now, add_created_timestamps, \
-                  add_updated_timestamps
+                  add_updated_timestamps, document_id, next_version, \
+                  DETERMINISTIC_IDS
 
 
 log = logging.getLogger(__name__)
 
 DEFAULT_PAGE_SIZE = 100
+BULK_CHUNK_SIZE = int(os.getenv('ES_BULK_CHUNK_SIZE', '500'))
+# export scroll, hits per round trip and how long the context lives
+ES_SCROLL_SIZE = int(os.getenv('ES_SCROLL_SIZE', '1000'))
+ES_SCROLL = os.getenv('ES_SCROLL', '5m')
+# values per terms query of resolve()
+RESOLVE_CHUNK_SIZE = int(os.getenv('ES_RESOLVE_CHUNK_SIZE', '1000'))
+
+
+class CodecSerializer(JSONSerializer):
+    """ request and response bodies through json_codec """
+
+    def loads(self, s):
+        try:
+            return json_codec.loads(s)
+        except (ValueError, TypeError) as e:
+            raise elasticsearch.SerializationError(s, e)
+
+    def dumps(self, data):
+        # bulk bodies arrive already serialized
+        if isinstance(data, basestring):
+            return data
+        try:
+            return json_codec.dumps(data)
+        except (ValueError, TypeError) as e:
+            raise elasticsearch.SerializationError(data, e)
+
 
 # connect to elastic
 
 ELASTIC_URL = os.getenv('ELASTIC_URL', 'localhost:9200')
-client = Elasticsearch([ELASTIC_URL])
+client = Elasticsearch([ELASTIC_URL], serializer=CodecSerializer())
 assert client.info()
 # check persistence options in env
 ES_REFRESH_ON_PERSIST = os.getenv('ES_REFRESH_ON_PERSIST', 'False')
@@ -33,61 +63,520 @@ if not ES_REFRESH_ON_PERSIST:
              ' ES writes defer index refresh')
 else:
     log.info('ES_REFRESH_ON_PERSIST set, ES writes will refresh index')
+# install index templates and create missing indexes on startup
+ES_PUT_TEMPLATES = os.getenv('ES_PUT_TEMPLATES', 'True')
+ES_PUT_TEMPLATES = not (ES_PUT_TEMPLATES == 'False')
+
+# current versions in <index>, older versions in <index>_history
+ES_SPLIT_HISTORY = os.getenv('ES_SPLIT_HISTORY', 'False')
+ES_SPLIT_HISTORY = not (ES_SPLIT_HISTORY == 'False')
+
+INDEXES = ['data_objects', 'data_bundles']
+
+# lookups are exact, so every string is a keyword unless mapped otherwise
+MAPPING = {
+    'dynamic_templates': [
+        {'strings': {
+            'match_mapping_type': 'string',
+            'mapping': {'type': 'keyword', 'ignore_above': 1024}
+        }}
+    ],
+    'properties': {
+        'id': {'type': 'keyword'},
+        'version': {'type': 'keyword'},
+        'current': {'type': 'boolean'},
+        'aliases': {'type': 'keyword'},
+        'size': {'type': 'long'},
+        'created': {'type': 'date'},
+        'updated': {'type': 'date'},
+        'checksums': {'properties': {
+            'checksum': {'type': 'keyword'},
+            'type': {'type': 'keyword'},
+        }},
+        'urls': {'properties': {
+            'url': {'type': 'keyword'},
+        }},
+    }
+}
+
+# property names used by the controllers -> indexed field
+FIELDS = {
+    'alias': 'aliases',
+    'checksum': 'checksums.checksum',
+    'url': 'urls.url',
+}
+
+
+def _put_templates(indexes=INDEXES):
+    """
+    one template per index, ES 6 allows a single doc type per index,
+    then create any missing index so the template applies
+    """
+    if ES_SPLIT_HISTORY:
+        indexes = indexes + [_history(index) for index in indexes]
+    for index in indexes:
+        if index.endswith('_history'):
+            # covered by the template of its index
+            if not client.indices.exists(index=index):
+                client.indices.create(index=index, ignore=400)
+            continue
+        client.indices.put_template(
+            name='dos_connect_{}'.format(index),
+            body={'index_patterns': ['{}*'.format(index)],
+                  'mappings': {index[:-1]: MAPPING}})
+        if not client.indices.exists(index=index):
+            client.indices.create(index=index, ignore=400)
+
+
+def _history(index):
+    """ index of the older versions, see ES_SPLIT_HISTORY """
+    return '{}_history'.format(index)
+
+
+# fields every list and search sorts on, ES refuses to sort on text
+SORTED = {'id': 'keyword', 'version': 'keyword', 'updated': 'date'}
+# order of search hits, updated desc, id and version make it total.
+# a page cursor (hit.meta.sort) holds a value of each
+SEARCH_SORT = ('-updated', '-id', '-version')
+
+
+def _keyword_strings(mapping):
+    """ True if the dynamic templates map new strings as keyword """
+    for template in mapping.get('dynamic_templates', []):
+        for definition in template.values():
+            if definition.get('match_mapping_type', None) == 'string' and \
+                    definition['mapping'].get('type', None) == 'keyword':
+                return True
+    return False
+
+
+def _check_mappings(indexes=INDEXES):
+    """
+    fail fast if an index maps the sort fields otherwise than the template,
+    e.g. one created before the templates maps id as text, and every
+    list and search would fail
+    """
+    if ES_SPLIT_HISTORY:
+        indexes = indexes + [_history(index) for index in indexes]
+    wrong = []
+    for index in indexes:
+        if not client.indices.exists(index=index):
+            continue
+        for name, mapping in client.indices.get_mapping(index=index).items():
+            # an index without documents may have no type yet
+            types = mapping['mappings'] or {index[:-1]: {}}
+            for doc_type, type_mapping in types.items():
+                if doc_type == '_default_':
+                    continue
+                properties = type_mapping.get('properties', {})
+                for field, expected in sorted(SORTED.items()):
+                    actual = properties.get(field, {}).get('type', None)
+                    # unmapped strings are mapped when first indexed
+                    if actual is None and (
+                            expected == 'date' or
+                            _keyword_strings(type_mapping)):
+                        continue
+                    if actual != expected:
+                        wrong.append('{} maps {} as {}, not {}'.format(
+                            name, field, actual or 'dynamic text', expected))
+    assert not wrong, '{}. Reindex, see "ES index Setup" in the server ' \
+                      'README'.format(', '.join(wrong))
+
+
+if ES_PUT_TEMPLATES:
+    _put_templates()
+_check_mappings()
+
+
+def _filter(s, properties):
+    """
+    add an exact match term filter for each property,
+    filters are not scored and are cached by ES
+    """
+    for k in properties.keys():
+        v = properties[k]
+        if k == 'checksum':
+            v = v['checksum']
+        s = s.filter('term', **{FIELDS.get(k, k): v})
+    return s
 
 
 def save(doc, index='data_objects'):
     """
     save the body in the index, ensure version and id set
     """
-    version = doc.get('version', None)
-    if not version:
-        doc['version'] = now()
-    if not doc.get('id', None):
-        temp_id = str(uuid.uuid4())
-        doc['id'] = temp_id
-
-    if _is_duplicate(doc, index):
+    if ES_SPLIT_HISTORY:
+        return _save_split(doc, index)
+    _id = _ensure_ids(doc)
+    if not _id and _is_duplicate(doc, index):
         raise Exception("duplicate document")
     # create index, use index name singular as doc type
     # do not wait for search available See
     # https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-refresh.html
-    result = client.index(index=index,
-                          body=doc,
-                          doc_type=index[:-1],
-                          timeout='120s',
-                          request_timeout=120,
-                          op_type='index',
-                          refresh=ES_REFRESH_ON_PERSIST
-                          )
+    # with a deterministic _id, create fails if the document exists
+    try:
+        result = client.index(index=index,
+                              body=doc,
+                              doc_type=index[:-1],
+                              id=_id,
+                              timeout='120s',
+                              request_timeout=120,
+                              op_type='create' if _id else 'index',
+                              refresh=ES_REFRESH_ON_PERSIST
+                              )
+    except elasticsearch.exceptions.ConflictError:
+        raise Exception("duplicate document")
     return doc
 
 
+def _ensure_ids(doc):
+    """
+    ensure version and id set,
+    return the deterministic _id, or None to let ES assign one
+    """
+    if not doc.get('id', None):
+        doc['id'] = str(uuid.uuid4())
+    # hash before defaulting version, so a resubmission matches
+    _id = document_id(doc) if DETERMINISTIC_IDS else None
+    if not doc.get('version', None):
+        doc['version'] = now()
+    return _id
+
+
+def save_many(docs, index='data_objects'):
+    """
+    save many bodies in the index with one duplicate query and
+    one _bulk request,
+    return list of (doc, error) in order, error is None on success
+    """
+    if ES_SPLIT_HISTORY:
+        return _save_many_split(docs, index)
+    _ids = [_ensure_ids(doc) for doc in docs]
+
+    results = [None] * len(docs)
+    actions = []
+    positions = []
+    if DETERMINISTIC_IDS:
+        # ES rejects existing documents, no need to look first
+        duplicates = [False] * len(docs)
+    else:
+        duplicates = _is_duplicate_many(docs, index)
+    for i, duplicate in enumerate(duplicates):
+        if duplicate:
+            results[i] = (docs[i], 'duplicate document')
+            continue
+        action = {'_op_type': 'index',
+                  '_index': index,
+                  '_type': index[:-1],
+                  '_source': docs[i]}
+        if _ids[i]:
+            action['_op_type'] = 'create'
+            action['_id'] = _ids[i]
+        actions.append(action)
+        positions.append(i)
+
+    # streaming_bulk yields one (ok, item) per action, in order
+    responses = helpers.streaming_bulk(client, actions,
+                                       chunk_size=BULK_CHUNK_SIZE,
+                                       raise_on_error=False,
+                                       raise_on_exception=False,
+                                       request_timeout=120,
+                                       refresh=ES_REFRESH_ON_PERSIST)
+    for i, (ok, item) in zip(positions, responses):
+        # item is keyed by op_type
+        status = item.values()[0] if item else {}
+        if ok:
+            results[i] = (docs[i], None)
+        elif status.get('status', None) == 409:
+            results[i] = (docs[i], 'duplicate document')
+        else:
+            log.error(item)
+            results[i] = (docs[i], str(status.get('error')))
+    return results
+
+
+def _contains(doc, new_doc):
+    """ True if doc has all of new_doc's aliases, checksums and urls """
+    if doc.get('id', None) != new_doc.get('id', None):
+        return False
+    for alias in new_doc.get('aliases', None) or []:
+        if alias not in (doc.get('aliases', None) or []):
+            return False
+    checksums = [c['checksum'] for c in doc.get('checksums', None) or []]
+    for checksum in new_doc.get('checksums', None) or []:
+        if checksum['checksum'] not in checksums:
+            return False
+    urls = [u['url'] for u in doc.get('urls', None) or []]
+    for url in new_doc.get('urls', None) or []:
+        if url['url'] not in urls:
+            return False
+    return True
+
+
+def _is_duplicate_many(new_docs, index='data_objects'):
+    """ batched _is_duplicate, one query for all new_docs.
+        return list of booleans in order, later docs in the
+        batch are also checked against earlier ones
+    """
+    existing = {}
+    ids = list(set([new_doc.id for new_doc in new_docs]))
+    s = Search(using=client, index=index) \
+        .filter('terms', id=ids) \
+        .source(['id', 'aliases', 'checksums', 'urls'])
+    try:
+        for hit in s.scan():
+            existing.setdefault(hit.id, []).append(hit.to_dict())
+    except elasticsearch.exceptions.NotFoundError:
+        log.info('NotFoundError {} (expected on empty db)'.format(index))
+
+    duplicates = []
+    for new_doc in new_docs:
+        candidates = existing.setdefault(new_doc.id, [])
+        duplicates.append(any(_contains(doc, new_doc) for doc in candidates))
+        candidates.append(new_doc)
+    return duplicates
+
+
 def _is_duplicate(new_doc, index='data_objects'):
     """ check if already stored.
         True if new_doc has same checksums and urls,
             and optionally id and aliases
     """
-    # by default search for everything
     s = Search(using=client, index=index)
-    clauses = ['*']
-    # make seach parameters ES friendly
     if 'id' in new_doc:
-        clauses.append('+{}:"{}"'.format('id', new_doc.id))
-    if 'aliases' in new_doc:
-        for alias in new_doc.aliases:
-            clauses.append('+{}:"{}"'.format('aliases', alias))
-    if 'checksums' in new_doc:
-        for checksum in new_doc.checksums:
-            clauses.append('+{}:"{}"'.format('checksums.checksum',
-                                             checksum['checksum']))
-    if 'urls' in new_doc:
-        for url in new_doc.urls:
-            clauses.append('+{}:"{}"'.format('urls.url', url['url']))
+        s = s.filter('term', id=new_doc.id)
+    for alias in new_doc.get('aliases', None) or []:
+        s = s.filter('term', aliases=alias)
+    for checksum in new_doc.get('checksums', None) or []:
+        s = s.filter('term', **{'checksums.checksum': checksum['checksum']})
+    for url in new_doc.get('urls', None) or []:
+        s = s.filter('term', **{'urls.url': url['url']})
     # execute query return True if a hit
-    s = s.query("query_string", query=' '.join(clauses))
     return s.count() > 0
 
 
+def _read_current(id, index):
+    """
+    return (_id, source, _version) of the current version, or Nones.
+    the search only finds the _id, it is near real-time and may miss a
+    version just written or return one an update already retired, so the
+    document is read with a realtime get, and looked up again after a
+    refresh if it is not current
+    """
+    for attempt in range(2):
+        if attempt:
+            client.indices.refresh(index=index)
+        hits = Search(using=client, index=index) \
+            .filter('term', id=id) \
+            .filter('term', current=True) \
+            .sort('-updated', '-version')[0:1] \
+            .execute()
+        if not hits:
+            continue
+        response = client.get(index=index, doc_type=index[:-1],
+                              id=hits[0].meta.id, ignore=404)
+        if response.get('found', False) and \
+                response['_source'].get('current', False):
+            return (hits[0].meta.id, AttributeDict(response['_source']),
+                    response['_version'])
+    return None, None, None
+
+
+def new_version(id, doc, index='data_objects'):
+    """
+    save doc as the current version of id and retire the previous one
+    in a single _bulk request. The retire is conditional on the version
+    of the document we read, so concurrent updates cannot both win.
+    """
+    if ES_SPLIT_HISTORY:
+        return _new_version_split(id, doc, index)
+    doc_type = index[:-1]
+    old_id, old_doc, old_version = _read_current(id, index)
+    if not old_doc:
+        raise Exception("document not found {}".format(id))
+    next_version(old_doc, doc)
+    _id = _ensure_ids(doc)
+    if not _id:
+        if _is_duplicate(doc, index):
+            raise Exception("duplicate document")
+        # known up front, so it can be removed if the retire fails
+        _id = str(uuid.uuid4())
+    body = [
+        {'create': {'_index': index, '_type': doc_type, '_id': _id}},
+        doc,
+        {'update': {'_index': index, '_type': doc_type,
+                    '_id': old_id,
+                    '_version': old_version}},
+        {'doc': {'current': False}},
+    ]
+    response = client.bulk(body=body,
+                           request_timeout=120,
+                           refresh=ES_REFRESH_ON_PERSIST)
+    created, retired = [item.values()[0] for item in response['items']]
+    if not created.get('error', None) and not retired.get('error', None):
+        return doc
+
+    # no multi document transactions in ES, undo the half that applied
+    if not created.get('error', None):
+        client.delete(index=index, doc_type=doc_type, id=_id,
+                      refresh=ES_REFRESH_ON_PERSIST)
+    if not retired.get('error', None):
+        update(old_id, {'current': True}, index)
+    if created.get('status', None) == 409:
+        raise Exception("duplicate document")
+    if retired.get('status', None) == 409:
+        raise Exception("concurrent update of {}".format(id))
+    log.error(response)
+    raise Exception("new version of {} failed".format(id))
+
+
+# ES_SPLIT_HISTORY layout: the current version of each id is stored in
+# <index> with the id as _id, older versions are appended to
+# <index>_history.
+
+
+def _get_current(id, index):
+    """ return (source, _version) of the current version, or (None, None) """
+    response = client.get(index=index, doc_type=index[:-1], id=id,
+                          ignore=404)
+    if not response.get('found', False):
+        return None, None
+    return AttributeDict(response['_source']), response['_version']
+
+
+def _split_actions(doc, index, current, version):
+    """
+    bulk (action, source) pairs storing doc as the current version,
+    moving current, if any, to history
+    """
+    doc_type = index[:-1]
+    if current is None:
+        return [({'create': {'_index': index, '_type': doc_type,
+                             '_id': doc.id}}, doc)]
+    retired = AttributeDict(current)
+    retired.current = False
+    return [({'create': {'_index': _history(index), '_type': doc_type,
+                         '_id': str(uuid.uuid4())}}, retired),
+            ({'index': {'_index': index, '_type': doc_type,
+                        '_id': doc.id, '_version': version}}, doc)]
+
+
+def _run_split(pairs_per_doc, index):
+    """
+    send the pairs of every doc in one _bulk request,
+    return an error or None per doc
+    """
+    body = []
+    for pairs in pairs_per_doc:
+        for action, source in pairs:
+            body.extend([action, source])
+    if not body:
+        return []
+    response = client.bulk(body=body,
+                           request_timeout=120,
+                           refresh=ES_REFRESH_ON_PERSIST)
+    items = iter([item.values()[0] for item in response['items']])
+    errors = []
+    for pairs in pairs_per_doc:
+        if len(pairs) == 1:
+            current = next(items)
+            if current.get('status', None) == 409:
+                errors.append('duplicate document')
+            else:
+                errors.append(current.get('error', None))
+            continue
+        (_, retired), _ = pairs
+        history, current = next(items), next(items)
+        if current.get('error', None):
+            # the current version changed under us, drop our history copy
+            if not history.get('error', None):
+                client.delete(index=history['_index'],
+                              doc_type=history['_type'],
+                              id=history['_id'])
+            if current.get('status', None) == 409:
+                errors.append('concurrent update of {}'.format(retired.id))
+            else:
+                errors.append(current['error'])
+            continue
+        if history.get('error', None):
+            # history is append only, so a retry is safe
+            log.error(history)
+            client.index(index=_history(index), doc_type=index[:-1],
+                         body=retired, refresh=ES_REFRESH_ON_PERSIST)
+        errors.append(None)
+    return errors
+
+
+def _save_split(doc, index):
+    """
+    save, one create request keyed by the id. there is a single
+    current document per id, so a known id is a duplicate whatever
+    its content, new versions are only made by new_version
+    """
+    # the id is the _id, no deterministic _id needed
+    _ensure_ids(doc)
+    error = _run_split([_split_actions(doc, index, None, None)], index)[0]
+    if error:
+        raise Exception(error)
+    return doc
+
+
+def _save_many_split(docs, index):
+    """ save_many, one _bulk request of creates """
+    for doc in docs:
+        _ensure_ids(doc)
+    errors = _run_split([_split_actions(doc, index, None, None)
+                         for doc in docs], index)
+    results = []
+    for doc, error in zip(docs, errors):
+        if error:
+            log.error(error)
+        results.append((doc, error))
+    return results
+
+
+def _new_version_split(id, doc, index):
+    """ new_version, one realtime get and one _bulk request """
+    current, version = _get_current(id, index)
+    if current is None:
+        raise Exception("document not found {}".format(id))
+    next_version(current, doc)
+    _ensure_ids(doc)
+    error = _run_split([_split_actions(doc, index, current, version)],
+                       index)[0]
+    if error:
+        raise Exception(error)
+    return doc
+
+
+def _indexes(properties, index):
+    """ indexes a search must read, current only if it asks for current """
+    if ES_SPLIT_HISTORY and properties.get('current', None) is not True:
+        return [index, _history(index)]
+    return index
+
+
+def current_version(id, index='data_objects'):
+    """
+    version of the current document of id, or None,
+    fetching only the version field
+    """
+    if ES_SPLIT_HISTORY:
+        response = client.get(index=index, doc_type=index[:-1], id=id,
+                              _source_include=['version'], ignore=404)
+        if not response.get('found', False):
+            return None
+        return response['_source'].get('version', None)
+    s = Search(using=client, index=index) \
+        .filter('term', id=id) \
+        .filter('term', current=True) \
+        .sort('-updated', '-id', '-version') \
+        .source(['version'])[0:1]
+    for hit in s.execute():
+        return hit.version
+    return None
+
+
 def update(_id, doc, index='data_objects'):
     """
     partial update using the es contructed _id
@@ -103,37 +592,22 @@ def update(_id, doc, index='data_objects'):
 
 
 def search(properties, index='data_objects', size=DEFAULT_PAGE_SIZE,
-           offset=0, include_total=False):
+           offset=0, include_total=False, after=None):
     """
     get all objects that match
     if include_total set, return tuple (hit, total)
+    if after set, start after the hit whose meta.sort it is,
+    so deep pages cost the same as the first
     """
     #  see https://github.com/ga4gh/data-object-schemas/issues/33
-    # make seach parameters ES friendly
-    if 'alias' in properties:
-        properties.aliases = properties.alias
-        del properties['alias']
-    if 'checksum' in properties:
-        properties['checksums.checksum'] = properties.checksum['checksum']
-        del properties['checksum']
-    if 'url' in properties:
-        properties['urls.url'] = properties.url
-        del properties['url']
-    # by default search for everything
-    s = Search(using=client, index=index)
-    clauses = ['*']
-    for k in properties.keys():
-        v = properties[k]
-        # quote everything except booleans
-        if not isinstance(v, bool):
-            clauses.append('+{}:"{}"'.format(k, v))
-        else:
-            clauses.append('+{}:{}'.format(k, str(v).lower()))
-    s = s.query("query_string", query=' '.join(clauses))
-    # get current page
-    s = s[offset:offset+size]
-    # sorted by updated desc
-    s = s.sort('-updated')
+    s = _filter(Search(using=client, index=_indexes(properties, index)),
+                properties)
+    s = s.sort(*SEARCH_SORT)
+    if after:
+        s = s.extra(search_after=after)[0:size]
+    else:
+        # get current page
+        s = s[offset:offset+size]
     response = s.execute()
     total = response.hits.total
     for _, hit in enumerate(response):
@@ -144,20 +618,74 @@ def search(properties, index='data_objects', size=DEFAULT_PAGE_SIZE,
             yield hit
 
 
+def _values(hit, name):
+    """ values of the property name in hit """
+    if name == 'id':
+        return [hit.id]
+    if name == 'alias':
+        return list(hit.aliases or [])
+    if name == 'checksum':
+        return [c.checksum for c in hit.checksums or []]
+    return [u.url for u in hit.urls or []]
+
+
+def resolve(keys, index='data_objects'):
+    """
+    current objects having each key, keys maps a property name
+    (id, checksum, alias or url) to a list of values,
+    return {name: {value: [doc, ...]}}.
+    one terms query per RESOLVE_CHUNK_SIZE values, or an mget
+    of the current index for ids when ES_SPLIT_HISTORY
+    """
+    resolved = {}
+    for name, values in keys.items():
+        matches = resolved[name] = dict((value, []) for value in values)
+        values = list(matches.keys())
+        for start in range(0, len(values), RESOLVE_CHUNK_SIZE):
+            chunk = values[start:start + RESOLVE_CHUNK_SIZE]
+            if name == 'id' and ES_SPLIT_HISTORY:
+                # the current index is keyed by id
+                response = client.mget(index=index, doc_type=index[:-1],
+                                       body={'ids': chunk})
+                for doc in response['docs']:
+                    if doc.get('found', False):
+                        matches[doc['_id']].append(
+                            AttributeDict(doc['_source']))
+                continue
+            s = Search(using=client, index=index) \
+                .filter('terms', **{FIELDS.get(name, name): chunk}) \
+                .filter('term', current=True) \
+                .params(scroll=ES_SCROLL, size=ES_SCROLL_SIZE)
+            wanted = set(chunk)
+            for hit in s.scan():
+                for value in set(_values(hit, name)):
+                    if value in wanted:
+                        matches[value].append(hit)
+    return resolved
+
+
+def scan(properties, index='data_objects'):
+    """
+    yield every object that matches, in no particular order,
+    with a scroll so the result set is never held in memory
+    """
+    s = _filter(Search(using=client, index=_indexes(properties, index)),
+                properties)
+    s = s.params(scroll=ES_SCROLL, size=ES_SCROLL_SIZE)
+    for hit in s.scan():
+        yield hit
+
+
 def delete(properties, index='data_objects'):
     """
     delete item from index
     """
-    s = Search(using=client, index=index)
-    clauses = []
-    for k in properties.keys():
-        v = properties[k]
-        clauses.append('+{}:"{}"'.format(k, v))
-    s = s.query("query_string", query=' '.join(clauses))
+    s = _filter(Search(using=client, index=_indexes(properties, index)),
+                properties)
     s.delete()
 
 
-def metrics(indexes=['data_objects', 'data_bundles']):
+def metrics(indexes=INDEXES):
     """
     return document counts
     """
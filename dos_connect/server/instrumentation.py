@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# prometheus timings of controllers and the plugins they call
+
+import functools
+import logging
+import os
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+log = logging.getLogger(__name__)
+
+# seconds between background refreshes of document counts
+METRICS_REFRESH_INTERVAL = float(os.getenv('METRICS_REFRESH_INTERVAL', '60'))
+# several workers write their values to files that /metrics adds up,
+# see app.py serve()
+MULTIPROCESS = 'prometheus_multiproc_dir' in os.environ
+
+_requests = Counter('dos_connect_requests',
+                    'Requests handled',
+                    ['operation', 'status_code'])
+_request_latency = Histogram('dos_connect_request_latency_seconds',
+                             'Seconds to handle a request',
+                             ['operation'])
+_stage_latency = Histogram('dos_connect_stage_latency_seconds',
+                           'Seconds spent in authorization, '
+                           'backend and replication calls',
+                           ['operation', 'stage'])
+
+
+def gauge(name, documentation, multiprocess_mode):
+    """
+    Gauge, multiprocess_mode says how the values of several workers are
+    combined (min, max, livesum, liveall or all).
+    With several workers set_function raises, its value is never written
+    to the files, compute such values when scraped with a collector,
+    see document_cache.HitRatio
+    """
+    g = Gauge(name, documentation, multiprocess_mode=multiprocess_mode)
+    if MULTIPROCESS:
+        def set_function(f):
+            raise ValueError('{} is read from the multi-process files, '
+                             'set_function would export 0'.format(name))
+        g.set_function = set_function
+    return g
+
+
+# operation and start time of the request on this thread
+_request = threading.local()
+
+
+def _operation():
+    return getattr(_request, 'operation', None) or 'none'
+
+
+def observe(stage, elapsed):
+    """ record time spent in stage by the current request """
+    _stage_latency.labels(_operation(), stage).observe(elapsed)
+
+
+def timed(f):
+    """ controller decorator, apply outside authorization_check """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        _request.operation = f.__name__
+        _request.started = time.time()
+        status_code = 500
+        try:
+            response = f(*args, **kwargs)
+            if isinstance(response, tuple):
+                status_code = response[1]
+            else:
+                # e.g. the authorizer's 401 flask.Response
+                status_code = getattr(response, 'status_code', 200)
+            return response
+        finally:
+            _request_latency.labels(f.__name__).observe(
+                time.time() - _request.started)
+            _requests.labels(f.__name__, str(status_code)).inc()
+            _request.operation = None
+    return wrapper
+
+
+def timed_authorization(authorization_check):
+    """
+    wrap an authorizer's decorator, the time until it calls
+    the controller is recorded as the authorization stage
+    """
+    def timed_authorization_check(f):
+        @functools.wraps(f)
+        def authorized(*args, **kwargs):
+            started = getattr(_request, 'started', None)
+            if started:
+                observe('authorization', time.time() - started)
+            return f(*args, **kwargs)
+        return authorization_check(authorized)
+    return timed_authorization_check
+
+
+def timed_call(stage, f):
+    """ wrap a plugin function, record its duration as stage """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        started = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            observe(stage, time.time() - started)
+    return wrapper
+
+
+def timed_generator(stage, f):
+    """ like timed_call, for generators such as backend search """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        elapsed = 0.0
+        started = time.time()
+        try:
+            items = f(*args, **kwargs)
+            while True:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.time() - started
+                yield item
+                # time spent by the caller between items does not count
+                started = time.time()
+        finally:
+            observe(stage, elapsed)
+    return wrapper
+
+
+def streamed(items):
+    """
+    a response body generator, iterated after the controller returned
+    and timed reset the operation, the stages it runs are recorded
+    under the controller's operation
+    """
+    operation = _operation()
+
+    def run():
+        try:
+            while True:
+                _request.operation = operation
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    _request.operation = None
+                yield item
+        finally:
+            # e.g. the client went away before the end
+            _request.operation = operation
+            try:
+                items.close()
+            finally:
+                _request.operation = None
+    return run()
+
+
+class CachedMetrics(object):
+    """
+    document counts from the backend's metrics(), refreshed in the
+    background so a scrape never waits on the backend
+    """
+
+    def __init__(self, metrics, interval=METRICS_REFRESH_INTERVAL):
+        super(CachedMetrics, self).__init__()
+        self.metrics = metrics
+        self.interval = interval
+        self.values = self.metrics()
+        self.refreshed = time.time()
+        self.thread = threading.Thread(target=self._run,
+                                       name='metrics-refresh')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self):
+        return self.values
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.values = self.metrics()
+                self.refreshed = time.time()
+            except Exception as e:
+                # keep serving the last known counts
+                log.exception(e)
@@ -3,20 +3,203 @@
 
 # customize for your replication needs
 
+import atexit
+import contextlib
+import errno
+import fcntl
+import itertools
 import logging
 from kafka import KafkaProducer
 import os
-import json
+import threading
+import time
+
+from prometheus_client import Counter, Histogram
+from instrumentation import gauge
+from dos_connect import json_codec
 
 log = logging.getLogger(__name__)
 
 
 KAFKA_BOOTSTRAP_SERVERS = os.getenv('KAFKA_BOOTSTRAP_SERVERS', None)
+# wait for each message to be acknowledged (previous behavior)
+KAFKA_SYNC = os.getenv('KAFKA_SYNC', 'False')
+KAFKA_SYNC = not (KAFKA_SYNC == 'False')
+# producer batching, see kafka-python's KafkaProducer
+KAFKA_LINGER_MS = int(os.getenv('KAFKA_LINGER_MS', '50'))
+KAFKA_BATCH_SIZE = int(os.getenv('KAFKA_BATCH_SIZE', '65536'))
+KAFKA_ACKS = os.getenv('KAFKA_ACKS', 'all')
+KAFKA_RETRIES = int(os.getenv('KAFKA_RETRIES', '3'))
+# bytes buffered in process, a full buffer blocks the request
+# for up to KAFKA_MAX_BLOCK_MS before the message is spilled
+KAFKA_BUFFER_MEMORY = int(os.getenv('KAFKA_BUFFER_MEMORY', '33554432'))
+KAFKA_MAX_BLOCK_MS = int(os.getenv('KAFKA_MAX_BLOCK_MS', '1000'))
+# undeliverable messages are appended here and resent later,
+# workers share it, see _spill_locked
+KAFKA_SPILL_FILE = os.getenv('KAFKA_SPILL_FILE', None)
+KAFKA_SPILL_INTERVAL = float(os.getenv('KAFKA_SPILL_INTERVAL', '30'))
+# seconds to wait for buffered messages on shutdown
+KAFKA_SHUTDOWN_TIMEOUT = float(os.getenv('KAFKA_SHUTDOWN_TIMEOUT', '30'))
+
+_delivered = Counter('dos_connect_replication_delivered',
+                     'Messages acknowledged by kafka')
+_failed = Counter('dos_connect_replication_failed',
+                  'Messages kafka did not accept')
+_spilled = Counter('dos_connect_replication_spilled',
+                   'Messages written to KAFKA_SPILL_FILE')
+_queued = gauge('dos_connect_replication_queue_depth',
+                'Messages sent and not yet acknowledged',
+                multiprocess_mode='livesum')
+_latency = Histogram('dos_connect_replication_latency_seconds',
+                     'Seconds from send to acknowledgement')
+
+# message number -> message, removed once acknowledged
+_pending = {}
+_sequence = itertools.count()
+_spill_lock = threading.Lock()
+
 producer = None
 if KAFKA_BOOTSTRAP_SERVERS:
     KAFKA_DOS_TOPIC = os.getenv('KAFKA_DOS_TOPIC', None)
     assert KAFKA_DOS_TOPIC
-    producer = KafkaProducer(bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS)
+    producer = KafkaProducer(bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+                             linger_ms=KAFKA_LINGER_MS,
+                             batch_size=KAFKA_BATCH_SIZE,
+                             acks=KAFKA_ACKS,
+                             retries=KAFKA_RETRIES,
+                             buffer_memory=KAFKA_BUFFER_MEMORY,
+                             max_block_ms=KAFKA_MAX_BLOCK_MS)
+
+
+@contextlib.contextmanager
+def _spill_locked():
+    """
+    exclusive use of KAFKA_SPILL_FILE among threads and workers,
+    so it is never renamed while another one appends to it
+    """
+    with _spill_lock:
+        with open('{}.lock'.format(KAFKA_SPILL_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+
+def _spill(message):
+    """ keep a message we could not deliver """
+    if not KAFKA_SPILL_FILE:
+        log.error('dropped replication message {}'.format(message))
+        return
+    with _spill_locked():
+        with open(KAFKA_SPILL_FILE, 'a') as spill_file:
+            spill_file.write(message + '\n')
+    _spilled.inc()
+
+
+def _on_success(number, started, metadata):
+    _pending.pop(number, None)
+    _queued.dec()
+    _delivered.inc()
+    _latency.observe(time.time() - started)
+
+
+def _on_error(number, error):
+    message = _pending.pop(number, None)
+    _queued.dec()
+    _failed.inc()
+    log.error('replication failed {}'.format(error))
+    if message is not None:
+        _spill(message)
+
+
+def _send(message):
+    """ hand message to the producer, callbacks track delivery """
+    number = next(_sequence)
+    _pending[number] = message
+    _queued.inc()
+    try:
+        future = producer.send(KAFKA_DOS_TOPIC, message)
+    except Exception as e:
+        # buffer full for max_block_ms, or no broker metadata
+        _on_error(number, e)
+        return None
+    future.add_callback(_on_success, number, time.time())
+    future.add_errback(_on_error, number)
+    return future
+
+
+def _replay():
+    """
+    resend spilled messages, failures are spilled again.
+    one worker at a time replays, holding a lock on the replay file,
+    the file of a worker that died is adopted by the next one
+    """
+    replay_file = '{}.replay'.format(KAFKA_SPILL_FILE)
+    with _spill_locked():
+        if not os.path.exists(replay_file):
+            if not os.path.exists(KAFKA_SPILL_FILE):
+                return
+            os.rename(KAFKA_SPILL_FILE, replay_file)
+    try:
+        spill_file = open(replay_file)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        # replayed and removed by another worker meanwhile
+        return
+    with spill_file:
+        try:
+            fcntl.flock(spill_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            # another worker is replaying it
+            return
+        if not os.path.exists(replay_file) or \
+                os.stat(replay_file).st_ino != \
+                os.fstat(spill_file.fileno()).st_ino:
+            # replayed and removed since we opened it
+            return
+        count = 0
+        for line in spill_file:
+            if line.strip():
+                _send(line.rstrip('\n'))
+                count += 1
+        producer.flush(timeout=KAFKA_SHUTDOWN_TIMEOUT)
+        os.remove(replay_file)
+    log.info('replayed {} spilled messages'.format(count))
+
+
+def _replay_loop():
+    while True:
+        try:
+            _replay()
+        except Exception as e:
+            log.exception(e)
+        time.sleep(KAFKA_SPILL_INTERVAL)
+
+
+def close():
+    """ deliver or spill everything buffered, call before exiting """
+    if not producer:
+        return
+    try:
+        producer.flush(timeout=KAFKA_SHUTDOWN_TIMEOUT)
+    except Exception as e:
+        log.exception(e)
+    # never acknowledged, keep them for the next run
+    for number in list(_pending.keys()):
+        message = _pending.pop(number, None)
+        if message is not None:
+            _spill(message)
+    producer.close(timeout=0)
+
+
+if producer:
+    atexit.register(close)
+    if KAFKA_SPILL_FILE:
+        replayer = threading.Thread(target=_replay_loop,
+                                    name='kafka-replay')
+        replayer.daemon = True
+        replayer.start()
 
 
 # replicate implementation
@@ -25,8 +208,8 @@ if KAFKA_BOOTSTRAP_SERVERS:
 def replicate(doc, method):
     '''send data downstream'''
     if producer:
-        producer.send(KAFKA_DOS_TOPIC,
-                      json.dumps({'method': method, 'doc': doc}))
-        producer.flush()
+        future = _send(json_codec.dumps({'method': method, 'doc': doc}))
+        if KAFKA_SYNC and future:
+            producer.flush()
     else:
         log.warning('producer not configured')
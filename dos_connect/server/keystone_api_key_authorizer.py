@@ -3,51 +3,99 @@
 
 # customize for your authorization needs
 
+import calendar
 import flask
+import hashlib
 import logging
 import os
-import requests
+import time
 
+from dateutil.parser import parse
 from decorator import decorator
+from prometheus_client import Counter
+from dos_connect.http_session import session
+from utils import TTLCache
 
 log = logging.getLogger(__name__)
 assert os.getenv('OS_AUTH_URL', None), 'Please export openstack OS_AUTH_URL'
 assert os.getenv('AUTHORIZER_PROJECTS', None), \
     'Please export openstack AUTHORIZER_PROJECTS'
 
+# validated tokens, never kept past keystone's expires_at
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '10000'))
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '300'))
+# rejected tokens, short so a fixed role assignment is seen quickly
+AUTH_CACHE_NEGATIVE_TTL = float(os.getenv('AUTH_CACHE_NEGATIVE_TTL', '10'))
+
+_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+_cache_hits = Counter('dos_connect_auth_cache_hits',
+                      'Api keys authorized from cache')
+_cache_misses = Counter('dos_connect_auth_cache_misses',
+                        'Api keys validated with keystone')
+
 
 # auth implementation
 
+def _expires(token_info):
+    '''epoch seconds when keystone says the token expires, or None'''
+    expires_at = token_info['token'].get('expires_at', None)
+    if not expires_at:
+        return None
+    try:
+        return calendar.timegm(parse(expires_at).utctimetuple())
+    except ValueError as e:
+        log.error('unparsable expires_at {}: {}'.format(expires_at, e))
+        return None
+
+
 def _check_auth(token):
-    '''This function is called to check if a token is valid.
-       and user belongs to AUTHORIZER_PROJECTS'''
+    '''Called to check if a token is valid and the user
+       belongs to AUTHORIZER_PROJECTS, answers from cache if possible'''
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    authorized = _cache.get(key)
+    if authorized is not None:
+        _cache_hits.inc()
+        return authorized
+    _cache_misses.inc()
+    authorized, expires = _validate(token)
+    if authorized:
+        expires = min(expires or float('inf'), time.time() + AUTH_CACHE_TTL)
+        _cache.set(key, True, expires=expires)
+    else:
+        _cache.set(key, False, ttl=AUTH_CACHE_NEGATIVE_TTL)
+    return authorized
+
+
+def _validate(token):
+    '''Ask keystone if a token is valid and the user belongs to
+       AUTHORIZER_PROJECTS, return (authorized, expires)'''
     # log.info('check_auth {}'.format(token))
     # validate the token
     url = '{}/auth/tokens'.format(os.environ.get('OS_AUTH_URL'))
     headers = {'X-Auth-Token': token,
                'X-Subject-Token': token}
-    token_info = requests.get(url, headers=headers).json()
+    token_info = session().get(url, headers=headers).json()
     if 'token' not in token_info:
         log.error(url)
         log.error(token_info)
-        return False
+        return False, None
 
     url = '{}/auth/projects'.format(os.environ.get('OS_AUTH_URL'))
     headers = {'X-Auth-Token': token}
-    project_info = requests.get(url, headers=headers).json()
+    project_info = session().get(url, headers=headers).json()
     if 'projects' not in project_info:
         log.error('no project_info for {}'.format(token))
         log.error(project_info)
-        return False
+        return False, None
     user_projects = [p['name'] for p in project_info['projects']]
     auth_projects = os.environ.get('AUTHORIZER_PROJECTS').split(',')
     auth_projects = [p.strip() for p in auth_projects]
     matched_projects = [p for p in auth_projects if p in user_projects]
     if len(matched_projects) == 0:
         log.error('no matches for {} {}'.format(user_projects, auth_projects))
-        return False
+        return False, None
 
-    return True
+    return True, _expires(token_info)
 
 
 def _authenticate():
@@ -0,0 +1,390 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# customize/override for your backend
+
+import atexit
+import glob
+import itertools
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from dos_connect import json_codec
+from utils import AttributeDict
+import memory_backend
+from memory_backend import _Index
+# the memory backend's implementation, over indexes whose documents
+# are kept in the log, see _LogIndex
+from memory_backend import save, save_many, update, new_version, \
+                           current_version, search, scan, resolve, \
+                           metrics, SEARCH_SORT  # noqa
+# assigned, an imported name would clash with _Log.delete
+delete = memory_backend.delete
+
+log = logging.getLogger(__name__)
+
+# directory of the segment files, offset table and checkpoint
+LOG_PATH = os.getenv('LOG_PATH', 'dos_connect_log')
+# bytes written to a segment before a new one is started
+LOG_SEGMENT_SIZE = int(os.getenv('LOG_SEGMENT_SIZE', str(64 * 1024 * 1024)))
+# fsync every write, otherwise only a power loss can lose recent writes
+LOG_FSYNC = os.getenv('LOG_FSYNC', 'False')
+LOG_FSYNC = not (LOG_FSYNC == 'False')
+# seconds between compactions, 0 disables them
+LOG_COMPACT_INTERVAL = float(os.getenv('LOG_COMPACT_INTERVAL', '300'))
+# a closed segment is rewritten when less than this share of
+# LOG_SEGMENT_SIZE is still live
+LOG_COMPACT_RATIO = float(os.getenv('LOG_COMPACT_RATIO', '0.5'))
+
+INDEXES = ['data_objects', 'data_bundles']
+
+# offset table entry of an _id: segment, length, offset.
+# segment 0 is no document, entry 0 holds the highest _id as its offset
+_SLOT = struct.Struct('<IIQ')
+
+
+class _Log(object):
+    """
+    documents appended to numbered segment files, one record per line,
+    located through a memory mapped table indexed by _id.
+    segments up to the checkpoint are reflected in the table, later
+    ones are replayed into it on startup
+    """
+
+    def __init__(self, path):
+        super(_Log, self).__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        table_path = os.path.join(path, 'offsets')
+        if not os.path.exists(table_path):
+            with open(table_path, 'wb') as table_file:
+                table_file.truncate(_SLOT.size * 1024)
+        self.table_file = open(table_path, 'r+b')
+        self.table = mmap.mmap(self.table_file.fileno(), 0)
+        self.readers = {}       # segment -> file
+        self.live = {}          # segment -> bytes of current records
+        self.checkpoint = 0
+        checkpoint_path = os.path.join(path, 'checkpoint')
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as checkpoint_file:
+                self.checkpoint = int(checkpoint_file.read())
+        self.recover()
+        # never append to a segment the checkpoint may cover
+        self.active = max(self.segments() + [self.checkpoint]) + 1
+        self.writer = open(self._segment_path(self.active), 'ab')
+        self.writer.seek(0, os.SEEK_END)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '{:08d}.log'.format(segment))
+
+    def segments(self):
+        """ segment numbers, oldest first """
+        return sorted(int(os.path.basename(p)[:-4]) for p in
+                      glob.glob(os.path.join(self.path, '*.log')))
+
+    @property
+    def max_id(self):
+        return _SLOT.unpack_from(self.table, 0)[2]
+
+    def slot(self, _id):
+        """ (segment, length, offset) of _id, or None """
+        position = _id * _SLOT.size
+        if position + _SLOT.size > len(self.table):
+            return None
+        slot = _SLOT.unpack_from(self.table, position)
+        return slot if slot[0] else None
+
+    def _set_slot(self, _id, segment, length, offset):
+        position = _id * _SLOT.size
+        if position + _SLOT.size > len(self.table):
+            size = max(len(self.table) * 2, position + _SLOT.size)
+            self.table.flush()
+            self.table.close()
+            self.table_file.truncate(size)
+            self.table = mmap.mmap(self.table_file.fileno(), 0)
+        old = self.slot(_id)
+        if old:
+            self.live[old[0]] = self.live.get(old[0], 0) - old[1]
+        if segment:
+            self.live[segment] = self.live.get(segment, 0) + length
+        _SLOT.pack_into(self.table, position, segment, length, offset)
+        if _id > self.max_id:
+            _SLOT.pack_into(self.table, 0, 0, 0, _id)
+
+    def _append(self, record):
+        """ write record to the active segment, return its location """
+        line = json_codec.dumps(record)
+        data = '{:08x} {}\n'.format(zlib.crc32(line) & 0xffffffff, line)
+        location = (self.active, len(data), self.writer.tell())
+        self.writer.write(data)
+        self.writer.flush()
+        if LOG_FSYNC:
+            os.fsync(self.writer.fileno())
+        if self.writer.tell() >= LOG_SEGMENT_SIZE:
+            self._roll()
+        return location
+
+    def _roll(self):
+        """ close the active segment and checkpoint it """
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+        self.table.flush()
+        self._write_checkpoint(self.active)
+        self.active += 1
+        self.writer = open(self._segment_path(self.active), 'ab')
+
+    def _write_checkpoint(self, segment):
+        checkpoint_path = os.path.join(self.path, 'checkpoint')
+        with open(checkpoint_path + '.tmp', 'w') as checkpoint_file:
+            checkpoint_file.write(str(segment))
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(checkpoint_path + '.tmp', checkpoint_path)
+        self.checkpoint = segment
+
+    def put(self, index, _id, key, doc):
+        record = {'index': index, '_id': _id, 'key': key,
+                  'doc': dict((k, v) for k, v in doc.items() if k != 'meta')}
+        with self.lock:
+            self._set_slot(_id, *self._append(record))
+
+    def delete(self, index, _id):
+        with self.lock:
+            self._append({'index': index, '_id': _id, 'deleted': True})
+            self._set_slot(_id, 0, 0, 0)
+
+    def _read(self, segment, length, offset):
+        """ the record at a location, None if it is not intact """
+        reader = self.readers.get(segment, None)
+        if reader is None:
+            reader = self.readers[segment] = \
+                open(self._segment_path(segment), 'rb')
+        reader.seek(offset)
+        return _decode(reader.read(length))
+
+    def read(self, _id):
+        """ the record of _id, or None """
+        with self.lock:
+            slot = self.slot(_id)
+            if slot is None:
+                return None
+            return self._read(*slot)
+
+    def records(self, segment):
+        """
+        yield (offset, length, record) of a segment in order,
+        record is None where the segment stops being intact
+        """
+        offset = 0
+        with open(self._segment_path(segment), 'rb') as segment_file:
+            for data in segment_file:
+                record = _decode(data)
+                yield offset, len(data), record
+                if record is None:
+                    return
+                offset += len(data)
+
+    def recover(self):
+        """ replay the segments after the checkpoint into the table """
+        for segment in self.segments():
+            if segment <= self.checkpoint:
+                continue
+            for offset, length, record in self.records(segment):
+                if record is None:
+                    # torn write of a crash, drop it
+                    log.warning('truncating segment {} at {}'
+                                .format(segment, offset))
+                    with open(self._segment_path(segment), 'r+b') as torn:
+                        torn.truncate(offset)
+                    break
+                if record.get('deleted', False):
+                    self._set_slot(record['_id'], 0, 0, 0)
+                else:
+                    self._set_slot(record['_id'], segment, length, offset)
+
+    def documents(self):
+        """ yield (_id, record) of every document, _id ascending """
+        self.live = {}
+        for _id in xrange(1, self.max_id + 1):
+            slot = self.slot(_id)
+            if slot is None:
+                continue
+            record = self._read(*slot)
+            if record is None or record['_id'] != _id:
+                # written after the last fsync and lost
+                log.warning('lost document {}'.format(_id))
+                _SLOT.pack_into(self.table, _id * _SLOT.size, 0, 0, 0)
+                continue
+            self.live[slot[0]] = self.live.get(slot[0], 0) + slot[1]
+            yield _id, record
+
+    def compact(self):
+        """
+        rewrite the current records of mostly superseded segments
+        to the active one and remove them
+        """
+        for segment in self.segments():
+            if segment >= self.active:
+                continue
+            if self.live.get(segment, 0) >= \
+                    LOG_SEGMENT_SIZE * LOG_COMPACT_RATIO:
+                continue
+            moved = 0
+            for offset, length, record in self.records(segment):
+                if record is None:
+                    break
+                with self.lock:
+                    # superseded records and tombstones are dropped
+                    if self.slot(record['_id']) == (segment, length, offset):
+                        self._set_slot(record['_id'],
+                                       *self._append(record))
+                        moved += 1
+            with self.lock:
+                self.writer.flush()
+                os.fsync(self.writer.fileno())
+                self.table.flush()
+                reader = self.readers.pop(segment, None)
+                if reader:
+                    reader.close()
+                os.remove(self._segment_path(segment))
+                self.live.pop(segment, None)
+            log.info('compacted segment {}, moved {} documents'
+                     .format(segment, moved))
+
+    def close(self):
+        """ make everything durable, call before exiting """
+        with self.lock:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.table.flush()
+            self._write_checkpoint(self.active)
+
+
+def _decode(data):
+    """ a record line -> record, None if torn or corrupt """
+    if len(data) < 10 or data[8] != ' ' or not data.endswith('\n'):
+        return None
+    line = data[9:-1]
+    try:
+        if int(data[:8], 16) != zlib.crc32(line) & 0xffffffff:
+            return None
+        return json_codec.loads(line)
+    except ValueError:
+        return None
+
+
+class _Documents(object):
+    """
+    the _id -> document mapping of an index, read from and
+    appended to the log, only the _ids are held in memory
+    """
+
+    def __init__(self, index):
+        super(_Documents, self).__init__()
+        self.index = index
+        self.ids = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, _id):
+        return _id in self.ids
+
+    def keys(self):
+        return list(self.ids)
+
+    def get(self, _id, default=None):
+        if _id not in self.ids:
+            return default
+        return _document(_id, _log.read(_id))
+
+    def __getitem__(self, _id):
+        doc = self.get(_id)
+        if doc is None:
+            raise KeyError(_id)
+        return doc
+
+    def __setitem__(self, _id, doc):
+        _log.put(self.index, _id, doc.get('meta', {}).get('key', None), doc)
+        self.ids.add(_id)
+
+    def pop(self, _id):
+        doc = self[_id]
+        _log.delete(self.index, _id)
+        self.ids.discard(_id)
+        return doc
+
+
+def _document(_id, record):
+    """ log record -> document as the memory backend stores it """
+    doc = AttributeDict(record['doc'])
+    # sort is the page cursor, see search(after=)
+    doc.meta = AttributeDict({'id': _id, 'sort': [_id]})
+    if record.get('key', None):
+        doc.meta.key = record['key']
+    return doc
+
+
+class _LogIndex(_Index):
+    """ an _Index whose documents are in the log """
+
+    def __init__(self, index):
+        super(_LogIndex, self).__init__()
+        self.docs = _Documents(index)
+
+    def add(self, _id, doc, key=None):
+        # the key is written with the document
+        if key:
+            doc.meta.key = key
+        super(_LogIndex, self).add(_id, doc, key)
+
+    def restore(self, _id, doc):
+        """ index a document read back from the log """
+        self.docs.ids.add(_id)
+        key = doc.meta.get('key', None)
+        if key:
+            self.keys[key] = _id
+        self.versions.setdefault(doc.get('id', None), []).append(_id)
+        self._index(_id, doc)
+
+
+def _open():
+    """ recover the log and rebuild the lookups of every index """
+    started = time.time()
+    for index in INDEXES:
+        memory_backend.store[index] = _LogIndex(index)
+    for _id, record in _log.documents():
+        index = record['index']
+        if index not in memory_backend.store:
+            memory_backend.store[index] = _LogIndex(index)
+        memory_backend.store[index].restore(_id, _document(_id, record))
+    memory_backend._sequence = itertools.count(_log.max_id + 1)
+    log.info('opened {} in {:.1f}s, {} documents'.format(
+        LOG_PATH, time.time() - started,
+        sum(len(idx) for idx in memory_backend.store.values())))
+
+
+def _compact_loop():
+    while True:
+        time.sleep(LOG_COMPACT_INTERVAL)
+        try:
+            _log.compact()
+        except Exception as e:
+            log.exception(e)
+
+
+_log = _Log(LOG_PATH)
+_open()
+atexit.register(_log.close)
+if LOG_COMPACT_INTERVAL:
+    compactor = threading.Thread(target=_compact_loop, name='log-compaction')
+    compactor.daemon = True
+    compactor.start()
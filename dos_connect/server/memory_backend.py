@@ -4,44 +4,221 @@
 # customize/override for your backend
 
 
+import atexit
+import bisect
+import itertools
 import logging
 import os
+import threading
+import time
 import uuid
 
+from dos_connect import json_codec
 from utils import AttributeDict, now, add_created_timestamps, \
-                  add_updated_timestamps
+                  add_updated_timestamps, document_id, next_version, \
+                  compact, DETERMINISTIC_IDS
 
 
 log = logging.getLogger(__name__)
 
 DEFAULT_PAGE_SIZE = 100
+# order of search hits, newest first. a page cursor holds the _id
+SEARCH_SORT = ('-_id',)
+
+# persist the store, a snapshot plus a log of every change since,
+# both newline delimited json, replayed on startup
+MEMORY_SNAPSHOT_PATH = os.getenv('MEMORY_SNAPSHOT_PATH', None)
+# seconds between snapshots, 0 snapshots only on exit
+MEMORY_SNAPSHOT_INTERVAL = float(os.getenv('MEMORY_SNAPSHOT_INTERVAL', '300'))
+# fsync every change, otherwise only a power loss can lose recent changes
+MEMORY_LOG_FSYNC = os.getenv('MEMORY_LOG_FSYNC', 'False')
+MEMORY_LOG_FSYNC = not (MEMORY_LOG_FSYNC == 'False')
+
+
+class _Index(object):
+    """
+    documents of a single index, keyed by an internal sequence number
+    (exposed as doc.meta.id), with secondary indexes for lookups
+    """
+
+    def __init__(self):
+        self.docs = {}          # _id -> doc
+        self.versions = {}      # id -> [_id, ...] version chain, oldest first
+        self.urls = {}          # url -> set(_id)
+        self.checksums = {}     # checksum -> set(_id)
+        self.aliases = {}       # alias -> set(_id)
+        self.current = set()    # _id of current documents
+        self.current_order = []  # the same _ids ascending, for paging
+        self.keys = {}          # document_id -> _id, see DETERMINISTIC_IDS
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, _id, doc, key=None):
+        """ store doc and index it, key is its document_id if any """
+        self.docs[_id] = doc
+        if key:
+            self.keys[key] = _id
+            doc.meta.key = key
+        self.versions.setdefault(doc.get('id', None), []).append(_id)
+        self._index(_id, doc)
+
+    def remove(self, _id):
+        """ drop doc and its index entries """
+        doc = self.docs.pop(_id)
+        self._unindex(_id, doc)
+        self.keys.pop(doc.meta.get('key', None), None)
+        chain = self.versions.get(doc.get('id', None), [])
+        if _id in chain:
+            chain.remove(_id)
+        if not chain:
+            self.versions.pop(doc.get('id', None), None)
+        return doc
+
+    def reindex(self, _id, old_doc, new_doc):
+        """ refresh secondary indexes after a partial update """
+        self._unindex(_id, old_doc)
+        self.docs[_id] = new_doc
+        self._index(_id, new_doc)
+
+    def _keys(self, doc):
+        """ yield (postings, value) for each indexed value of doc """
+        for url in doc.get('urls', None) or []:
+            yield self.urls, url.get('url', None)
+        for checksum in doc.get('checksums', None) or []:
+            yield self.checksums, checksum.get('checksum', None)
+        for alias in doc.get('aliases', None) or []:
+            yield self.aliases, alias
+
+    def _index(self, _id, doc):
+        for postings, value in self._keys(doc):
+            postings.setdefault(value, set()).add(_id)
+        if doc.get('current', None) and _id not in self.current:
+            self.current.add(_id)
+            if not self.current_order or _id > self.current_order[-1]:
+                self.current_order.append(_id)
+            else:
+                bisect.insort(self.current_order, _id)
+
+    def _unindex(self, _id, doc):
+        for postings, value in self._keys(doc):
+            ids = postings.get(value, None)
+            if ids is not None:
+                ids.discard(_id)
+                if not ids:
+                    del postings[value]
+        if _id in self.current:
+            self.current.discard(_id)
+            del self.current_order[
+                bisect.bisect_left(self.current_order, _id)]
+
+    def postings(self, name):
+        """ value -> _ids index of the property name """
+        return {'id': self.versions, 'checksum': self.checksums,
+                'alias': self.aliases, 'url': self.urls}[name]
+
+    def ascending(self, ids):
+        """ the _ids of a lookup, sorted """
+        if ids is self.current:
+            return self.current_order
+        return sorted(ids)
+
+    def lookup(self, properties):
+        """
+        return the set of _id matching all properties, narrowing on the
+        most selective secondary index available.
+        the set may be the index's own, copy it before changing the index
+        """
+        candidates = []
+        if 'id' in properties:
+            candidates.append(set(self.versions.get(properties.id, [])))
+        if 'alias' in properties:
+            candidates.append(self.aliases.get(properties.alias, set()))
+        if 'checksum' in properties:
+            candidates.append(
+                self.checksums.get(properties.checksum['checksum'], set()))
+        if 'url' in properties:
+            candidates.append(self.urls.get(properties.url, set()))
+        if properties.get('current', None) is True:
+            candidates.append(self.current)
+
+        if candidates:
+            candidates.sort(key=len)
+            hits = candidates[0]
+            if len(candidates) > 1:
+                hits = hits.intersection(*candidates[1:])
+        else:
+            hits = set(self.docs.keys())
+
+        # remaining properties are plain equality filters
+        indexed = ['id', 'alias', 'checksum', 'url']
+        if properties.get('current', None) is True:
+            # answered by self.current, no need to load every document
+            indexed.append('current')
+        filters = [(k, v) for k, v in properties.items() if k not in indexed]
+        if filters:
+            hits = set(_id for _id in hits
+                       if all(self.docs[_id].get(k, None) == v
+                              for k, v in filters))
+        return hits
+
 
 store = AttributeDict({})
+_lock = threading.RLock()
+_sequence = itertools.count(1)
+
+
+def _get_index(index):
+    """ get or create the named index """
+    if index not in store:
+        store[index] = _Index()
+    return store[index]
 
 
 def save(doc, index='data_objects'):
     """
     save the body in the index, ensure version and id set
     """
-    doc = AttributeDict(doc)
-    version = doc.get('version', None)
-    if not version:
-        doc['version'] = now()
+    doc = compact(AttributeDict(doc))
     if not doc.get('id', None):
         temp_id = str(uuid.uuid4())
         doc['id'] = temp_id
+    # hash before defaulting version, so a resubmission matches
+    key = document_id(doc) if DETERMINISTIC_IDS else None
+    version = doc.get('version', None)
+    if not version:
+        doc['version'] = now()
 
-    if _is_duplicate(doc, index):
-        raise Exception("duplicate document")
-
-    if index not in store:
-        store[index] = []
-    doc.meta = AttributeDict({'id': doc.id})
-    store[index].append(doc)
+    with _lock:
+        idx = _get_index(index)
+        if key and key in idx.keys:
+            raise Exception("duplicate document")
+        if not key and _is_duplicate(doc, index):
+            raise Exception("duplicate document")
+        _id = next(_sequence)
+        # sort is the page cursor, see search(after=)
+        doc.meta = AttributeDict({'id': _id, 'sort': [_id]})
+        idx.add(_id, doc, key)
+        _journal(index, _id, doc)
     log.info(doc.id)
     return doc
 
 
+def save_many(docs, index='data_objects'):
+    """
+    save many bodies in the index,
+    return list of (doc, error) in order, error is None on success
+    """
+    results = []
+    with _lock:
+        for doc in docs:
+            try:
+                results.append((save(doc, index), None))
+            except Exception as e:
+                results.append((AttributeDict(doc), str(e)))
+    return results
+
+
 def _is_duplicate(new_doc, index='data_objects'):
     """ check if already stored.
         True if new_doc has same checksums and urls,
@@ -52,24 +229,22 @@ def _is_duplicate(new_doc, index='data_objects'):
     n = None
     if index not in store:
         return False
-    for doc in store[index]:
-        if new_doc.get('id', n) == doc.get('id', n):
-            if new_doc.get('aliases', n) == doc.get('aliases', n):
-                if new_doc.get('checksums', t) == doc.get('checksums', f):
-                    if new_doc.get('urls', t) == doc.get('urls', f):
-                        return True
+    idx = store[index]
+    for _id in idx.versions.get(new_doc.get('id', n), []):
+        doc = idx.docs[_id]
+        if new_doc.get('aliases', n) == doc.get('aliases', n):
+            if new_doc.get('checksums', t) == doc.get('checksums', f):
+                if new_doc.get('urls', t) == doc.get('urls', f):
+                    return True
     return False
 
 
 def _get(_id, current=None, index='data_objects'):
-    """ get by id, optionally current """
-    for doc in store[index]:
-        if doc.id == _id:
-            if current:
-                if doc.current == current:
-                    return doc
-            else:
-                return doc
+    """ get by internal _id, optionally current """
+    doc = store[index].docs.get(_id, None)
+    if doc and current and doc.get('current', None) != current:
+        return None
+    return doc
 
 
 def update(_id, doc, index='data_objects'):
@@ -91,55 +266,64 @@ def update(_id, doc, index='data_objects'):
             else:
                 a[key] = b[key]
         return a
-    store[index].append(AttributeDict(merge(_get(_id, index=index, current=True), doc)))  # noqa
+    with _lock:
+        old_doc = _get(_id, index=index)
+        if old_doc is None:
+            raise Exception("document not found {}".format(_id))
+        # merged into a copy, old_doc may have been handed out
+        new_doc = merge(compact(old_doc), compact(doc))
+        store[index].reindex(_id, old_doc, new_doc)
+        _journal(index, _id, new_doc)
+
+
+def new_version(id, doc, index='data_objects'):
+    """
+    save doc as the current version of id and retire the previous one,
+    in one step under the lock
+    """
+    with _lock:
+        idx = _get_index(index)
+        current = [_id for _id in idx.versions.get(id, [])
+                   if _id in idx.current]
+        if not current:
+            raise Exception("document not found {}".format(id))
+        old_doc = idx.docs[current[-1]]
+        doc = save(next_version(old_doc, AttributeDict(doc)), index)
+        update(old_doc.meta.id, {'current': False}, index)
+    return doc
+
+
+def current_version(id, index='data_objects'):
+    """
+    version of the current document of id, or None,
+    from the version chain without copying the document
+    """
+    with _lock:
+        idx = _get_index(index)
+        for _id in reversed(idx.versions.get(id, [])):
+            if _id in idx.current:
+                return idx.docs[_id].get('version', None)
+    return None
 
 
 def search(properties, index='data_objects', size=DEFAULT_PAGE_SIZE,
-           offset=0, include_total=False):
+           offset=0, include_total=False, after=None):
     """
     get all objects that match
     if include_total set, return tuple (hit, total)
+    if after set, start after the hit whose meta.sort it is
     """
-    hits = []
-    if index not in store:
-        store[index] = []
-    for doc in store[index]:
-        if 'alias' in properties and 'aliases' in doc:
-            if properties.alias in doc.aliases:
-                hits.append(doc)
-                continue
-        if 'checksum' in properties:
-            added = False
-            for checksum in doc.checksums:
-                if properties.checksum['checksum'] == checksum['checksum']:
-                    print 'added checksum', properties.checksum['checksum']
-                    hits.append(doc)
-                    added = True
-            if added:
-                continue
-        if 'url' in properties:
-            added = False
-            for url in doc.urls:
-                if properties.url == url['url']:
-                    hits.append(doc)
-                    added = True
-            if added:
-                continue
-        if 'id' in properties:
-            if properties.id == doc.id and doc.current:
-                hits.append(doc)
-                continue
-        if 'current' in properties and len(properties) == 1:
-            if doc.current:
-                hits.append(doc)
-                continue
-        if len(properties.keys()) == 0:
-            hits.append(doc)
-            continue
-
-    total = len(hits)
-
-    for _, hit in enumerate(hits):
+    with _lock:
+        idx = _get_index(index)
+        keys = idx.ascending(idx.lookup(properties))
+        total = len(keys)
+        # newest first, the page ends before the cursor
+        end = bisect.bisect_left(keys, after[0]) if after else total
+        end = max(end - offset, 0)
+        page = reversed(keys[max(end - size, 0):end])
+        hits = [idx.docs[_id] for _id in page]
+
+    for hit in hits:
         # for paging return the total number of matches
         if include_total:
             yield (hit, total)
@@ -147,16 +331,49 @@ def search(properties, index='data_objects', size=DEFAULT_PAGE_SIZE,
             yield hit
 
 
+def resolve(keys, index='data_objects'):
+    """
+    current objects having each key, keys maps a property name
+    (id, checksum, alias or url) to a list of values,
+    return {name: {value: [doc, ...]}}
+    """
+    resolved = {}
+    with _lock:
+        idx = _get_index(index)
+        for name, values in keys.items():
+            postings = idx.postings(name)
+            resolved[name] = dict(
+                (value, [idx.docs[_id]
+                         for _id in sorted(postings.get(value, []))
+                         if _id in idx.current])
+                for value in values)
+    return resolved
+
+
+def scan(properties, index='data_objects'):
+    """
+    yield every object that matches, oldest first,
+    the lock is only held while collecting matches
+    """
+    with _lock:
+        keys = sorted(_get_index(index).lookup(properties))
+    docs = store[index].docs
+    for _id in keys:
+        doc = docs.get(_id, None)
+        # deleted since the scan started
+        if doc is not None:
+            yield doc
+
+
 def delete(properties, index='data_objects'):
     """
     delete item from index
     """
-    indexes = []
-    for i, doc in enumerate(store[index]):
-        if doc.id == properties.id:
-            indexes.append(i)
-    for i in sorted(indexes, reverse=True):
-        del store[index][i]
+    with _lock:
+        idx = _get_index(index)
+        for _id in list(idx.lookup(properties)):
+            idx.remove(_id)
+            _journal(index, _id)
 
 
 def metrics(indexes=['data_objects', 'data_bundles']):
@@ -168,3 +385,140 @@ def metrics(indexes=['data_objects', 'data_bundles']):
             {'name': index, 'count': len(store.get(index, []))}
             ) for index in indexes
         ]
+
+
+# persistence, see MEMORY_SNAPSHOT_PATH
+
+_log_file = None
+_snapshot_lock = threading.Lock()
+
+
+def _record(index, _id, doc=None):
+    """ snapshot or log line storing doc as _id, removing _id if no doc """
+    record = {'index': index, '_id': _id}
+    if doc is None:
+        record['removed'] = True
+    else:
+        record['doc'] = dict((k, v) for k, v in doc.items() if k != 'meta')
+        record['key'] = doc.meta.get('key', None)
+    return json_codec.dumps(record) + '\n'
+
+
+def _journal(index, _id, doc=None):
+    """ log a change, call with the lock held """
+    if _log_file is None:
+        return
+    _log_file.write(_record(index, _id, doc))
+    _log_file.flush()
+    if MEMORY_LOG_FSYNC:
+        os.fsync(_log_file.fileno())
+
+
+def _restore(record):
+    """ apply a snapshot or log line """
+    idx = _get_index(record['index'])
+    _id = record['_id']
+    if record.get('removed', False):
+        if _id in idx.docs:
+            idx.remove(_id)
+        return
+    doc = compact(AttributeDict(record['doc']))
+    doc.meta = AttributeDict({'id': _id, 'sort': [_id]})
+    if record.get('key', None):
+        doc.meta.key = record['key']
+    if _id in idx.docs:
+        idx.reindex(_id, idx.docs[_id], doc)
+    else:
+        idx.add(_id, doc, record.get('key', None))
+
+
+def _replay(path):
+    """ apply every line of path, a torn last line is cut off """
+    count = 0
+    offset = 0
+    with open(path, 'r+b') as replay_file:
+        for line in replay_file:
+            try:
+                record = json_codec.loads(line) \
+                    if line.endswith('\n') else None
+            except ValueError:
+                record = None
+            if record is None:
+                log.warning('truncating {} at {}'.format(path, offset))
+                replay_file.truncate(offset)
+                break
+            _restore(record)
+            offset += len(line)
+            count += 1
+    return count
+
+
+def snapshot():
+    """
+    write every document to MEMORY_SNAPSHOT_PATH and start a new log,
+    the lock is only held to collect the documents
+    """
+    global _log_file
+    log_path = MEMORY_SNAPSHOT_PATH + '.log'
+    with _snapshot_lock:
+        with _lock:
+            docs = [(index, _id, idx.docs[_id])
+                    for index, idx in store.items()
+                    for _id in sorted(idx.docs.keys())]
+            # changes from here on go to a new log, the previous one
+            # is kept until the snapshot is complete
+            _log_file.close()
+            if os.path.exists(log_path + '.1'):
+                # the last snapshot failed, keep both logs
+                with open(log_path + '.1', 'ab') as previous:
+                    with open(log_path, 'rb') as current:
+                        previous.write(current.read())
+                os.remove(log_path)
+            else:
+                os.rename(log_path, log_path + '.1')
+            _log_file = open(log_path, 'ab')
+        with open(MEMORY_SNAPSHOT_PATH + '.tmp', 'wb') as snapshot_file:
+            for index, _id, doc in docs:
+                snapshot_file.write(_record(index, _id, doc))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.rename(MEMORY_SNAPSHOT_PATH + '.tmp', MEMORY_SNAPSHOT_PATH)
+        os.remove(log_path + '.1')
+    log.info('snapshot of {} documents'.format(len(docs)))
+
+
+def _snapshot_loop():
+    while True:
+        time.sleep(MEMORY_SNAPSHOT_INTERVAL)
+        try:
+            snapshot()
+        except Exception as e:
+            log.exception(e)
+
+
+def _open():
+    """ load the snapshot and replay the logs written since """
+    global _log_file, _sequence
+    started = time.time()
+    log_path = MEMORY_SNAPSHOT_PATH + '.log'
+    count = 0
+    with _lock:
+        for path in [MEMORY_SNAPSHOT_PATH, log_path + '.1', log_path]:
+            if os.path.exists(path):
+                count += _replay(path)
+        _sequence = itertools.count(
+            max([max(idx.docs.keys() or [0]) for idx in store.values()] +
+                [0]) + 1)
+        _log_file = open(log_path, 'ab')
+    log.info('restored {} records from {} in {:.1f}s'.format(
+        count, MEMORY_SNAPSHOT_PATH, time.time() - started))
+
+
+if MEMORY_SNAPSHOT_PATH:
+    _open()
+    atexit.register(snapshot)
+    if MEMORY_SNAPSHOT_INTERVAL:
+        snapshotter = threading.Thread(target=_snapshot_loop,
+                                       name='memory-snapshot')
+        snapshotter.daemon = True
+        snapshotter.start()
@@ -0,0 +1,398 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# customize/override for your backend
+
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+
+from dos_connect import json_codec
+from utils import AttributeDict, now, document_id, next_version, \
+                  DETERMINISTIC_IDS
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 100
+# order of search hits, newest first. a page cursor holds the _id
+SEARCH_SORT = ('-_id',)
+
+# the database file, created if missing
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'dos_connect.sqlite')
+# seconds a write waits for another process's transaction
+SQLITE_TIMEOUT = float(os.getenv('SQLITE_TIMEOUT', '30'))
+# prepared statements kept per connection
+SQLITE_STATEMENT_CACHE = int(os.getenv('SQLITE_STATEMENT_CACHE', '200'))
+# NORMAL is durable in WAL mode except on power loss, FULL syncs every commit
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+# keys per IN (...) query, below sqlite's 999 variable limit
+SQLITE_CHUNK_SIZE = int(os.getenv('SQLITE_CHUNK_SIZE', '500'))
+
+INDEXES = ['data_objects', 'data_bundles']
+
+# documents of every index, _id orders them by insertion,
+# urls, checksums and aliases are the secondary indexes
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    _id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idx TEXT NOT NULL,
+    id TEXT NOT NULL,
+    version TEXT,
+    current INTEGER NOT NULL DEFAULT 0,
+    key TEXT,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_id ON documents (idx, id);
+CREATE INDEX IF NOT EXISTS documents_current ON documents (idx, current);
+CREATE UNIQUE INDEX IF NOT EXISTS documents_key ON documents (idx, key);
+CREATE TABLE IF NOT EXISTS urls (_id INTEGER NOT NULL, url TEXT);
+CREATE INDEX IF NOT EXISTS urls_url ON urls (url, _id);
+CREATE INDEX IF NOT EXISTS urls_id ON urls (_id);
+CREATE TABLE IF NOT EXISTS checksums (_id INTEGER NOT NULL, checksum TEXT);
+CREATE INDEX IF NOT EXISTS checksums_checksum ON checksums (checksum, _id);
+CREATE INDEX IF NOT EXISTS checksums_id ON checksums (_id);
+CREATE TABLE IF NOT EXISTS aliases (_id INTEGER NOT NULL, alias TEXT);
+CREATE INDEX IF NOT EXISTS aliases_alias ON aliases (alias, _id);
+CREATE INDEX IF NOT EXISTS aliases_id ON aliases (_id);
+"""
+
+# property name -> (table, column) of its secondary index
+POSTINGS = {
+    'url': ('urls', 'url'),
+    'checksum': ('checksums', 'checksum'),
+    'alias': ('aliases', 'alias'),
+}
+
+# one connection per thread, sqlite connections are not shared
+_local = threading.local()
+
+
+def _connection():
+    """ this thread's connection, opened on first use """
+    db = getattr(_local, 'db', None)
+    if db is None:
+        # isolation_level None, transactions are begun explicitly
+        db = sqlite3.connect(SQLITE_PATH, timeout=SQLITE_TIMEOUT,
+                             isolation_level=None,
+                             cached_statements=SQLITE_STATEMENT_CACHE)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous={}'.format(SQLITE_SYNCHRONOUS))
+        _local.db = db
+    return db
+
+
+@contextlib.contextmanager
+def _transaction():
+    """ write transaction, takes the write lock up front """
+    db = _connection()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    db.execute('COMMIT')
+
+
+def _create_schema():
+    _connection().executescript(SCHEMA)
+
+
+_create_schema()
+log.info('sqlite backend {}'.format(SQLITE_PATH))
+
+
+def _load(_id, text):
+    """ stored row -> document """
+    doc = AttributeDict(json_codec.loads(text))
+    # sort is the page cursor, see search(after=)
+    doc.meta = AttributeDict({'id': _id, 'sort': [_id]})
+    return doc
+
+
+def _dump(doc):
+    return json_codec.dumps(
+        dict((k, v) for k, v in doc.items() if k != 'meta'))
+
+
+def _keys(doc):
+    """ yield (property name, value) for each indexed value of doc """
+    for url in doc.get('urls', None) or []:
+        yield 'url', url.get('url', None)
+    for checksum in doc.get('checksums', None) or []:
+        yield 'checksum', checksum.get('checksum', None)
+    for alias in doc.get('aliases', None) or []:
+        yield 'alias', alias
+
+
+def _index(db, _id, doc):
+    for name, value in _keys(doc):
+        table, column = POSTINGS[name]
+        db.execute('INSERT INTO {} (_id, {}) VALUES (?, ?)'
+                   .format(table, column), (_id, value))
+
+
+def _unindex(db, _id):
+    for table, _ in POSTINGS.values():
+        db.execute('DELETE FROM {} WHERE _id = ?'.format(table), (_id,))
+
+
+def _where(properties, index):
+    """ sql condition and parameters matching all properties """
+    clauses = ['idx = ?']
+    params = [index]
+    for k, v in properties.items():
+        if k in ['id', 'version']:
+            clauses.append('{} = ?'.format(k))
+        elif k == 'current':
+            v = 1 if v else 0
+            clauses.append('current = ?')
+        elif k in POSTINGS:
+            if k == 'checksum':
+                v = v['checksum']
+            clauses.append('_id IN (SELECT _id FROM {} WHERE {} = ?)'
+                           .format(*POSTINGS[k]))
+        else:
+            raise Exception('unsupported property {}'.format(k))
+        params.append(v)
+    return ' AND '.join(clauses), params
+
+
+def _insert(db, doc, index):
+    """ store doc in the open transaction, ensure version and id set """
+    doc = AttributeDict(doc)
+    if not doc.get('id', None):
+        temp_id = str(uuid.uuid4())
+        doc['id'] = temp_id
+    # hash before defaulting version, so a resubmission matches
+    key = document_id(doc) if DETERMINISTIC_IDS else None
+    version = doc.get('version', None)
+    if not version:
+        doc['version'] = now()
+    if not key and _is_duplicate(db, doc, index):
+        raise Exception("duplicate document")
+    try:
+        cursor = db.execute(
+            'INSERT INTO documents (idx, id, version, current, key, doc) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (index, doc.id, doc.version, 1 if doc.get('current', None) else 0,
+             key, _dump(doc)))
+    except sqlite3.IntegrityError:
+        # the unique key index
+        raise Exception("duplicate document")
+    _id = cursor.lastrowid
+    _index(db, _id, doc)
+    doc.meta = AttributeDict({'id': _id, 'sort': [_id]})
+    return doc
+
+
+def save(doc, index='data_objects'):
+    """
+    save the body in the index, ensure version and id set
+    """
+    with _transaction() as db:
+        doc = _insert(db, doc, index)
+    log.info(doc.id)
+    return doc
+
+
+def save_many(docs, index='data_objects'):
+    """
+    save many bodies in the index in one transaction,
+    return list of (doc, error) in order, error is None on success
+    """
+    results = []
+    with _transaction() as db:
+        for doc in docs:
+            # a failed doc is rolled back alone
+            db.execute('SAVEPOINT doc')
+            try:
+                results.append((_insert(db, doc, index), None))
+            except Exception as e:
+                db.execute('ROLLBACK TO doc')
+                results.append((AttributeDict(doc), str(e)))
+            db.execute('RELEASE doc')
+    return results
+
+
+def _is_duplicate(db, new_doc, index='data_objects'):
+    """ check if already stored.
+        True if new_doc has same checksums and urls,
+            and optionally id and aliases
+    """
+    t = True
+    f = False
+    n = None
+    rows = db.execute('SELECT doc FROM documents WHERE idx = ? AND id = ?',
+                      (index, new_doc.get('id', n)))
+    for (text,) in rows:
+        doc = json_codec.loads(text)
+        if new_doc.get('aliases', n) == doc.get('aliases', n):
+            if new_doc.get('checksums', t) == doc.get('checksums', f):
+                if new_doc.get('urls', t) == doc.get('urls', f):
+                    return True
+    return False
+
+
+def _merge(a, b):
+    "merges b into a"
+    for key in b:
+        if key in a and isinstance(a[key], dict) and isinstance(b[key], dict):
+            _merge(a[key], b[key])
+        else:
+            a[key] = b[key]
+    return a
+
+
+def _update(db, _id, doc, index):
+    row = db.execute('SELECT doc FROM documents WHERE _id = ? AND idx = ?',
+                     (_id, index)).fetchone()
+    if row is None:
+        raise Exception("document not found {}".format(_id))
+    new_doc = AttributeDict(_merge(json_codec.loads(row[0]), doc))
+    db.execute('UPDATE documents SET version = ?, current = ?, doc = ? '
+               'WHERE _id = ?',
+               (new_doc.get('version', None),
+                1 if new_doc.get('current', None) else 0,
+                _dump(new_doc), _id))
+    _unindex(db, _id)
+    _index(db, _id, new_doc)
+
+
+def update(_id, doc, index='data_objects'):
+    """
+    partial update using the contructed _id
+    """
+    with _transaction() as db:
+        _update(db, _id, doc, index)
+
+
+def new_version(id, doc, index='data_objects'):
+    """
+    save doc as the current version of id and retire the previous one,
+    in one transaction
+    """
+    with _transaction() as db:
+        row = db.execute('SELECT _id, doc FROM documents '
+                         'WHERE idx = ? AND id = ? AND current = 1 '
+                         'ORDER BY _id DESC LIMIT 1', (index, id)).fetchone()
+        if row is None:
+            raise Exception("document not found {}".format(id))
+        old_doc = _load(*row)
+        doc = _insert(db, next_version(old_doc, AttributeDict(doc)), index)
+        _update(db, old_doc.meta.id, {'current': False}, index)
+    return doc
+
+
+def current_version(id, index='data_objects'):
+    """
+    version of the current document of id, or None,
+    read from the index without loading the document
+    """
+    row = _connection().execute(
+        'SELECT version FROM documents '
+        'WHERE idx = ? AND id = ? AND current = 1 '
+        'ORDER BY _id DESC LIMIT 1', (index, id)).fetchone()
+    return row[0] if row else None
+
+
+def search(properties, index='data_objects', size=DEFAULT_PAGE_SIZE,
+           offset=0, include_total=False, after=None):
+    """
+    get all objects that match
+    if include_total set, return tuple (hit, total)
+    if after set, start after the hit whose meta.sort it is
+    """
+    db = _connection()
+    where, params = _where(properties, index)
+    total = None
+    if include_total:
+        total = db.execute('SELECT COUNT(*) FROM documents WHERE ' + where,
+                           params).fetchone()[0]
+    if after:
+        where += ' AND _id < ?'
+        params = params + [after[0]]
+    # newest first
+    rows = db.execute('SELECT _id, doc FROM documents WHERE ' + where +
+                      ' ORDER BY _id DESC LIMIT ? OFFSET ?',
+                      params + [size, offset]).fetchall()
+    for row in rows:
+        hit = _load(*row)
+        # for paging return the total number of matches
+        if include_total:
+            yield (hit, total)
+        else:
+            yield hit
+
+
+def scan(properties, index='data_objects'):
+    """
+    yield every object that matches, oldest first,
+    rows are read from the cursor as they are consumed
+    """
+    where, params = _where(properties, index)
+    rows = _connection().execute('SELECT _id, doc FROM documents WHERE ' +
+                                 where + ' ORDER BY _id', params)
+    for row in rows:
+        yield _load(*row)
+
+
+def resolve(keys, index='data_objects'):
+    """
+    current objects having each key, keys maps a property name
+    (id, checksum, alias or url) to a list of values,
+    return {name: {value: [doc, ...]}}
+    """
+    db = _connection()
+    resolved = {}
+    for name, values in keys.items():
+        matches = resolved[name] = dict((value, []) for value in values)
+        values = list(matches.keys())
+        if name == 'id':
+            sql = 'SELECT id, _id, doc FROM documents ' \
+                  'WHERE idx = ? AND current = 1 AND id IN ({}) ' \
+                  'ORDER BY _id'
+        else:
+            table, column = POSTINGS[name]
+            sql = 'SELECT DISTINCT p.{1}, d._id, d.doc ' \
+                  'FROM {0} p JOIN documents d ON d._id = p._id ' \
+                  'WHERE d.idx = ? AND d.current = 1 ' \
+                  'AND p.{1} IN ({{}}) ORDER BY d._id'.format(table, column)
+        for start in range(0, len(values), SQLITE_CHUNK_SIZE):
+            chunk = values[start:start + SQLITE_CHUNK_SIZE]
+            rows = db.execute(sql.format(', '.join('?' * len(chunk))),
+                              [index] + chunk)
+            for value, _id, text in rows:
+                matches[value].append(_load(_id, text))
+    return resolved
+
+
+def delete(properties, index='data_objects'):
+    """
+    delete item from index
+    """
+    where, params = _where(properties, index)
+    with _transaction() as db:
+        ids = [row[0] for row in
+               db.execute('SELECT _id FROM documents WHERE ' + where,
+                          params).fetchall()]
+        for _id in ids:
+            _unindex(db, _id)
+            db.execute('DELETE FROM documents WHERE _id = ?', (_id,))
+
+
+def metrics(indexes=INDEXES):
+    """
+    return document counts
+    """
+    db = _connection()
+    return [
+        AttributeDict(
+            {'name': index,
+             'count': db.execute('SELECT COUNT(*) FROM documents '
+                                 'WHERE idx = ?', (index,)).fetchone()[0]}
+            ) for index in indexes
+        ]
@@ -1,19 +1,83 @@
 #!/usr/bin/python
 # -*- encoding: utf-8 -*-
 
+import collections
 import datetime
+import hashlib
 import json
+import os
+import threading
+import time
 
 
 class AttributeDict(dict):
     """
     use dot notation for dicts
     """
+    # attributes are items, so no per instance __dict__
+    __slots__ = ()
     __getattr__ = dict.__getitem__
     __setattr__ = dict.__setitem__
 
     def to_dict(self):
-        return json.loads(json.dumps(self))
+        # a copy the caller may change, nested AttributeDicts (meta)
+        # become dicts, encoders probe attributes and expect
+        # AttributeError, not KeyError
+        return _copy(self)
+
+
+def _copy(value):
+    """ copy of nested dicts and lists, strings and numbers are shared """
+    if isinstance(value, dict):
+        return dict((k, _copy(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+# distinct strings shared between documents, see compact()
+MAX_INTERNED_STRINGS = int(os.getenv('MAX_INTERNED_STRINGS', '100000'))
+# values of these keys repeat across documents, e.g. checksum types,
+# event types and bucket names. other metadata values, object keys or
+# etags for example, are mostly unique and would only fill the table
+INTERNED_FIELDS = ['type', 'event_type', 'bucket_name', 'awsRegion',
+                   'location', 'blob_type', 'mime_type']
+_strings = {}
+
+
+def _intern(value):
+    """ the shared copy of a str or unicode value """
+    shared = _strings.get(value, None)
+    if shared is not None:
+        return shared
+    if len(_strings) < MAX_INTERNED_STRINGS:
+        _strings[value] = value
+    return value
+
+
+def compact(value, interned=False):
+    """
+    copy of a document for long term storage, its keys and the string
+    values of INTERNED_FIELDS are shared with other documents
+    """
+    if isinstance(value, dict):
+        copy = value.__class__()
+        for k, v in value.iteritems():
+            if isinstance(k, basestring):
+                k = _intern(k)
+            copy[k] = compact(v, k in INTERNED_FIELDS)
+        return copy
+    if isinstance(value, (list, tuple)):
+        return [compact(v, interned) for v in value]
+    if interned and isinstance(value, basestring):
+        return _intern(value)
+    return value
+
+
+# derive storage ids from content, duplicates are then rejected by the
+# storage engine instead of a search before every write
+DETERMINISTIC_IDS = os.getenv('DETERMINISTIC_IDS', 'False')
+DETERMINISTIC_IDS = not (DETERMINISTIC_IDS == 'False')
 
 
 def now():
@@ -41,3 +105,90 @@ def add_updated_timestamps(doc):
     if 'updated' not in doc:
         doc['updated'] = now()
     return doc
+
+
+def next_version(old_doc, doc):
+    """
+    prepare doc as the current version following old_doc,
+    a backend's stored document or search hit
+    """
+    def _field(name):
+        try:
+            return old_doc[name]
+        except KeyError:
+            return None
+    doc.created = _field('created') or doc.get('created', None)
+    # We need to safely set the version if they provided one that
+    # collides we'll pad it. If they provided a good one, we will
+    # accept it. If they don't provide one, we'll give one.
+    new_version = doc.get('version', None)
+    if not new_version or new_version == _field('version'):
+        doc.version = now()
+    doc.id = old_doc['id']
+    doc.current = True
+    return doc
+
+
+def document_id(doc):
+    """
+    stable storage id, a hash of the canonical id, version,
+    checksums and urls. call before a default version is assigned
+    """
+    canonical = {
+        'id': doc.get('id', None),
+        'version': doc.get('version', None),
+        'checksums': sorted([[c.get('type', None), c.get('checksum', None)]
+                             for c in doc.get('checksums', None) or []]),
+        'urls': sorted([u.get('url', None)
+                        for u in doc.get('urls', None) or []]),
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True)).hexdigest()
+
+
+class TTLCache(object):
+    """
+    thread safe LRU cache whose entries also expire,
+    each entry can carry its own expiry (epoch seconds)
+    """
+
+    def __init__(self, maxsize=1000, ttl=300.0):
+        super(TTLCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """ return live value for key, refresh its recency """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None, expires=None):
+        """ store value until expires, or ttl seconds from now """
+        if expires is None:
+            expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """ drop key if present """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
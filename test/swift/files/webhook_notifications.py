@@ -12,6 +12,9 @@ To configure, in proxy-server.conf:
     paste.filter_factory = swift.common.middleware.webhook_notifications:filter_factory
     kafka_bootstrap = localhost:29092
     kafka_topic = s3-topic
+    # optional, messages are batched and sent in the background
+    kafka_linger_ms = 50
+    kafka_acks = all
 
 Additionally, in pipeline:main, add webhookmiddleware to the pipeline;
 it should be added towards the end to ensure any required environment
@@ -34,6 +37,7 @@ from swift.common.wsgi import make_env, make_pre_authed_env, \
 from swift.common import wsgi
 from swift.common.utils import get_logger
 
+import atexit
 import requests
 import json
 from kafka import KafkaProducer
@@ -206,7 +210,15 @@ def _producer(conf):
 #                                       ssl_certfile=ssl_certfile,
 #                                       ssl_keyfile=ssl_keyfile)
 #         else:
-        _PRODUCER = KafkaProducer(bootstrap_servers=kafka_bootstrap)
+        _PRODUCER = KafkaProducer(
+            bootstrap_servers=kafka_bootstrap,
+            linger_ms=int(conf.get('kafka_linger_ms', 50)),
+            acks=conf.get('kafka_acks', 'all'),
+            retries=int(conf.get('kafka_retries', 3)),
+            max_block_ms=int(conf.get('kafka_max_block_ms', 1000)))
+        # deliver what is still buffered when the proxy stops
+        atexit.register(_PRODUCER.flush,
+                        timeout=float(conf.get('kafka_shutdown_timeout', 30)))
 
     return _PRODUCER
 
@@ -285,13 +297,22 @@ class LoggingNotifier(object):
                 payload = self.to_data_object(payload)
                 key = '{}~{}'.format(payload['urls'][0]['system_metadata']['event_type'],
                                      payload['urls'][0]['url'])
-                producer.send(kafka_topic, key=key, value=json.dumps(payload))
-                producer.flush()
-                self.logger.warn('++++ sent to kafka topic: {}'.format(kafka_topic))
+                # do not wait for the broker on the request path
+                future = producer.send(kafka_topic, key=key,
+                                       value=json.dumps(payload))
+                future.add_callback(self.on_send_success, key)
+                future.add_errback(self.on_send_error, key)
 
         except Exception as e:
             self.logger.exception(e)
 
+    def on_send_success(self, key, record_metadata):
+        self.logger.debug('sent to kafka topic: {} {}'.format(
+            record_metadata.topic, key))
+
+    def on_send_error(self, key, e):
+        self.logger.error('kafka send failed: {} {}'.format(key, e))
+
 
 class WebHookMiddleware(object):
     def __init__(self, app, conf):
@@ -0,0 +1,141 @@
+import argparse
+import threading
+import time
+import pytest
+
+from dos_connect import apps
+
+
+class _Result(object):
+    def __init__(self, status_code, data_object_id=None, msg=None):
+        self.status_code = status_code
+        self.data_object_id = data_object_id
+        self.msg = msg
+
+
+class _Client(object):
+    """ stands in for client_factory(), answers with status_codes """
+
+    def __init__(self, *status_codes):
+        self.status_codes = list(status_codes)
+        self.batches = []
+        self.client = self
+        self.models = self
+
+    def get_model(self, name):
+        return argparse.Namespace
+
+    def CreateDataObjects(self, body):
+        self.batches.append(body.data_objects)
+        status_code = self.status_codes.pop(0)
+        results = [_Result(status_code, data_object_id=data_object,
+                           msg='rejected')
+                   for data_object in body.data_objects]
+        return argparse.Namespace(
+            result=lambda: argparse.Namespace(results=results))
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    """ a batcher that does not back off, closed after the test """
+    monkeypatch.setattr(apps, 'time', argparse.Namespace(
+        time=time.time, sleep=lambda seconds: None))
+    args = argparse.Namespace(batch_size=2, batch_interval=0.1,
+                              batch_queue_size=10, batch_retries=1)
+    batchers = []
+
+    def create(client_factory):
+        monkeypatch.setattr(apps, 'client_factory', client_factory)
+        batchers.append(apps._Batcher(args))
+        return batchers[-1]
+    yield create
+    for b in batchers:
+        # a dead thread would never drain the queue
+        if b.thread.is_alive():
+            b.close()
+
+
+def _flush(b):
+    """ flush, failing instead of hanging if an item is never done """
+    t = threading.Thread(target=b.flush)
+    t.daemon = True
+    t.start()
+    t.join(5)
+    assert not t.is_alive(), 'flush should return'
+
+
+def test_send(batcher):
+    """ batches are sent and sent() is called for each data object """
+    client = _Client(200, 200)
+    b = batcher(lambda args: client)
+    sent = []
+    for data_object in ['a', 'b', 'c']:
+        b.put(data_object, data_object, lambda d=data_object: sent.append(d))
+    _flush(b)
+    assert sorted(sum(client.batches, [])) == ['a', 'b', 'c']
+    assert sorted(sent) == ['a', 'b', 'c']
+
+
+def test_retry(batcher):
+    """ a server error is retried, sent() only after it was accepted """
+    client = _Client(503, 200)
+    b = batcher(lambda args: client)
+    sent = []
+    b.put('a', 'a', lambda: sent.append('a'))
+    _flush(b)
+    assert client.batches == [['a'], ['a']]
+    assert sent == ['a']
+
+
+def test_give_up(batcher):
+    """ after batch_retries the data object is dropped, sent() not called """
+    client = _Client(503, 503, 200)
+    b = batcher(lambda args: client)
+    sent = []
+    b.put('a', 'a', lambda: sent.append('a'))
+    _flush(b)
+    assert client.batches == [['a'], ['a']]
+    assert sent == []
+
+
+def test_rejected(batcher):
+    """ a rejected data object is not retried """
+    client = _Client(400)
+    b = batcher(lambda args: client)
+    sent = []
+    b.put('a', 'a', lambda: sent.append('a'))
+    _flush(b)
+    assert client.batches == [['a']]
+    assert sent == []
+
+
+def test_client_factory_exception(batcher):
+    """ a failing client_factory is retried and does not stop the thread """
+    client = _Client(200)
+    calls = []
+
+    def client_factory(args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise IOError('dos server unreachable')
+        return client
+    b = batcher(client_factory)
+    sent = []
+    b.put('a', 'a', lambda: sent.append('a'))
+    _flush(b)
+    assert b.thread.is_alive()
+    assert client.batches == [['a']]
+    assert sent == ['a']
+
+
+def test_acknowledgement():
+    """ ack once every expected data object was sent and done() called """
+    acked = []
+    acknowledgement = apps.Acknowledgement(lambda: acked.append(True))
+    first = acknowledgement.expect()
+    second = acknowledgement.expect()
+    first()
+    acknowledgement.done()
+    assert acked == []
+    second()
+    assert acked == [True]
@@ -0,0 +1,63 @@
+import base64
+import uuid
+import flask
+import pytest
+
+from dos_connect.server import controllers
+from dos_connect.server import memory_backend
+from dos_connect.server.utils import document_id
+
+
+@pytest.fixture
+def deterministic_ids(monkeypatch):
+    """ controllers on the memory backend with DETERMINISTIC_IDS=True """
+    if controllers.backend is not memory_backend:
+        pytest.skip('BACKEND is not the memory backend')
+    monkeypatch.setattr(memory_backend, 'DETERMINISTIC_IDS', True)
+    with flask.Flask(__name__).test_request_context():
+        yield
+
+
+def _data_object(id):
+    return {'id': id,
+            'checksums': [{'checksum': id, 'type': 'md5'}],
+            'urls': [{'url': 's3://bucket/{}'.format(id)}]}
+
+
+def test_create_twice(deterministic_ids):
+    """ the same object created twice keeps its id, the second is a 400 """
+    id = str(uuid.uuid1())
+    body = {'data_object': _data_object(id)}
+    response, status = controllers.CreateDataObject(body=body)
+    assert (response, status) == ({'data_object_id': id}, 200)
+    response, status = controllers.CreateDataObject(body=body)
+    assert (response['msg'], status) == ('duplicate document', 400)
+    index = memory_backend.store.data_objects
+    assert len(index.versions[id]) == 1
+    stored = index.docs[index.versions[id][0]]
+    assert stored.meta.key == document_id(_data_object(id))
+
+
+def test_bulk_create_twice(deterministic_ids):
+    """ a bulk create reports each duplicate as a 400 """
+    ids = [str(uuid.uuid1()) for _ in range(2)]
+    body = {'data_objects': [_data_object(id) for id in ids]}
+    response, status = controllers.CreateDataObjects(body=body)
+    assert status == 200
+    assert [(r['data_object_id'], r['status_code'])
+            for r in response['results']] == [(id, 200) for id in ids]
+    response, status = controllers.CreateDataObjects(body=body)
+    assert [(r['data_object_id'], r['status_code'])
+            for r in response['results']] == [(id, 400) for id in ids]
+
+
+@pytest.mark.parametrize('cursor', ['{"a": 1}', '7.5', '"7"', '[1, 2, 3, 4]',
+                                    '[{"a": 1}]', '[true]', 'not json'])
+def test_invalid_page_token(cursor):
+    """ a page_token that is not a cursor of the backend is a 400 """
+    body = {'page_token': base64.urlsafe_b64encode(cursor)}
+    with flask.Flask(__name__).test_request_context():
+        response, status = controllers.ListDataObjects(body=body)
+        assert status == 400
+        response, status = controllers.ListDataBundles(body=body)
+        assert status == 400
@@ -0,0 +1,45 @@
+import collections
+import pytest
+
+from dos_connect.server import document_cache
+from dos_connect.server import utils
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """ an empty cache of two ids """
+    monkeypatch.setattr(document_cache, 'GET_CACHE_SIZE', 2)
+    monkeypatch.setattr(document_cache, '_cache',
+                        utils.TTLCache(maxsize=2, ttl=60))
+    monkeypatch.setattr(document_cache, '_generations',
+                        collections.OrderedDict())
+    monkeypatch.setattr(document_cache, '_dropped', 0)
+    return document_cache
+
+
+def test_set_after_invalidate(cache):
+    """ a read that raced with an update is not cached """
+    generation = cache.generation('data_objects', 'a')
+    # updated while the get read the old version from the backend
+    cache.invalidate('data_objects', 'a')
+    cache.set('data_objects', 'a', {'version': '1'}, generation)
+    assert cache.get('data_objects', 'a') is None
+    generation = cache.generation('data_objects', 'a')
+    cache.set('data_objects', 'a', {'version': '2'}, generation)
+    assert cache.get('data_objects', 'a') == {'version': '2'}
+    # other ids are not affected
+    generation = cache.generation('data_objects', 'b')
+    cache.invalidate('data_objects', 'a')
+    cache.set('data_objects', 'b', {'version': '1'}, generation)
+    assert cache.get('data_objects', 'b') == {'version': '1'}
+
+
+def test_generation_dropped(cache):
+    """ an invalidation is still seen after its generation is dropped """
+    generation = cache.generation('data_objects', 'a')
+    cache.invalidate('data_objects', 'a')
+    for id in ['b', 'c']:
+        cache.invalidate('data_objects', id)
+    assert ('data_objects', 'a') not in cache._generations
+    cache.set('data_objects', 'a', {'version': '1'}, generation)
+    assert cache.get('data_objects', 'a') is None
@@ -0,0 +1,47 @@
+import uuid
+import pytest
+
+# the backend connects to ELASTIC_URL on import
+try:
+    from dos_connect.server import elasticsearch_backend as backend
+except Exception as e:
+    pytest.skip('elasticsearch not available: {}'.format(e),
+                allow_module_level=True)
+from dos_connect.server.utils import AttributeDict  # NOQA
+
+
+@pytest.fixture
+def split_index(monkeypatch):
+    """ an ES_SPLIT_HISTORY index of its own, removed afterwards """
+    monkeypatch.setattr(backend, 'ES_SPLIT_HISTORY', True)
+    monkeypatch.setattr(backend, 'ES_REFRESH_ON_PERSIST', True)
+    index = 'dos_connect_test_{}s'.format(uuid.uuid4().hex)
+    yield index
+    for name in [index, backend._history(index)]:
+        backend.client.indices.delete(index=name, ignore=404)
+
+
+def _doc(id, url):
+    return AttributeDict({
+        'id': id,
+        'urls': [{'url': url}],
+        'checksums': [{'checksum': 'md5-' + url, 'type': 'md5'}],
+    })
+
+
+def test_split_create_known_id(split_index):
+    """ a known id is a duplicate whatever its content, not a version """
+    backend.save(_doc('a', 'url-a'), split_index)
+    with pytest.raises(Exception) as e:
+        backend.save(_doc('a', 'url-a2'), split_index)
+    assert str(e.value) == 'duplicate document'
+    results = backend.save_many([_doc('b', 'url-b'), _doc('a', 'url-a3'),
+                                 _doc('b', 'url-b2')], split_index)
+    assert [error for _, error in results] == \
+        [None, 'duplicate document', 'duplicate document']
+    assert backend.current_version('a', split_index) is not None
+    assert backend._get_current('a', split_index)[0].urls == \
+        [{'url': 'url-a'}]
+    version = backend.new_version('a', _doc('a', 'url-a2'),
+                                  split_index).version
+    assert backend.current_version('a', split_index) == version
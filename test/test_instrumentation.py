@@ -0,0 +1,35 @@
+from prometheus_client import REGISTRY
+
+from dos_connect.server import instrumentation
+
+
+def _count(operation, stage):
+    return REGISTRY.get_sample_value(
+        'dos_connect_stage_latency_seconds_count',
+        {'operation': operation, 'stage': stage}) or 0
+
+
+def test_streamed():
+    """ stages of a body read after the controller are its operation's """
+    def numbers():
+        for i in range(3):
+            yield i
+    scan = instrumentation.timed_generator('test_scan', numbers)
+
+    @instrumentation.timed
+    def TestExport():
+        lines = (str(i) for i in scan())
+        return instrumentation.streamed(lines), 200
+
+    before = _count('TestExport', 'test_scan')
+    body, _ = TestExport()
+    assert instrumentation._operation() == 'none'
+    assert list(body) == ['0', '1', '2']
+    assert _count('TestExport', 'test_scan') == before + 1
+    assert instrumentation._operation() == 'none'
+
+    # closed before the end, as when the client goes away
+    body, _ = TestExport()
+    assert next(body) == '0'
+    body.close()
+    assert _count('TestExport', 'test_scan') == before + 2
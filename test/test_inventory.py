@@ -0,0 +1,116 @@
+import argparse
+import json
+import pickle
+import pytest
+
+from dos_connect.apps import inventory
+
+
+@pytest.fixture
+def events(tmpdir, monkeypatch):
+    """ offsets in an empty directory, flush() and writes recorded """
+    monkeypatch.chdir(tmpdir)
+    recorded = []
+    write = inventory._write
+
+    def _write(key, checkpoint):
+        recorded.append(('write', checkpoint['offset']))
+        write(key, checkpoint)
+    monkeypatch.setattr(inventory, 'flush', lambda: recorded.append('flush'))
+    monkeypatch.setattr(inventory, '_write', _write)
+    return recorded
+
+
+def test_flush_before_commit(events):
+    """ buffered data objects are sent before the offset is saved """
+    checkpoint = inventory.Checkpoint('bucket', every=2, interval=3600)
+    checkpoint.advance('k1')
+    assert events == []
+    checkpoint.advance('k2')
+    assert events == ['flush', ('write', 'k2')]
+    # nothing new, nothing to commit
+    checkpoint.commit()
+    assert events == ['flush', ('write', 'k2')]
+
+
+def test_resume(events):
+    """ a new run starts at the last committed offset """
+    checkpoint = inventory.Checkpoint('bucket', every=2, interval=3600)
+    for key in ['k1', 'k2', 'k3']:
+        checkpoint.advance(key)
+    # k3 was not committed, as if the run crashed
+    resumed = inventory.Checkpoint('bucket', every=2, interval=3600)
+    assert (resumed.offset, resumed.count, resumed.run_count) == \
+        ('k2', 2, 0)
+    resumed.advance('k3')
+    stats = resumed.close()
+    assert (stats['offset'], stats['count'], stats['run_count']) == \
+        ('k3', 3, 1)
+    assert inventory.get_offset('bucket') == 'k3'
+
+
+def test_atomic_write(events):
+    """ a failed write leaves the previous checkpoint intact """
+    inventory.save_offset('k1', 'bucket')
+
+    def torn(value, data_file):
+        data_file.write('{"offset": "k')
+        raise IOError('disk full')
+    dump = json.dump
+    json.dump = torn
+    try:
+        with pytest.raises(IOError):
+            inventory.save_offset('k2', 'bucket')
+    finally:
+        json.dump = dump
+    assert inventory.get_offset('bucket') == 'k1'
+
+
+def test_read_pickle(tmpdir, monkeypatch):
+    """ offsets pickled by previous releases are resumed """
+    monkeypatch.chdir(tmpdir)
+    with open('offset.bucket.pickle', 'w') as data_file:
+        pickle.dump('k1', data_file)
+    assert inventory.Checkpoint('bucket').offset == 'k1'
+
+
+def _inventory(args, shard):
+    """ inventory one shard, fail the one named fail """
+    prefix, _ = shard
+    if prefix == 'fail':
+        raise Exception('listing failed')
+    checkpoint = inventory.Checkpoint(inventory.shard_key('bucket', shard))
+    for i in range(3):
+        checkpoint.advance('{}{}'.format(prefix, i))
+    return checkpoint.close()
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_run_shards(tmpdir, monkeypatch, processes):
+    """ every shard runs, a failed one is reported, not raised """
+    monkeypatch.chdir(tmpdir)
+    args = argparse.Namespace(processes=processes)
+    results = inventory.run_shards(
+        args, _inventory, [('a/', None), ('fail', None), ('b/', None)])
+    assert [stats.get('offset', None) for stats in results] == \
+        ['a/2', None, 'b/2']
+    assert 'listing failed' in results[1]['error']
+    assert inventory.get_offset('bucket~a/~') == 'a/2'
+    assert inventory.get_offset('bucket~b/~') == 'b/2'
+
+
+def test_shards():
+    """ shards are split between nodes, each key checkpoints apart """
+    def args(node_index, **kwargs):
+        return argparse.Namespace(shard_prefixes=None, shard_delimiter='/',
+                                  node_index=node_index, node_count=2,
+                                  **kwargs)
+
+    def list_prefixes(delimiter):
+        return ['b/', 'a/', 'c/']
+    assert inventory.shards(args(0), list_prefixes) == \
+        [('', '/'), ('b/', None)]
+    assert inventory.shards(args(1), list_prefixes) == \
+        [('a/', None), ('c/', None)]
+    assert inventory.shard_key('bucket', ('', None)) == 'bucket'
+    assert inventory.shard_key('bucket', ('', '/')) == 'bucket~~/'
@@ -0,0 +1,100 @@
+import datetime
+import decimal
+import json
+import uuid
+import pytest
+
+from dos_connect import json_codec
+
+
+def _installed(names):
+    return [name for name, _ in json_codec._codecs(names)]
+
+
+def test_select(monkeypatch):
+    """ the first installed library is used, in order of preference """
+    monkeypatch.setattr(json_codec, 'DECODERS', ['no_such_json', 'json'])
+    monkeypatch.setattr(json_codec, 'ENCODERS', ['no_such_json', 'json'])
+    (decoder, loads), (encoder, dumps) = json_codec._select()
+    assert (decoder, encoder) == ('json', 'json')
+    assert loads is json.loads
+    assert loads(dumps({'a': 1})) == {'a': 1}
+
+
+def test_select_fallback(monkeypatch):
+    """ without any of the listed libraries the standard library is used """
+    monkeypatch.setattr(json_codec, 'DECODERS', ['no_such_json'])
+    monkeypatch.setattr(json_codec, 'ENCODERS', ['no_such_json'])
+    (decoder, _), (encoder, _) = json_codec._select()
+    assert (decoder, encoder) == ('json', 'json')
+
+
+def test_select_installed():
+    """ the module uses the preferred installed libraries """
+    assert json_codec.DECODER == _installed(json_codec.DECODERS)[0]
+    assert json_codec.ENCODER in _installed(json_codec.ENCODERS)
+
+
+class _EpochJson(object):
+    """ a library that encodes datetimes as epoch seconds """
+
+    @staticmethod
+    def dumps(value, **kwargs):
+        return json.dumps([0 for _ in value])
+
+    loads = staticmethod(json.loads)
+
+
+def test_unusable_encoder(monkeypatch):
+    """ an encoder that can not write ISO-8601 datetimes is skipped """
+    assert json_codec._encoder(_EpochJson) is None
+    monkeypatch.setattr(json_codec, '_codecs', lambda names: [
+        ('epoch', _EpochJson), ('json', json)])
+    (_, _), (encoder, _) = json_codec._select()
+    assert encoder == 'json'
+
+
+@pytest.mark.parametrize('name', _installed(['ujson', 'simplejson', 'json']))
+def test_encode(name):
+    """ every usable encoder writes the added types the same way """
+    arrow = pytest.importorskip('arrow')
+    dumps = json_codec._encoder(__import__(name))
+    if not dumps:
+        pytest.skip('{} can not encode datetimes'.format(name))
+    id = uuid.UUID('12345678-1234-5678-1234-567812345678')
+    value = {
+        'datetime': datetime.datetime(2018, 1, 2, 3, 4, 5, 6),
+        'date': datetime.date(2018, 1, 2),
+        'arrow': arrow.get(datetime.datetime(2018, 1, 2, 3, 4, 5)),
+        'uuid': id,
+        'decimal': decimal.Decimal('1.5'),
+        'text': u'\xe9',
+    }
+    assert json.loads(dumps(value)) == {
+        'datetime': '2018-01-02T03:04:05.000006',
+        'date': '2018-01-02',
+        'arrow': '2018-01-02T03:04:05+00:00',
+        'uuid': str(id),
+        'decimal': 1.5,
+        'text': u'\xe9',
+    }
+    with pytest.raises(TypeError):
+        dumps({'object': object()})
+
+
+def test_round_trip():
+    """ loads reads what dumps writes """
+    value = {'id': 'a', 'size': 12345, 'current': True,
+             'urls': [{'url': u's3://bucket/\xe9'}]}
+    assert json_codec.loads(json_codec.dumps(value)) == value
+
+
+def test_benchmark():
+    """ every installed library is timed, unusable encoders are None """
+    results = json_codec.benchmark(number=10)
+    assert [name for name, _, _ in results] == \
+        _installed(['ujson', 'simplejson', 'json'])
+    for name, encode, decode in results:
+        assert decode > 0
+        assert encode is None or encode > 0
+    assert dict((name, encode) for name, encode, _ in results)['json']
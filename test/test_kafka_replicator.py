@@ -0,0 +1,63 @@
+import fcntl
+import os
+import pytest
+
+from dos_connect.server import kafka_replicator
+
+
+class _Future(object):
+    def add_callback(self, f, *args):
+        pass
+
+    def add_errback(self, f, *args):
+        pass
+
+
+class _Producer(object):
+    """ KafkaProducer stand in, records what is sent """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, topic, message):
+        self.sent.append(message)
+        return _Future()
+
+    def flush(self, timeout=None):
+        pass
+
+
+@pytest.fixture
+def producer(tmpdir, monkeypatch):
+    """ a replicator spilling to an empty directory """
+    producer = _Producer()
+    monkeypatch.setattr(kafka_replicator, 'producer', producer)
+    monkeypatch.setattr(kafka_replicator, 'KAFKA_DOS_TOPIC', 'dos',
+                        raising=False)
+    monkeypatch.setattr(kafka_replicator, 'KAFKA_SPILL_FILE',
+                        str(tmpdir.join('kafka.jsonl')))
+    monkeypatch.setattr(kafka_replicator, '_pending', {})
+    return producer
+
+
+def test_replay_once(producer):
+    """ a file another worker replays is skipped until it exits """
+    spill_file = kafka_replicator.KAFKA_SPILL_FILE
+    replay_file = spill_file + '.replay'
+    for message in ['m1', 'm2']:
+        kafka_replicator._spill(message)
+    os.rename(spill_file, replay_file)
+    other = open(replay_file)
+    fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    kafka_replicator._spill('m3')
+    kafka_replicator._replay()
+    assert producer.sent == []
+    assert os.path.exists(replay_file)
+    # the other worker exited without finishing, its file is adopted
+    other.close()
+    kafka_replicator._replay()
+    assert producer.sent == ['m1', 'm2']
+    assert not os.path.exists(replay_file)
+    kafka_replicator._replay()
+    assert producer.sent == ['m1', 'm2', 'm3']
+    assert not os.path.exists(spill_file)
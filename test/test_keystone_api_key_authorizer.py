@@ -0,0 +1,133 @@
+import datetime
+import os
+import flask
+import pytest
+
+# the authorizer requires keystone settings on import
+os.environ['OS_AUTH_URL'] = 'http://keystone/v3'
+os.environ['AUTHORIZER_PROJECTS'] = 'project-a, project-b'
+from dos_connect.server import \
+    keystone_api_key_authorizer as authorizer  # NOQA
+from dos_connect.server import utils  # NOQA
+
+
+class _Response(object):
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class _Keystone(object):
+    """ session() stand in, answers token and project requests """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.expires_in = 3600
+        self.projects = ['project-b']
+        self.requests = []
+
+    def get(self, url, headers):
+        self.requests.append(url)
+        if url.endswith('/auth/tokens'):
+            if headers['X-Auth-Token'] != 'valid':
+                return _Response({'error': {'code': 404}})
+            expires_at = None
+            if self.expires_in is not None:
+                expires_at = datetime.datetime.utcfromtimestamp(
+                    self.clock.now + self.expires_in).isoformat() + 'Z'
+            return _Response({'token': {'expires_at': expires_at}})
+        return _Response({'projects': [{'name': name}
+                                       for name in self.projects]})
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1500000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(utils, 'time', clock)
+    monkeypatch.setattr(authorizer, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def keystone(clock, monkeypatch):
+    """ a fake keystone behind an empty cache """
+    keystone = _Keystone(clock)
+    monkeypatch.setattr(authorizer, 'session', lambda: keystone)
+    monkeypatch.setattr(authorizer, 'AUTH_CACHE_TTL', 300)
+    monkeypatch.setattr(authorizer, 'AUTH_CACHE_NEGATIVE_TTL', 10)
+    monkeypatch.setattr(authorizer, '_cache',
+                        utils.TTLCache(maxsize=100, ttl=300))
+    return keystone
+
+
+def _validations(keystone):
+    return len([url for url in keystone.requests
+                if url.endswith('/auth/tokens')])
+
+
+def test_cached_until_expires_at(keystone, clock):
+    """ a valid key is not trusted past the token's expires_at """
+    keystone.expires_in = 60
+    assert authorizer._check_auth('valid')
+    clock.now += 59
+    assert authorizer._check_auth('valid')
+    assert _validations(keystone) == 1
+    clock.now += 1
+    assert authorizer._check_auth('valid')
+    assert _validations(keystone) == 2
+
+
+def test_cached_for_ttl(keystone, clock):
+    """ a long lived token is validated again after AUTH_CACHE_TTL """
+    assert authorizer._check_auth('valid')
+    clock.now += 299
+    assert authorizer._check_auth('valid')
+    assert _validations(keystone) == 1
+    clock.now += 1
+    keystone.projects = ['project-c']
+    assert not authorizer._check_auth('valid')
+    assert _validations(keystone) == 2
+
+
+def test_no_expires_at(keystone, clock):
+    """ without expires_at, AUTH_CACHE_TTL bounds the cache """
+    keystone.expires_in = None
+    assert authorizer._check_auth('valid')
+    clock.now += 300
+    assert authorizer._check_auth('valid')
+    assert _validations(keystone) == 2
+
+
+def test_negative_ttl(keystone, clock):
+    """ a rejected key is remembered for AUTH_CACHE_NEGATIVE_TTL """
+    assert not authorizer._check_auth('invalid')
+    clock.now += 9
+    assert not authorizer._check_auth('invalid')
+    assert _validations(keystone) == 1
+    clock.now += 1
+    assert not authorizer._check_auth('invalid')
+    assert _validations(keystone) == 2
+
+
+def test_authorization_check(keystone):
+    """ requests without a valid key get a 401 """
+    @authorizer.authorization_check
+    def operation():
+        return 'ok'
+    app = flask.Flask(__name__)
+    with app.test_request_context(headers={'X-API-Key': 'valid'}):
+        assert operation() == 'ok'
+    with app.test_request_context(headers={'Api-Key': 'invalid'}):
+        assert operation().status_code == 401
+    with app.test_request_context():
+        assert operation().status_code == 401
@@ -0,0 +1,147 @@
+import itertools
+import os
+import tempfile
+import pytest
+
+# the backend opens its log on import
+os.environ['LOG_PATH'] = tempfile.mkdtemp()
+os.environ['LOG_COMPACT_INTERVAL'] = '0'
+from dos_connect.server import log_backend  # NOQA
+from dos_connect.server import memory_backend  # NOQA
+from dos_connect.server.utils import AttributeDict  # NOQA
+
+
+@pytest.fixture
+def reopen(tmpdir, monkeypatch):
+    """ open the log in an empty directory, call again to restart """
+    monkeypatch.setattr(memory_backend, 'store', AttributeDict({}))
+    monkeypatch.setattr(memory_backend, '_sequence', itertools.count(1))
+    opened = []
+
+    def open_log():
+        # as after a crash, the previous log is not closed
+        opened.append(log_backend._Log(str(tmpdir)))
+        monkeypatch.setattr(log_backend, '_log', opened[-1])
+        log_backend._open()
+        return opened[-1]
+    yield open_log
+    for _log in opened:
+        _log.writer.close()
+
+
+def _doc(id, url):
+    return AttributeDict({
+        'id': id,
+        'current': True,
+        'urls': [{'url': url}],
+        'checksums': [{'checksum': 'md5-' + url, 'type': 'md5'}],
+    })
+
+
+def _ids(hits):
+    return [hit.id for hit in hits]
+
+
+def _search(**properties):
+    return log_backend.search(AttributeDict(properties))
+
+
+def test_replay(reopen):
+    """ documents, new versions and deletes are replayed on restart """
+    reopen()
+    log_backend.save(_doc('a', 'url-a'))
+    version = log_backend.new_version('a', _doc('a', 'url-a2')).version
+    log_backend.save(_doc('b', 'url-b'))
+    log_backend.delete(AttributeDict({'id': 'b'}))
+    reopen()
+    assert [hit.current for hit in _search(id='a')] == [True, False]
+    assert log_backend.current_version('a') == version
+    assert _ids(_search(url='url-a2')) == ['a']
+    assert _ids(_search(id='b')) == []
+    # _ids continue after the highest one in the log
+    log_backend.save(_doc('c', 'url-c'))
+    assert _ids(_search()) == ['c', 'a', 'a']
+
+
+def test_close_checkpoint(reopen):
+    """ after a clean close the table is used, nothing is replayed """
+    _log = reopen()
+    log_backend.save(_doc('a', 'url-a'))
+    _log.close()
+    _log = reopen()
+    assert _log.checkpoint == _log.active - 1
+    assert _ids(_search(id='a')) == ['a']
+
+
+def test_torn_record(reopen):
+    """ a partially written final record is truncated on restart """
+    _log = reopen()
+    log_backend.save(_doc('a', 'url-a'))
+    path = _log._segment_path(_log.active)
+    intact = os.path.getsize(path)
+    with open(path, 'ab') as segment:
+        segment.write('0badc0de {"index": "data_objects", "_id": 2, "do')
+    _log = reopen()
+    assert os.path.getsize(path) == intact
+    assert _ids(_search()) == ['a']
+    log_backend.save(_doc('b', 'url-b'))
+    reopen()
+    assert _ids(_search()) == ['b', 'a']
+
+
+def test_compact(reopen, monkeypatch):
+    """ superseded segments are removed, current records moved """
+    # every record fills a segment
+    monkeypatch.setattr(log_backend, 'LOG_SEGMENT_SIZE', 64)
+    _log = reopen()
+    for i in range(5):
+        _log.put('data_objects', 1, None, _doc('a', 'url-{}'.format(i)))
+    _log.put('data_objects', 2, None, _doc('b', 'url-b'))
+    _log.delete('data_objects', 2)
+    before = _log.segments()
+    _log.compact()
+    after = _log.segments()
+    assert len(after) < len(before)
+    assert _log.slot(1)[0] in after
+    assert _log.slot(2) is None
+    assert _log.read(1)['doc']['urls'] == [{'url': 'url-4'}]
+    _log.close()
+    _log = reopen()
+    assert _log.read(1)['doc']['urls'] == [{'url': 'url-4'}]
+    assert _ids(_search()) == ['a']
+
+
+def test_table_growth(reopen):
+    """ the offset table is remapped as _ids grow, entries are kept """
+    _log = reopen()
+    size = len(_log.table)
+    _log.put('data_objects', 1, None, _doc('a', 'url-a'))
+    for _id in [2000, 5000]:
+        _log.put('data_objects', _id, None, _doc(str(_id), 'url'))
+    assert len(_log.table) > size * 4
+    assert _log.max_id == 5000
+    assert [_log.read(_id)['doc']['id'] for _id in [1, 2000, 5000]] == \
+        ['a', '2000', '5000']
+    _log.close()
+    _log = reopen()
+    assert _log.max_id == 5000
+    assert _log.read(5000)['doc']['id'] == '5000'
+    assert sorted(_ids(_search())) == ['2000', '5000', 'a']
+
+
+def test_page_reads(reopen, monkeypatch):
+    """ a page of current documents reads only its own records """
+    _log = reopen()
+    for i in range(2000):
+        log_backend.save(_doc(str(i), 'url-{}'.format(i)))
+    reads = []
+    read = _log.read
+
+    def counted(_id):
+        reads.append(_id)
+        return read(_id)
+    monkeypatch.setattr(_log, 'read', counted)
+    page = list(log_backend.search(AttributeDict({'current': True}),
+                                   size=10))
+    assert _ids(page) == [str(i) for i in range(1999, 1989, -1)]
+    assert len(reads) == 10
@@ -0,0 +1,211 @@
+import itertools
+import os
+import pytest
+
+from dos_connect.server import memory_backend
+from dos_connect.server.utils import AttributeDict
+
+
+@pytest.fixture
+def reopen(tmpdir, monkeypatch):
+    """ persist to an empty directory, call again to restart """
+    monkeypatch.setattr(memory_backend, 'MEMORY_SNAPSHOT_PATH',
+                        str(tmpdir.join('snapshot')))
+    monkeypatch.setattr(memory_backend, '_log_file', None)
+    monkeypatch.setattr(memory_backend, '_sequence', itertools.count(1))
+
+    def open_snapshot():
+        if memory_backend._log_file:
+            memory_backend._log_file.close()
+        monkeypatch.setattr(memory_backend, 'store', AttributeDict({}))
+        memory_backend._open()
+    yield open_snapshot
+    memory_backend._log_file.close()
+
+
+def _doc(id, url):
+    return AttributeDict({
+        'id': id,
+        'current': True,
+        'urls': [{'url': url}],
+        'checksums': [{'checksum': 'md5-' + url, 'type': 'md5'}],
+    })
+
+
+def _ids(hits):
+    return [hit.id for hit in hits]
+
+
+def _search(**properties):
+    return memory_backend.search(AttributeDict(properties))
+
+
+def test_reload(reopen):
+    """ the snapshot and the log written since are both restored """
+    reopen()
+    memory_backend.save(_doc('a', 'url-a'))
+    version = memory_backend.new_version('a', _doc('a', 'url-a2')).version
+    memory_backend.save(_doc('b', 'url-b'))
+    memory_backend.snapshot()
+    # after the snapshot, only in the log
+    memory_backend.delete(AttributeDict({'id': 'b'}))
+    memory_backend.save(_doc('c', 'url-c'))
+    reopen()
+    assert [hit.current for hit in _search(id='a')] == [True, False]
+    assert memory_backend.current_version('a') == version
+    assert _ids(_search(url='url-a2')) == ['a']
+    assert _ids(_search(id='b')) == []
+    assert _ids(_search(id='c')) == ['c']
+    # _ids continue after the highest restored one
+    d = memory_backend.save(_doc('d', 'url-d'))
+    assert d.meta.id == 5
+
+
+def test_torn_line(reopen):
+    """ a partially written last log line is cut off """
+    reopen()
+    memory_backend.save(_doc('a', 'url-a'))
+    path = memory_backend.MEMORY_SNAPSHOT_PATH + '.log'
+    intact = os.path.getsize(path)
+    with open(path, 'ab') as log_file:
+        log_file.write('{"index": "data_objects", "_id": 2, "doc": {"id"')
+    reopen()
+    assert os.path.getsize(path) == intact
+    assert _ids(_search()) == ['a']
+    memory_backend.save(_doc('b', 'url-b'))
+    reopen()
+    assert _ids(_search()) == ['b', 'a']
+
+
+def test_rotation(reopen):
+    """ the log is rotated by a snapshot and kept while one fails """
+    reopen()
+    path = memory_backend.MEMORY_SNAPSHOT_PATH
+    memory_backend.save(_doc('a', 'url-a'))
+    memory_backend.snapshot()
+    assert os.path.getsize(path + '.log') == 0
+    assert not os.path.exists(path + '.log.1')
+
+    def fail(fileno):
+        raise IOError('disk full')
+    memory_backend.save(_doc('b', 'url-b'))
+    fsync = os.fsync
+    os.fsync = fail
+    try:
+        with pytest.raises(IOError):
+            memory_backend.snapshot()
+    finally:
+        os.fsync = fsync
+    assert os.path.exists(path + '.log.1')
+    memory_backend.save(_doc('c', 'url-c'))
+    reopen()
+    assert _ids(_search()) == ['c', 'b', 'a']
+
+    # the next snapshot covers both logs, then removes the kept one
+    memory_backend.save(_doc('d', 'url-d'))
+    memory_backend.snapshot()
+    assert not os.path.exists(path + '.log.1')
+    reopen()
+    assert _ids(_search()) == ['d', 'c', 'b', 'a']
+
+
+@pytest.fixture
+def index(monkeypatch):
+    """ an empty data_objects index, not persisted """
+    monkeypatch.setattr(memory_backend, '_log_file', None)
+    monkeypatch.setattr(memory_backend, '_sequence', itertools.count(1))
+    monkeypatch.setattr(memory_backend, 'store', AttributeDict({}))
+    return memory_backend._get_index('data_objects')
+
+
+def _lookup(index, **properties):
+    return index.lookup(AttributeDict(properties))
+
+
+def test_lookup(index):
+    """ properties narrow on each other, other fields filter """
+    a = memory_backend.save(AttributeDict(_doc('a', 'url-a'),
+                                          aliases=['shared']))
+    b = memory_backend.save(AttributeDict(_doc('b', 'url-b'),
+                                          aliases=['shared']))
+    c = memory_backend.save(AttributeDict(_doc('c', 'url-a'),
+                                          current=False))
+    checksum = {'checksum': 'md5-url-a', 'type': 'md5'}
+    assert _lookup(index, alias='shared') == set([a.meta.id, b.meta.id])
+    assert _lookup(index, url='url-a') == set([a.meta.id, c.meta.id])
+    assert _lookup(index, url='url-a', alias='shared') == set([a.meta.id])
+    assert _lookup(index, checksum=checksum, current=True) == \
+        set([a.meta.id])
+    assert _lookup(index, id='b', url='url-a') == set()
+    assert _lookup(index, url='url-a', version=c.version) == \
+        set([c.meta.id])
+    assert _lookup(index, alias='missing') == set()
+    # a single posting set is returned as is, not copied
+    assert _lookup(index, current=True) is index.current
+    assert _lookup(index) == set([a.meta.id, b.meta.id, c.meta.id])
+
+
+def test_postings_removed(index):
+    """ a new version leaves the current set, delete drops every posting """
+    first = memory_backend.save(_doc('a', 'url-1'))
+    second = memory_backend.new_version('a', _doc('a', 'url-2'))
+    assert index.current == set([second.meta.id])
+    assert index.current_order == [second.meta.id]
+    assert index.versions == {'a': [first.meta.id, second.meta.id]}
+    assert _lookup(index, url='url-1', current=True) == set()
+    assert _lookup(index, url='url-1') == set([first.meta.id])
+    memory_backend.update(first.meta.id, {'urls': [{'url': 'url-3'}]})
+    assert 'url-1' not in index.urls
+    assert _lookup(index, url='url-3') == set([first.meta.id])
+    memory_backend.delete(AttributeDict({'url': 'url-3'}))
+    assert index.versions == {'a': [second.meta.id]}
+    memory_backend.delete(AttributeDict({'id': 'a'}))
+    assert len(index) == 0
+    assert (index.versions, index.urls, index.checksums, index.aliases,
+            index.current, index.current_order) == ({}, {}, {}, {}, set(), [])
+
+
+def test_new_version_of_current(index):
+    """ the current version is retired, not the newest one """
+    current = memory_backend.save(_doc('a', 'url-1'))
+    memory_backend.save(AttributeDict(_doc('a', 'url-0'), current=False,
+                                      version='0'))
+    new = memory_backend.new_version('a', _doc('a', 'url-2'))
+    assert [(hit.version, hit.current) for hit in _search(id='a')] == \
+        [(new.version, True), ('0', False), (current.version, False)]
+    assert index.current == set([new.meta.id])
+
+
+def test_newest_first(index):
+    """ search pages newest first, after a cursor or an offset """
+    for i in range(5):
+        memory_backend.save(_doc(str(i), 'url-{}'.format(i)))
+    assert _ids(_search()) == ['4', '3', '2', '1', '0']
+    page = list(memory_backend.search(AttributeDict({}), size=2))
+    assert _ids(page) == ['4', '3']
+    assert _ids(memory_backend.search(AttributeDict({}), size=2,
+                                      after=page[-1].meta.sort)) == \
+        ['2', '1']
+    assert _ids(memory_backend.search(AttributeDict({}), size=2,
+                                      offset=3)) == ['1', '0']
+
+
+def test_current_pages(index):
+    """ current documents page from the cursor as versions change """
+    for i in range(6):
+        memory_backend.save(_doc(str(i), 'url-{}'.format(i)))
+    memory_backend.new_version('1', _doc('1', 'url-1b'))
+    memory_backend.update(3, {'urls': [{'url': 'url-2b'}]})
+    assert index.current_order == sorted(index.current)
+    pages, after = [], None
+    while True:
+        page = list(memory_backend.search(AttributeDict({'current': True}),
+                                          size=2, after=after))
+        if not page:
+            break
+        pages.append(_ids(page))
+        after = page[-1].meta.sort
+    assert pages == [['1', '5'], ['4', '3'], ['2', '0']]
+    assert _ids(memory_backend.search(AttributeDict({'current': True}),
+                                      size=2, offset=1, after=[6])) == \
+        ['3', '2']
@@ -1,3 +1,5 @@
+import uuid
+import pytest
 import requests
 from . import init_logging, SERVER_URL
 
@@ -14,3 +16,51 @@ def test_metrics():
         'should return dos_connect_data_bundles_count'
     assert 'dos_connect_data_objects_count' in r.text, \
         'should return dos_connect_data_objects_count'
+
+
+def test_request_metrics():
+    """ controllers report latency and the time spent in the backend """
+    r = requests.get(SERVER_URL + '/dataobjects/no-such-id')
+    assert r.status_code == 404
+    r = requests.get(SERVER_URL.replace('/ga4gh/dos/v1', '/metrics'))
+    assert r.status_code == 200, '/metrics should return 200'
+    assert 'dos_connect_request_latency_seconds_count' \
+           '{operation="GetDataObject"}' in r.text
+    assert 'dos_connect_requests{operation="GetDataObject",' \
+           'status_code="404"}' in r.text
+    assert 'dos_connect_stage_latency_seconds_count' \
+           '{operation="GetDataObject",stage="backend_search"}' in r.text
+
+
+def _sample(name):
+    """ value of an unlabelled sample on /metrics """
+    r = requests.get(SERVER_URL.replace('/ga4gh/dos/v1', '/metrics'))
+    assert r.status_code == 200, '/metrics should return 200'
+    for line in r.text.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split(' ')[1])
+    assert False, '{} should be on /metrics'.format(name)
+
+
+def test_get_cache_metrics():
+    """ repeated gets are counted as cache hits """
+    id = str(uuid.uuid1())
+    r = requests.post(SERVER_URL + '/dataobjects',
+                      json={'data_object': {
+                          'id': id, 'name': 'cached', 'size': '12345',
+                          'checksums': [{'checksum': id, 'type': 'md5'}],
+                          'urls': [{'url': id}]}})
+    assert r.status_code == 200
+    hits = _sample('dos_connect_get_cache_hits')
+    misses = _sample('dos_connect_get_cache_misses')
+    for i in range(2):
+        r = requests.get('{}/dataobjects/{}'.format(SERVER_URL, id))
+        assert r.status_code == 200
+    if (_sample('dos_connect_get_cache_hits') == hits and
+            _sample('dos_connect_get_cache_misses') == misses):
+        pytest.skip('get cache disabled, e.g. several workers')
+    # the first get reads the backend, the second is answered from cache
+    assert _sample('dos_connect_get_cache_hits') == hits + 1
+    assert _sample('dos_connect_get_cache_misses') == misses + 1
+    ratio = _sample('dos_connect_get_cache_hit_ratio')
+    assert 0 < ratio <= 1
@@ -1,4 +1,5 @@
 # With app.py running start this test
+import json
 import logging
 import sys
 import os
@@ -7,7 +8,7 @@ import requests
 import pytest
 
 
-from . import init_logging, init_client
+from . import init_logging, init_client, SERVER_URL
 
 # setup connection, models and security
 from bravado.exception import HTTPNotFound
@@ -504,3 +505,230 @@ def test_duplicate_create():
         create_request = CreateDataObjectRequest(
                         data_object=create_data_object)
         create_response = client.CreateDataObject(body=create_request).result()
+
+
+def test_bulk_create():
+    """ validate per item status of bulk create """
+    Checksum = models.get_model('Checksum')
+    URL = models.get_model('URL')
+    DataObject = models.get_model('DataObject')
+    CreateDataObjectsRequest = models.get_model('CreateDataObjectsRequest')
+    ids = [str(uuid.uuid1()) for i in range(3)]
+    data_objects = [
+        DataObject(
+            id=id,
+            name="bulk",
+            size="12345",
+            checksums=[Checksum(checksum=id, type="md5")],
+            urls=[URL(url=id)])
+        for id in ids]
+    # the last one duplicates the first
+    data_objects.append(data_objects[0])
+    create_request = CreateDataObjectsRequest(data_objects=data_objects)
+    create_response = client.CreateDataObjects(body=create_request).result()
+    results = create_response.results
+    assert len(results) == 4, 'expected one result per data_object'
+    assert [r.status_code for r in results] == [200, 200, 200, 400]
+    assert [r.data_object_id for r in results] == ids + [ids[0]]
+    for id in ids:
+        data_object = client.GetDataObject(data_object_id=id).result()\
+            .data_object
+        assert data_object.id == id
+
+
+def test_page_cursor():
+    """ page through a listing with cursor tokens, no gaps or repeats """
+    Checksum = models.get_model('Checksum')
+    URL = models.get_model('URL')
+    DataObject = models.get_model('DataObject')
+    CreateDataObjectsRequest = models.get_model('CreateDataObjectsRequest')
+    ListDataObjectsRequest = models.get_model('ListDataObjectsRequest')
+    checksum = str(uuid.uuid1())
+    data_objects = [
+        DataObject(
+            name="page{}".format(i),
+            size="12345",
+            checksums=[Checksum(checksum=checksum, type="md5")],
+            urls=[URL(url="page{}".format(i))])
+        for i in range(25)]
+    create_request = CreateDataObjectsRequest(data_objects=data_objects)
+    client.CreateDataObjects(body=create_request).result()
+    page_token = None
+    names = []
+    while(True):
+        list_request = ListDataObjectsRequest(checksum={'checksum': checksum},
+                                              page_size=7,
+                                              page_token=page_token)
+        list_response = client.ListDataObjects(body=list_request).result()
+        names.extend([x.name for x in list_response.data_objects])
+        page_token = list_response.next_page_token
+        if not page_token:
+            break
+    assert sorted(names) == sorted(["page{}".format(i) for i in range(25)])
+    # newest first
+    assert names[0] == 'page24'
+
+    list_request = ListDataObjectsRequest(page_token='not-a-cursor')
+    with pytest.raises(HTTPBadRequest):
+        client.ListDataObjects(body=list_request).result()
+
+
+def test_etag():
+    """ conditional get answers 304 until the object changes """
+    Checksum = models.get_model('Checksum')
+    URL = models.get_model('URL')
+    DataObject = models.get_model('DataObject')
+    CreateDataObjectRequest = models.get_model('CreateDataObjectRequest')
+    UpdateDataObjectRequest = models.get_model('UpdateDataObjectRequest')
+    id = str(uuid.uuid1())
+    create_data_object = DataObject(
+        id=id,
+        name="etag",
+        size="12345",
+        checksums=[Checksum(checksum=id, type="md5")],
+        urls=[URL(url=id)])
+    create_request = CreateDataObjectRequest(data_object=create_data_object)
+    client.CreateDataObject(body=create_request).result()
+    url = '{}/dataobjects/{}'.format(SERVER_URL, id)
+    r = requests.get(url)
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+    version = r.json()['data_object']['version']
+    r = requests.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.headers['ETag'] == etag
+    assert not r.content
+
+    update_data_object = DataObject(
+        name="etag",
+        size="12345",
+        checksums=[Checksum(checksum=id, type="md5")],
+        urls=[URL(url=id), URL(url='changed')])
+    update_request = UpdateDataObjectRequest(data_object=update_data_object)
+    client.UpdateDataObject(data_object_id=id, body=update_request).result()
+    r = requests.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+
+    # a version still answers 304, until the object is deleted
+    versioned = {'version': version}
+    r = requests.get(url, params=versioned, headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    client.DeleteDataObject(data_object_id=id).result()
+    r = requests.get(url, params=versioned, headers={'If-None-Match': etag})
+    assert r.status_code == 404
+    r = requests.get(url, params=versioned)
+    assert r.status_code == 404
+
+
+def test_update_twice():
+    """ back to back updates both apply, each reads the latest version """
+    Checksum = models.get_model('Checksum')
+    URL = models.get_model('URL')
+    DataObject = models.get_model('DataObject')
+    CreateDataObjectRequest = models.get_model('CreateDataObjectRequest')
+    UpdateDataObjectRequest = models.get_model('UpdateDataObjectRequest')
+    id = str(uuid.uuid1())
+    create_data_object = DataObject(
+        id=id,
+        name="twice",
+        size="12345",
+        checksums=[Checksum(checksum=id, type="md5")],
+        urls=[URL(url=id)])
+    create_request = CreateDataObjectRequest(data_object=create_data_object)
+    client.CreateDataObject(body=create_request).result()
+    for url in ['first', 'second']:
+        update_data_object = DataObject(
+            name="twice",
+            size="12345",
+            checksums=[Checksum(checksum=id, type="md5")],
+            urls=[URL(url=id), URL(url=url)])
+        update_request = UpdateDataObjectRequest(
+            data_object=update_data_object)
+        client.UpdateDataObject(data_object_id=id,
+                                body=update_request).result()
+    data_object = client.GetDataObject(
+        data_object_id=id).result().data_object
+    assert [url.url for url in data_object.urls] == [id, 'second']
+    versions = client.GetDataObjectVersions(
+        data_object_id=id).result().data_objects
+    assert len(versions) == 3
+    assert len(set([version.version for version in versions])) == 3
+
+
+def test_export():
+    """ export streams one object per line, gzip when accepted """
+    Checksum = models.get_model('Checksum')
+    URL = models.get_model('URL')
+    DataObject = models.get_model('DataObject')
+    CreateDataObjectRequest = models.get_model('CreateDataObjectRequest')
+    UpdateDataObjectRequest = models.get_model('UpdateDataObjectRequest')
+    id = str(uuid.uuid1())
+    create_data_object = DataObject(
+        id=id,
+        name="export",
+        size="12345",
+        checksums=[Checksum(checksum=id, type="md5")],
+        urls=[URL(url=id)])
+    create_request = CreateDataObjectRequest(data_object=create_data_object)
+    client.CreateDataObject(body=create_request).result()
+    update_data_object = DataObject(
+        name="export",
+        size="12345",
+        checksums=[Checksum(checksum=id, type="md5")],
+        urls=[URL(url=id), URL(url='changed')])
+    update_request = UpdateDataObjectRequest(data_object=update_data_object)
+    client.UpdateDataObject(data_object_id=id, body=update_request).result()
+
+    url = '{}/dataobjects/export'.format(SERVER_URL)
+    r = requests.get(url, headers={'Accept-Encoding': 'identity'})
+    assert r.status_code == 200
+    assert 'Content-Encoding' not in r.headers
+    lines = r.text.splitlines()
+    exported = [json.loads(line) for line in lines]
+    assert len([x for x in exported if x['id'] == id]) == 1
+    assert all([x['current'] for x in exported])
+
+    r = requests.get(url, params={'all_versions': 'true'},
+                     headers={'Accept-Encoding': 'gzip'}, stream=True)
+    assert r.status_code == 200
+    assert r.headers['Content-Encoding'] == 'gzip'
+    # requests decompresses transparently
+    exported = [json.loads(line) for line in r.iter_lines() if line]
+    assert len([x for x in exported if x['id'] == id]) == 2
+    assert len(exported) > len(lines)
+
+
+def test_resolve():
+    """ resolve many keys in one request, keyed by input """
+    Checksum = models.get_model('Checksum')
+    URL = models.get_model('URL')
+    DataObject = models.get_model('DataObject')
+    CreateDataObjectsRequest = models.get_model('CreateDataObjectsRequest')
+    ResolveDataObjectsRequest = models.get_model('ResolveDataObjectsRequest')
+    ids = [str(uuid.uuid1()) for i in range(3)]
+    data_objects = [
+        DataObject(
+            id=id,
+            name="resolve",
+            size="12345",
+            aliases=['alias-' + id],
+            checksums=[Checksum(checksum='checksum-' + id, type="md5")],
+            urls=[URL(url='url-' + id)])
+        for id in ids]
+    create_request = CreateDataObjectsRequest(data_objects=data_objects)
+    client.CreateDataObjects(body=create_request).result()
+
+    missing = str(uuid.uuid1())
+    resolve_request = ResolveDataObjectsRequest(
+        ids=ids + [missing],
+        checksums=['checksum-' + id for id in ids],
+        aliases=['alias-' + ids[0]],
+        urls=['url-' + ids[1]])
+    resolved = client.ResolveDataObjects(body=resolve_request).result()
+    for id in ids:
+        assert [x.id for x in resolved.ids[id]] == [id]
+        assert [x.id for x in resolved.checksums['checksum-' + id]] == [id]
+    assert resolved.ids[missing] == []
+    assert [x.id for x in resolved.aliases['alias-' + ids[0]]] == [ids[0]]
+    assert [x.id for x in resolved.urls['url-' + ids[1]]] == [ids[1]]
@@ -0,0 +1,131 @@
+import os
+import tempfile
+import pytest
+
+# the backend creates its schema on import
+os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(),
+                                         'dos_connect.sqlite')
+from dos_connect.server import sqlite_backend  # NOQA
+from dos_connect.server.utils import AttributeDict  # NOQA
+
+
+def _close():
+    """ drop this thread's connection, the next call reopens the file """
+    db = getattr(sqlite_backend._local, 'db', None)
+    if db is not None:
+        db.close()
+        del sqlite_backend._local.db
+
+
+@pytest.fixture
+def backend(tmpdir, monkeypatch):
+    """ the sqlite backend on an empty file """
+    _close()
+    monkeypatch.setattr(sqlite_backend, 'SQLITE_PATH',
+                        str(tmpdir.join('dos_connect.sqlite')))
+    sqlite_backend._create_schema()
+    yield sqlite_backend
+    _close()
+
+
+def _doc(id, url):
+    return AttributeDict({
+        'id': id,
+        'current': True,
+        'urls': [{'url': url}],
+        'checksums': [{'checksum': 'md5-' + url, 'type': 'md5'}],
+        'aliases': ['alias-' + id],
+    })
+
+
+def _ids(hits):
+    return [hit.id for hit in hits]
+
+
+def test_save_search(backend):
+    """ a saved document is found by each of its properties """
+    backend.save(_doc('a', 'url-a'))
+    backend.save(_doc('b', 'url-b'))
+    assert _ids(backend.search({'id': 'a'})) == ['a']
+    assert _ids(backend.search({'url': 'url-b'})) == ['b']
+    assert _ids(backend.search(
+        {'checksum': {'checksum': 'md5-url-a', 'type': 'md5'}})) == ['a']
+    assert _ids(backend.search({'alias': 'alias-b'})) == ['b']
+    assert _ids(backend.search({'current': True})) == ['b', 'a']
+    with pytest.raises(Exception):
+        backend.save(_doc('a', 'url-a'))
+
+
+def test_new_version(backend):
+    """ a new version retires the previous one and takes its postings """
+    first = backend.save(_doc('a', 'url-1'))
+    second = backend.new_version('a', _doc('a', 'url-2'))
+    third = backend.new_version('a', _doc('a', 'url-3'))
+    versions = list(backend.search({'id': 'a'}))
+    assert [hit.version for hit in versions] == \
+        [third.version, second.version, first.version]
+    assert [hit.current for hit in versions] == [True, False, False]
+    assert backend.current_version('a') == third.version
+    assert _ids(backend.search({'url': 'url-1', 'current': True})) == []
+    resolved = backend.resolve({'url': ['url-1', 'url-3']})
+    assert resolved['url']['url-1'] == []
+    assert [hit.version for hit in resolved['url']['url-3']] == \
+        [third.version]
+    with pytest.raises(Exception):
+        backend.new_version('missing', _doc('missing', 'url'))
+
+
+def test_new_version_of_current(backend):
+    """ the current version is retired, not the newest one """
+    current = backend.save(_doc('a', 'url-1'))
+    backend.save(AttributeDict(_doc('a', 'url-0'), current=False,
+                               version='0'))
+    new = backend.new_version('a', _doc('a', 'url-2'))
+    assert [(hit.version, hit.current)
+            for hit in backend.search({'id': 'a'})] == \
+        [(new.version, True), ('0', False), (current.version, False)]
+
+
+def test_delete(backend):
+    """ delete removes every version and its postings """
+    backend.save(_doc('a', 'url-1'))
+    backend.new_version('a', _doc('a', 'url-2'))
+    backend.save(_doc('b', 'url-b'))
+    backend.delete({'id': 'a'})
+    assert _ids(backend.search({'id': 'a'})) == []
+    assert _ids(backend.search({'url': 'url-2'})) == []
+    assert backend.current_version('a') is None
+    assert _ids(backend.search({})) == ['b']
+    counts = dict((m.name, m.count) for m in backend.metrics())
+    assert counts == {'data_objects': 1, 'data_bundles': 0}
+
+
+def test_paging(backend):
+    """ pages follow the cursor of the last hit, newest first """
+    for i in range(5):
+        backend.save(_doc(str(i), 'url-{}'.format(i)))
+    pages = []
+    after = None
+    while True:
+        page = list(backend.search({}, size=2, include_total=True,
+                                   after=after))
+        if not page:
+            break
+        assert set(total for _, total in page) == set([5])
+        pages.append(_ids(hit for hit, _ in page))
+        after = page[-1][0].meta.sort
+    assert pages == [['4', '3'], ['2', '1'], ['0']]
+    assert _ids(backend.search({}, size=2, offset=3)) == ['1', '0']
+    assert _ids(backend.scan({})) == ['0', '1', '2', '3', '4']
+
+
+def test_reopen(backend):
+    """ documents survive reopening the file, new ones sort after them """
+    backend.save(_doc('a', 'url-a'))
+    version = backend.new_version('a', _doc('a', 'url-a2')).version
+    _close()
+    backend._create_schema()
+    assert backend.current_version('a') == version
+    assert len(list(backend.search({'id': 'a'}))) == 2
+    backend.save(_doc('b', 'url-b'))
+    assert _ids(backend.search({})) == ['b', 'a', 'a']
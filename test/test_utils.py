@@ -0,0 +1,122 @@
+import json
+from dos_connect.server import utils
+from dos_connect.server.utils import AttributeDict
+
+
+def _doc():
+    return AttributeDict({
+        'id': 'a',
+        'checksums': [{'checksum': 'md5-a', 'type': 'md5'}],
+        'urls': [{'url': 's3://bucket/a',
+                  'system_metadata': {'event_type': 'ObjectCreated:Put',
+                                      'bucket_name': 'bucket',
+                                      'etag': 'etag-a'},
+                  'user_metadata': {'project': 'project-a'}}],
+        'meta': AttributeDict({'id': 1, 'sort': [1]}),
+    })
+
+
+def test_to_dict_copies():
+    """ changing what to_dict returns leaves the document alone """
+    doc = _doc()
+    copy = doc.to_dict()
+    assert copy == doc
+    assert type(copy['meta']) is dict
+    copy['urls'][0]['system_metadata']['etag'] = 'changed'
+    copy['urls'].append({'url': 'other'})
+    copy['checksums'][0]['type'] = 'sha256'
+    copy['meta']['sort'].append(2)
+    assert doc == _doc()
+    assert doc.to_dict() == _doc().to_dict()
+
+
+def test_compact_interns_known_fields():
+    """ keys and INTERNED_FIELDS values are shared, other values not """
+    def stored():
+        # distinct string objects, as if parsed from separate requests
+        return utils.compact(AttributeDict(
+            json.loads(json.dumps(_doc()))))
+    first, second = stored(), stored()
+    assert first == _doc().to_dict()
+    system_metadata = [doc['urls'][0]['system_metadata']
+                       for doc in [first, second]]
+    for field in ['event_type', 'bucket_name']:
+        assert system_metadata[0][field] is system_metadata[1][field]
+    assert first['checksums'][0]['type'] is second['checksums'][0]['type']
+    assert system_metadata[0].keys()[0] is system_metadata[1].keys()[0]
+    assert system_metadata[0]['etag'] is not system_metadata[1]['etag']
+    user_metadata = [doc['urls'][0]['user_metadata']
+                     for doc in [first, second]]
+    assert user_metadata[0]['project'] is not user_metadata[1]['project']
+
+
+class _Clock(object):
+    """ time.time() the test moves forward """
+
+    def __init__(self):
+        self.now = 1500000000.0
+
+    def time(self):
+        return self.now
+
+
+def test_ttl_cache_expiry(monkeypatch):
+    """ entries expire after the cache ttl, their own ttl or expires """
+    clock = _Clock()
+    monkeypatch.setattr(utils, 'time', clock)
+    cache = utils.TTLCache(maxsize=10, ttl=60)
+    cache.set('default', 1)
+    cache.set('short', 2, ttl=5)
+    cache.set('until', 3, expires=clock.now + 30)
+    assert [cache.get(k) for k in ['default', 'short', 'until']] == [1, 2, 3]
+    clock.now += 5
+    assert cache.get('short') is None
+    assert cache.get('until', 'missing') == 3
+    clock.now += 25
+    assert cache.get('until', 'missing') == 'missing'
+    assert cache.get('default') == 1
+    clock.now += 30
+    assert cache.get('default') is None
+    assert (cache.hits, cache.misses) == (5, 3)
+
+
+def test_ttl_cache_lru(monkeypatch):
+    """ the least recently used entry is evicted first """
+    monkeypatch.setattr(utils, 'time', _Clock())
+    cache = utils.TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # a is now more recent than b
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert [cache.get(k) for k in ['a', 'b', 'c']] == [1, None, 3]
+    # setting again refreshes recency too
+    cache.set('a', 4)
+    cache.set('d', 5)
+    assert [cache.get(k) for k in ['a', 'c', 'd']] == [4, None, 5]
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_document_id():
+    """ the same content has the same id, whatever the order of its lists """
+    doc = {'id': 'a',
+           'checksums': [{'checksum': 'c1', 'type': 'md5'},
+                         {'checksum': 'c2', 'type': 'sha256'}],
+           'urls': [{'url': 'u1'}, {'url': 'u2'}],
+           'name': 'ignored'}
+    reordered = {'id': 'a',
+                 'checksums': list(reversed(doc['checksums'])),
+                 'urls': list(reversed(doc['urls'])),
+                 'aliases': ['ignored']}
+    assert utils.document_id(doc) == utils.document_id(reordered)
+    assert len(utils.document_id(doc)) == 64
+    for changed in [dict(doc, id='b'), dict(doc, version='1'),
+                    dict(doc, urls=[{'url': 'u1'}]),
+                    dict(doc, checksums=[{'checksum': 'c1', 'type': 'sha1'},
+                                         {'checksum': 'c2',
+                                          'type': 'sha256'}])]:
+        assert utils.document_id(changed) != utils.document_id(doc)